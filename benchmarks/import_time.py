@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""
+Import time benchmark of the obsfinder package and of its command line tools.
+
+Each target is run in a fresh interpreter several times, and the best wall time, minus the
+start-up time of an empty interpreter, is compared to its budget. The script also checks that
+the heavy dependencies are not imported by these targets. It returns 1 if a budget is exceeded,
+so that it can be used as a gate in CI. With -o, results are appended to a JSON-lines file to
+track the import time across versions.
+
+Usage: python benchmarks/import_time.py [-n 10] [-o import_time.jsonl]
+"""
+
+import subprocess
+import argparse
+import json
+import time
+import sys
+
+# Budget of each target (in millisecond, on top of the interpreter start-up)
+BUDGETS = {"import obsfinder": 20,
+           "import obsfinder.findgaia": 60,
+           "import obsfinder.find2mass": 60,
+           "import obsfinder.findgaia2mass": 60,
+           "import obsfinder.findsimbad": 60,
+           "import obsfinder.finder": 80,
+           "pyfindsimbad -h": 100,
+           "pyfinder -h": 120}
+
+# Modules that must not be imported by any target
+HEAVY_MODULES = ["pandas", "numpy", "h5py", "zero_point", "xml.dom.minidom"]
+
+def target_code(target: str) -> str:
+    """
+    Python code running a target
+
+    Args:
+        target (str): 'import <module>' or '<console script> -h'
+
+    Returns:
+        str: Code to run with python -c
+    """
+
+    if target.startswith("import "):
+        return target
+
+    script, *args = target.split()
+    module = {"pyfindgaia": "findgaia", "pyfind2mass": "find2mass", "pyfindgaia2mass": "findgaia2mass",
+              "pyfinder": "finder", "pyfindsimbad": "findsimbad"}[script]
+
+    return (f"import sys\nsys.argv = {[script] + args!r}\nfrom obsfinder.{module} import main\n"
+            "try:\n    main()\nexcept SystemExit:\n    pass\n")
+
+def run(code: str, repeat: int) -> float:
+    """
+    Best wall time of a piece of code run in a fresh interpreter
+
+    Args:
+        code (str): Python code
+        repeat (int): Number of runs
+
+    Returns:
+        float: Best time (in millisecond)
+    """
+
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check = True, stdout = subprocess.DEVNULL)
+        best = min(best, (time.perf_counter() - t0) * 1e3)
+
+    return best
+
+def heavy_imports(code: str) -> list:
+    """
+    Heavy modules imported by a piece of code
+
+    Args:
+        code (str): Python code
+
+    Returns:
+        list: Names of the heavy modules found in sys.modules
+    """
+
+    check = code + f"\nimport sys\nprint('heavy:', *[name for name in {HEAVY_MODULES!r} if name in sys.modules])\n"
+    output = subprocess.run([sys.executable, "-c", check], check = True, capture_output = True, text = True).stdout
+
+    return [line for line in output.splitlines() if line.startswith('heavy:')][-1].split()[1:]
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description = "Import time benchmark of obsfinder")
+    parser.add_argument('-n', type = int, required = False, help = "Number of runs per target", default = 10)
+    parser.add_argument('-o', type = str, required = False, help = "JSON-lines file the results are appended to", default = None)
+    args = parser.parse_args()
+
+    baseline = run("pass", args.n)
+    results = {}
+    status = 0
+
+    print(f"Interpreter start-up: {baseline:.1f} ms")
+    print(f"{'target':35s} {'time (ms)':>10s} {'budget':>8s}  heavy imports")
+    for target, budget in BUDGETS.items():
+        code = target_code(target)
+        elapsed = run(code, args.n) - baseline
+        heavy = heavy_imports(code)
+        ok = elapsed <= budget and len(heavy) == 0
+        status = status if ok else 1
+        results[target] = {"time": elapsed, "budget": budget, "heavy": heavy}
+        print(f"{target:35s} {elapsed:10.1f} {budget:8d}  {' '.join(heavy) if heavy else '-'}{'' if ok else '  FAILED'}")
+
+    if args.o != None:
+        with open(args.o, 'a') as f:
+            f.write(json.dumps({"time": time.time(), "python": sys.version.split()[0], "baseline": baseline, "results": results}) + "\n")
+
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
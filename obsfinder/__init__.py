@@ -1,5 +1,23 @@
-from .findgaia import Findgaia, FindGaiaQuery
-from .find2mass import Find2mass
-from .findgaia2mass import Findgaia2mass
-from .finder import Finder
-from .findsimbad import FindSimbad
\ No newline at end of file
+import importlib
+
+# Classes exported by the package, imported on first use to keep the start-up fast
+_exports = {"Findgaia": ".findgaia",
+            "FindGaiaQuery": ".findgaia",
+            "Find2mass": ".find2mass",
+            "Findgaia2mass": ".findgaia2mass",
+            "Finder": ".finder",
+            "FindSimbad": ".findsimbad",
+            "Catalog": ".catalog",
+            "MOC": ".moc"}
+
+__all__ = list(_exports)
+
+def __getattr__(name):
+    if name in _exports:
+        value = getattr(importlib.import_module(_exports[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from .lazy import lazy_import
+
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+h5py = lazy_import("h5py")
+
+# Size of the cells of the grid index (in degree)
+DEFAULT_CELL = 1 / 60
+
+def cell_ids(lon, lat, cell: float = DEFAULT_CELL) -> np.ndarray:
+    """
+    Cell of the grid index containing each position. Cells are numbered along the longitude first,
+    so that the cells of a band of latitude have consecutive numbers.
+
+    Args:
+        lon (array-like): Galactic longitudes (in degree)
+        lat (array-like): Galactic latitudes (in degree)
+        cell (float, optional): Size of the cells (in degree). Default to DEFAULT_CELL (1 arcmin).
+
+    Returns:
+        np.ndarray: Cell numbers (int64)
+    """
+
+    ncols = int(np.ceil(360 / cell))
+    rows = np.floor((np.asarray(lat, dtype = np.float64) + 90) / cell).astype(np.int64)
+    cols = np.floor(np.mod(np.asarray(lon, dtype = np.float64), 360) / cell).astype(np.int64)
+
+    return rows * ncols + np.minimum(cols, ncols - 1)
+
+def write_index(group, lon, lat, cell: float = DEFAULT_CELL) -> np.ndarray:
+    """
+    Write the grid index of a catalog in an hdf5 file or group. The rows of the catalog must then be
+    written in the returned order (sorted by cell), so that the sources of a cell are contiguous.
+
+    Args:
+        group (h5py.Group): File or group in which the catalog is written
+        lon (array-like): Galactic longitudes of the sources (in degree)
+        lat (array-like): Galactic latitudes of the sources (in degree)
+        cell (float, optional): Size of the cells (in degree). Default to DEFAULT_CELL (1 arcmin).
+
+    Returns:
+        np.ndarray: Order in which the rows must be written
+    """
+
+    ids = cell_ids(lon, lat, cell)
+    order = np.argsort(ids, kind = "stable")
+    cells, starts = np.unique(ids[order], return_index = True)
+
+    index = group.create_group('index')
+    index.attrs['cell'] = cell
+    index.create_dataset('cells', data = cells.astype(np.int64))
+    index.create_dataset('offsets', data = np.append(starts, len(ids)).astype(np.int64))
+
+    return order
+
+def in_polygon(lon: np.ndarray, lat: np.ndarray, vertices: np.ndarray) -> np.ndarray:
+    """
+    Whether each position is inside a polygon (even-odd rule), the longitude and latitude being used as planar coordinates
+
+    Args:
+        lon (np.ndarray): Longitudes (in degree)
+        lat (np.ndarray): Latitudes (in degree)
+        vertices (np.ndarray): Vertices of the polygon, of shape (n, 2)
+
+    Returns:
+        np.ndarray: Boolean mask
+    """
+
+    inside = np.zeros(len(lon), dtype = bool)
+    for (l0, b0), (l1, b1) in zip(vertices, np.roll(vertices, -1, axis = 0)):
+        crosses = (b0 > lat) != (b1 > lat)
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            edge = l0 + (lat - b0) * (l1 - l0) / (b1 - b0)
+        inside ^= crosses & (lon < edge)
+
+    return inside
+
+class Catalog():
+    """
+    This class reads the catalogs saved in hdf5 files by the finders (Findgaia, Find2mass, Findgaia2mass,
+    or a group of a file written by Finder.get_obs_multi). The sources are sorted by cell of a grid in
+    Galactic coordinates when the file is written, and the index of the cells is saved with them, so that
+    box, cone and polygon selections only read the rows of the cells they intersect. Files written without
+    index are read entirely.
+    """
+
+    def __init__(self, filename: str, group: str = None) -> None:
+        """
+        Initialize the class
+
+        Args:
+            filename (str): Path of the hdf5 file
+            group (str, optional): Group of the catalog in the file (e.g. 'gaia'). Default to None (root of the file).
+        """
+
+        self.filename = filename
+        self.group = group
+
+        with h5py.File(self.filename, 'r') as f:
+            root = f[group] if group != None else f
+            self.columns = [name for name in root.keys() if isinstance(root[name], h5py.Dataset)]
+            self.size = len(root['l'])
+            self.indexed = 'index' in root
+            if self.indexed:
+                self.cell = float(root['index'].attrs['cell'])
+                self.cells = root['index/cells'][()]
+                self.offsets = root['index/offsets'][()]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def ranges(self, lmin: float, lmax: float, bmin: float, bmax: float) -> list:
+        """
+        Ranges of rows of the cells intersecting a box
+
+        Args:
+            lmin (float): Lowest longitude (in degree). If lmin > lmax, the box contains l = 0.
+            lmax (float): Highest longitude (in degree)
+            bmin (float): Lowest latitude (in degree)
+            bmax (float): Highest latitude (in degree)
+
+        Returns:
+            list: Ranges of rows, as (start, end), sorted and merged
+        """
+
+        if not self.indexed:
+            return [(0, self.size)]
+
+        ncols = int(np.ceil(360 / self.cell))
+        rows = np.arange(int(np.floor((bmin + 90) / self.cell)), int(np.floor((bmax + 90) / self.cell)) + 1)
+        if lmax - lmin >= 360:
+            lmin, lmax = 0, 360
+        else:
+            lmin, lmax = np.mod(lmin, 360), np.mod(lmax, 360)
+        if lmin <= lmax:
+            spans = [(int(lmin / self.cell), min(int(lmax / self.cell), ncols - 1))]
+        else:
+            spans = [(int(lmin / self.cell), ncols - 1), (0, int(lmax / self.cell))]
+
+        ranges = []
+        for first, last in spans:
+            starts = self.offsets[np.searchsorted(self.cells, rows * ncols + first, side = 'left')]
+            ends = self.offsets[np.searchsorted(self.cells, rows * ncols + last, side = 'right')]
+            ranges += [(start, end) for start, end in zip(starts.tolist(), ends.tolist()) if end > start]
+
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+
+        return merged
+
+    def read_rows(self, ranges: list, columns: list) -> dict:
+        """
+        Read some ranges of rows of some columns
+
+        Args:
+            ranges (list): Ranges of rows, as (start, end)
+            columns (list): Names of the datasets to read
+
+        Returns:
+            dict: Values of each column, as {column: np.ndarray}
+        """
+
+        with h5py.File(self.filename, 'r') as f:
+            root = f[self.group] if self.group != None else f
+            values = {}
+            for column in columns:
+                dataset = root[column]
+                parts = [dataset[start:end] for start, end in ranges]
+                values[column] = np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype = dataset.dtype)
+
+        return values
+
+    def select(self, box: tuple, mask, columns: list = None, as_frame: bool = True):
+        """
+        Read the sources of the cells intersecting a box, and keep the ones selected by a mask
+
+        Args:
+            box (tuple): Box containing the selection, as (lmin, lmax, bmin, bmax)
+            mask (callable): Function of (l, b) returning the boolean mask of the selected sources
+            columns (list, optional): Columns to return. Default to None (all columns).
+            as_frame (bool, optional): Return a DataFrame (True) or a dictionary of numpy arrays (False). Default to True.
+
+        Returns:
+            pd.DataFrame or dict: Selected sources
+        """
+
+        columns = list(columns) if columns is not None else self.columns
+        ranges = self.ranges(*box)
+        coordinates = self.read_rows(ranges, ['l', 'b'])
+        keep = mask(coordinates['l'], coordinates['b'])
+
+        values = self.read_rows(ranges, [column for column in columns if column not in ('l', 'b')])
+        values.update(coordinates)
+        values = {column: values[column][keep] for column in columns}
+
+        return pd.DataFrame(values) if as_frame else values
+
+    def read(self, columns: list = None, as_frame: bool = True):
+        """
+        Read the whole catalog
+
+        Args:
+            columns (list, optional): Columns to return. Default to None (all columns).
+            as_frame (bool, optional): Return a DataFrame (True) or a dictionary of numpy arrays (False). Default to True.
+
+        Returns:
+            pd.DataFrame or dict: All the sources
+        """
+
+        values = self.read_rows([(0, self.size)], list(columns) if columns is not None else self.columns)
+
+        return pd.DataFrame(values) if as_frame else values
+
+    def box(self, lmin: float, lmax: float, bmin: float, bmax: float, columns: list = None, as_frame: bool = True):
+        """
+        Select the sources in a box of Galactic coordinates
+
+        Args:
+            lmin (float): Lowest longitude (in degree). If lmin > lmax, the box contains l = 0 (e.g. 359 to 1).
+            lmax (float): Highest longitude (in degree)
+            bmin (float): Lowest latitude (in degree)
+            bmax (float): Highest latitude (in degree)
+            columns (list, optional): Columns to return. Default to None (all columns).
+            as_frame (bool, optional): Return a DataFrame (True) or a dictionary of numpy arrays (False). Default to True.
+
+        Returns:
+            pd.DataFrame or dict: Selected sources
+        """
+
+        if lmax - lmin >= 360:
+            lmin, lmax = 0, 360
+        else:
+            lmin, lmax = np.mod(lmin, 360), np.mod(lmax, 360)
+
+        def mask(l, b):
+            inside_l = (l >= lmin) & (l <= lmax) if lmin <= lmax else (l >= lmin) | (l <= lmax)
+            return inside_l & (b >= bmin) & (b <= bmax)
+
+        return self.select((lmin, lmax, bmin, bmax), mask, columns, as_frame)
+
+    def cone(self, lvalue: float, bvalue: float, radius: float, columns: list = None, as_frame: bool = True):
+        """
+        Select the sources within a radius of a position
+
+        Args:
+            lvalue (float): Galactic longitude of the center (in degree)
+            bvalue (float): Galactic latitude of the center (in degree)
+            radius (float): Radius of the cone (in arcmin)
+            columns (list, optional): Columns to return. Default to None (all columns).
+            as_frame (bool, optional): Return a DataFrame (True) or a dictionary of numpy arrays (False). Default to True.
+
+        Returns:
+            pd.DataFrame or dict: Selected sources
+        """
+
+        radius = radius / 60
+        bmin, bmax = max(bvalue - radius, -90), min(bvalue + radius, 90)
+        if bmin <= -90 or bmax >= 90:
+            box = (0, 360, bmin, bmax)
+        else:
+            width = min(radius / np.cos(np.radians(max(abs(bmin), abs(bmax)))), 180)
+            box = (lvalue - width, lvalue + width, bmin, bmax)
+
+        def mask(l, b):
+            l, b, l0, b0 = np.radians(l), np.radians(b), np.radians(lvalue), np.radians(bvalue)
+            cos_distance = np.sin(b) * np.sin(b0) + np.cos(b) * np.cos(b0) * np.cos(l - l0)
+            return cos_distance >= np.cos(np.radians(radius))
+
+        return self.select(box, mask, columns, as_frame)
+
+    def polygon(self, vertices: list, columns: list = None, as_frame: bool = True):
+        """
+        Select the sources inside a polygon. The edges of the polygon are straight lines in the (l, b)
+        plane, which is accurate for polygons of a few degrees away from the poles.
+
+        Args:
+            vertices (list): Vertices of the polygon, as [(l1, b1), (l2, b2), ...] (in degree). Longitudes may be negative
+                to cross l = 0 (e.g. [(-1, 0), (1, 0), (0, 1)]).
+            columns (list, optional): Columns to return. Default to None (all columns).
+            as_frame (bool, optional): Return a DataFrame (True) or a dictionary of numpy arrays (False). Default to True.
+
+        Returns:
+            pd.DataFrame or dict: Selected sources
+        """
+
+        vertices = np.asarray(vertices, dtype = np.float64)
+        lmin, lmax = vertices[:, 0].min(), vertices[:, 0].max()
+        center = (lmin + lmax) / 2
+
+        def mask(l, b):
+            # Longitudes unwrapped around the center of the polygon
+            l = center + np.mod(l - center + 180, 360) - 180
+            return in_polygon(l, b, vertices)
+
+        return self.select((lmin, lmax, vertices[:, 1].min(), vertices[:, 1].max()), mask, columns, as_frame)
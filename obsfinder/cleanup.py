@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+from .journal import JobJournal
+from .tap import TapService
+import argparse
+import time
+import sys
+
+def cleanup_jobs(journal: JobJournal, proxy: tuple[str, int] = None, max_age: float = 0, verbose: int = 0) -> int:
+    """
+    Abort and delete from the servers all the jobs of a journal that have not been deleted yet,
+    for example the jobs left by an interrupted run or kept with keep_results.
+
+    Args:
+        journal (JobJournal):
+            Journal of the submitted jobs
+        proxy (tuple[str, int], optional):
+            Proxy to use, if needed. Tuple containing the adresse of the proxy and the port to use. Default to None.
+        max_age (float, optional):
+            Only clean the jobs whose last update is older than this value (in minute). Default to 0 (all jobs).
+        verbose (int, optional):
+            Toggle verbose (1 or 0). Default to 0.
+
+    Returns:
+        int: Number of deleted jobs
+    """
+
+    deleted = 0
+    for entry in journal.jobs(['SUBMITTED', 'COMPLETED', 'FETCHED', 'ABORTED']):
+        if time.time() - entry["time"] < max_age * 60:
+            continue
+
+        tap = TapService(entry["host"], entry.get("port", 443), entry["pathinfo"], proxy = proxy, verbose = verbose, journal = journal)
+        try:
+            # Jobs still running are aborted first
+            if entry["state"] == 'SUBMITTED':
+                phase, _ = tap.phase(entry["jobid"])
+                if phase in ['PENDING', 'QUEUED', 'EXECUTING']:
+                    tap.abort(entry["jobid"], entry["key"])
+                    deleted += 1
+                    continue
+
+            tap.delete(entry["jobid"], entry["key"])
+            deleted += 1
+        except Exception as error:
+            print(f"Could not delete job {entry['jobid']} on {entry['host']}: {error}")
+
+    return deleted
+
+def main() -> int:
+    """
+    Main function used when the script is called from a command line
+    """
+    # Arguments definition
+    parser = argparse.ArgumentParser(description = "Abort and delete the jobs of a journal that are still stored on the archives")
+    parser.add_argument('-journal', type = str, required = True, help = "Journal of the submitted jobs")
+    parser.add_argument('-age', type = float, required = False, help = "Only clean the jobs whose last update is older than this value (minute)", default = 0)
+    parser.add_argument('-v', type = int, required = False, help = "Verbose", default = 0)
+    parser.add_argument('-proxy', type = str, required = False, help = "Proxy to use host:port", default = None)
+
+    # Get arguments value
+    args = parser.parse_args()
+
+    if args.proxy != None:
+        proxy = (args.proxy.split(':')[0], int(args.proxy.split(':')[1]))
+    else:
+        proxy = None
+
+    deleted = cleanup_jobs(JobJournal(args.journal, verbose = args.v), proxy = proxy, max_age = args.age, verbose = args.v)
+    print(f"{deleted} jobs deleted")
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from .catalog import Catalog
+from .moc import MOC
+from .lazy import lazy_import
+import glob
+import os
+
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+h5py = lazy_import("h5py")
+
+# Boxes thinner than this (in degree) are rounding errors, and are not queried
+TOLERANCE = 1e-9
+
+def pixel_boxes(lvalue: float, bvalue: float, psize: float) -> list:
+    """
+    Boxes of Galactic coordinates covered by a pixel, split in two at l = 0 if needed
+
+    Args:
+        lvalue (float): Square center value in Galactic longitude (in degree)
+        bvalue (float): Square center value in Galactic latitude (in degree)
+        psize (float): Pixel size (in degree)
+
+    Returns:
+        list: Boxes, as [lmin, lmax, bmin, bmax] with longitudes in [0, 360]
+    """
+
+    lmin, lmax = lvalue - psize/2, lvalue + psize/2
+    bmin, bmax = bvalue - psize/2, bvalue + psize/2
+
+    if lmin < 0 and lmax > 0:
+        return [[360 + lmin, 360, bmin, bmax], [0, lmax, bmin, bmax]]
+
+    return [[lmin, lmax, bmin, bmax]]
+
+def area(boxes: list) -> float:
+    """
+    Total area of disjoint boxes (in square degree of the (l, b) plane)
+
+    Args:
+        boxes (list): Boxes, as [lmin, lmax, bmin, bmax]
+
+    Returns:
+        float: Area of the boxes
+    """
+
+    return sum((lmax - lmin) * (bmax - bmin) for lmin, lmax, bmin, bmax in boxes)
+
+def subtract_boxes(boxes: list, covered: list) -> list:
+    """
+    Part of some boxes not covered by other boxes, as a list of disjoint boxes
+
+    Args:
+        boxes (list): Boxes, as [lmin, lmax, bmin, bmax]
+        covered (list): Boxes already covered
+
+    Returns:
+        list: Uncovered boxes
+    """
+
+    for clmin, clmax, cbmin, cbmax in covered:
+        pieces = []
+        for lmin, lmax, bmin, bmax in boxes:
+            if clmin >= lmax or clmax <= lmin or cbmin >= bmax or cbmax <= bmin:
+                pieces.append([lmin, lmax, bmin, bmax])
+                continue
+
+            # Bands below and above the covered box, then the parts on its sides
+            if cbmin > bmin:
+                pieces.append([lmin, lmax, bmin, cbmin])
+            if cbmax < bmax:
+                pieces.append([lmin, lmax, cbmax, bmax])
+            low, high = max(bmin, cbmin), min(bmax, cbmax)
+            if clmin > lmin:
+                pieces.append([lmin, clmin, low, high])
+            if clmax < lmax:
+                pieces.append([clmax, lmax, low, high])
+        boxes = pieces
+
+    return [box for box in boxes if box[1] - box[0] > TOLERANCE and box[3] - box[2] > TOLERANCE]
+
+def read_coverage(filename: str, catalog: str, **options) -> list:
+    """
+    Coverage recorded in an hdf5 file written by a finder
+
+    Args:
+        filename (str): Path of the hdf5 file
+        catalog (str): Catalog the file must contain ('gaia', '2mass' or 'gaia2mass')
+        **options: Options the file must have been written with (e.g. pi = 1)
+
+    Returns:
+        list: Boxes covered by the file, None if it does not contain the catalog with these options
+    """
+
+    try:
+        with h5py.File(filename, 'r') as f:
+            if not matches(f, catalog, **options) or 'coverage' not in f.attrs:
+                return None
+            return np.asarray(f.attrs['coverage'], dtype = np.float64).reshape(-1, 4).tolist()
+    except (OSError, KeyError):
+        return None
+
+def read_moc(filename: str, catalog: str = None, **options) -> MOC:
+    """
+    Coverage map recorded in an hdf5 file written by a finder from a MOC
+
+    Args:
+        filename (str): Path of the hdf5 file
+        catalog (str, optional): Catalog the file must contain ('gaia', '2mass' or 'gaia2mass'). Default to None (any catalog).
+        **options: Options the file must have been written with (e.g. pi = 1)
+
+    Returns:
+        MOC: Coverage delivered in the file, None if it has none or does not contain the catalog with these options
+    """
+
+    try:
+        with h5py.File(filename, 'r') as f:
+            if (catalog != None and not matches(f, catalog, **options)) or 'moc' not in f:
+                return None
+            return MOC.from_uniq(f['moc/uniq'][()])
+    except (OSError, KeyError):
+        return None
+
+def matches(group, catalog: str, **options) -> bool:
+    """
+    Whether an hdf5 file contains a catalog obtained with some options
+
+    Args:
+        group (h5py.Group): File written by a finder
+        catalog (str): Catalog the file must contain ('gaia', '2mass' or 'gaia2mass')
+        **options: Options the file must have been written with (e.g. pi = 1)
+
+    Returns:
+        bool: True if the catalog and the options of the file match
+    """
+
+    return group.attrs.get('catalog') == catalog and all(group.attrs.get(key) == value for key, value in options.items())
+
+def write_coverage(group, catalog: str, boxes: list, **options) -> None:
+    """
+    Record the catalog and the coverage of an hdf5 file, so that it can be grown later
+
+    Args:
+        group (h5py.Group): File in which the catalog is written
+        catalog (str): Catalog of the file ('gaia', '2mass' or 'gaia2mass')
+        boxes (list): Boxes covered by the file, as [lmin, lmax, bmin, bmax]
+        **options: Options the data were obtained with (e.g. pi = 1)
+    """
+
+    group.attrs['catalog'] = catalog
+    group.attrs['coverage'] = np.asarray(boxes, dtype = np.float64).reshape(-1, 4)
+    for key, value in options.items():
+        group.attrs[key] = value
+
+def write_moc(group, catalog: str, moc: MOC, **options) -> None:
+    """
+    Record the catalog and the coverage map delivered in an hdf5 file, as the NUNIQ indices of its cells (moc/uniq dataset)
+
+    Args:
+        group (h5py.Group): File in which the catalog is written
+        catalog (str): Catalog of the file ('gaia', '2mass' or 'gaia2mass')
+        moc (MOC): Coverage delivered in the file
+        **options: Options the data were obtained with (e.g. pi = 1)
+    """
+
+    group.attrs['catalog'] = catalog
+    for key, value in options.items():
+        group.attrs[key] = value
+    cells = group.create_group('moc')
+    cells.attrs['max_order'] = moc.max_order
+    cells.create_dataset('uniq', data = moc.uniq(), dtype = np.int64)
+
+def find_previous(path: str, catalog: str, boxes: list, **options) -> tuple[str, list]:
+    """
+    Find the local file of a catalog covering the largest part of some boxes
+
+    Args:
+        path (str): Directory in which the hdf5 files are searched
+        catalog (str): Catalog the file must contain ('gaia', '2mass' or 'gaia2mass')
+        boxes (list): Boxes to cover, as [lmin, lmax, bmin, bmax]
+        **options: Options the file must have been written with (e.g. pi = 1)
+
+    Returns:
+        tuple[str, list]: Path of the file and its coverage, (None, []) if no file overlaps the boxes
+    """
+
+    best, coverage, overlap = None, [], 0.
+    for filename in sorted(glob.glob(os.path.join(path, "*.hdf5"))):
+        covered = read_coverage(filename, catalog, **options)
+        if covered is None:
+            continue
+        common = area(boxes) - area(subtract_boxes(boxes, covered))
+        if common > overlap:
+            best, coverage, overlap = filename, covered, common
+
+    return best, coverage
+
+def find_previous_moc(path: str, catalog: str, moc: MOC, **options) -> tuple[str, MOC]:
+    """
+    Find the local file of a catalog whose coverage map has the largest intersection with a MOC
+
+    Args:
+        path (str): Directory in which the hdf5 files are searched
+        catalog (str): Catalog the file must contain ('gaia', '2mass' or 'gaia2mass')
+        moc (MOC): Coverage to get
+        **options: Options the file must have been written with (e.g. pi = 1)
+
+    Returns:
+        tuple[str, MOC]: Path of the file and its coverage map, (None, empty MOC) if no file intersects the MOC
+    """
+
+    best, coverage, overlap = None, MOC(), 0.
+    for filename in sorted(glob.glob(os.path.join(path, "*.hdf5"))):
+        covered = read_moc(filename, catalog, **options)
+        if covered is None:
+            continue
+        common = (moc & covered).area()
+        if common > overlap:
+            best, coverage, overlap = filename, covered, common
+
+    return best, coverage
+
+def read_previous(filename: str, datasets: dict) -> pd.DataFrame:
+    """
+    Read the sources of a file written by a finder, with the column names of the finder data
+
+    Args:
+        filename (str): Path of the hdf5 file
+        datasets (dict): Column of the data written in each dataset, as {dataset: column}
+
+    Returns:
+        pd.DataFrame: Sources of the file
+    """
+
+    data = Catalog(filename).read(columns = list(datasets))
+
+    return data.rename(columns = datasets)
+
+def merge_obs(previous: pd.DataFrame, data: pd.DataFrame, key: list) -> pd.DataFrame:
+    """
+    Merge the sources already downloaded with new ones, removing the sources found twice (on the edges of the boxes)
+
+    Args:
+        previous (pd.DataFrame): Sources already downloaded, None if there is none
+        data (pd.DataFrame): New sources, None if there is none
+        key (list): Columns identifying a source (e.g. ['source_id'])
+
+    Returns:
+        pd.DataFrame: Merged sources
+    """
+
+    parts = [part for part in (previous, data) if part is not None]
+
+    return pd.concat(parts, ignore_index = True).drop_duplicates(subset = key, ignore_index = True)
@@ -0,0 +1,575 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from .tracing import Tracer
+from .journal import JobJournal
+from .errors import ObsfinderError, QueryError, JobFailed, TransientNetworkError
+from .retry import RetryPolicy
+from .lazy import lazy_import
+from collections import OrderedDict
+import threading
+import importlib
+import argparse
+import pathlib
+import time
+import sys
+
+httplib = lazy_import("http.client")
+httpserver = lazy_import("http.server")
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+inspect = lazy_import("inspect")
+json = lazy_import("json")
+
+# Finders available through the daemon: module, class and methods that can be called
+FINDERS = {"gaia": ("findgaia", "Findgaia", ["get_obs"]),
+           "2mass": ("find2mass", "Find2mass", ["get_obs"]),
+           "gaia+2mass": ("findgaia2mass", "Findgaia2mass", ["get_obs"]),
+           "gaia_query": ("findgaia", "FindGaiaQuery", ["query_obs"]),
+           "simbad": ("findsimbad", "FindSimbad", ["get_obs", "get_obs_with_gaia"])}
+
+# Errors sent back to the clients, with their HTTP status
+ERRORS = {"QueryError": (QueryError, 400), "JobFailed": (JobFailed, 502), "TransientNetworkError": (TransientNetworkError, 503)}
+
+# Number of rows sent per line of the response
+CHUNK_ROWS = 10000
+
+# Arguments of the finders holding the path of a file or a directory, which must be in the root directory of the daemon
+PATH_ARGUMENTS = ["path", "gaia_data", "moc"]
+
+def _to_json(value):
+    """
+    Convert the numpy values left in the data to python values (used as json default). Missing values of the
+    nullable columns (pd.NA, pd.NaT) are sent as null.
+    """
+
+    if value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+class ResultCache():
+    """
+    This class keeps the results of the last queries in memory (least recently used first out),
+    each result expiring after a given time.
+    """
+
+    def __init__(self, max_entries: int = 128, ttl: float = 3600) -> None:
+        """
+        Initialize the class
+
+        Args:
+            max_entries (int, optional):
+                Maximum number of results kept. Default to 128.
+            ttl (float, optional):
+                Time after which a result expires (in second). Default to 3600.
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        """
+        Get a result
+
+        Args:
+            key (str): Key of the request
+
+        Returns:
+            Result of the request, None if it is not in the cache or has expired
+        """
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or time.time() - entry[0] > self.ttl:
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, value) -> None:
+        """
+        Add a result
+
+        Args:
+            key (str): Key of the request
+            value: Result of the request
+        """
+
+        if self.max_entries <= 0:
+            return
+
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last = False)
+
+    def stats(self) -> dict:
+        """
+        Statistics of the cache
+
+        Returns:
+            dict: Number of entries, hits and misses
+        """
+
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+class QueryDaemon():
+    """
+    This class runs a local HTTP server executing the queries of the finders on behalf of thin clients
+    (DaemonClient, or pyfinder with -daemon). All the queries share one warm engine: connections to the
+    archives kept open, parallax zero-point tables loaded once, and an in-memory cache of the results.
+
+    Requests are POST /query with a json body {"finder": ..., "init": {...}, "call": ..., "args": {...}},
+    where finder is one of FINDERS, init the arguments of its constructor and call the method to run
+    with the arguments args. The response is json lines: a header (columns, dtypes, metrics) followed
+    by the rows, sent by chunks as soon as they are written. GET /status returns the state of the daemon.
+
+    The daemon has no authentication: the finders only read and write files in its root directory, the requests
+    giving a path outside of it being rejected.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, proxy: tuple[str, int] = None, verbose: int = 0,
+                 cache_size: int = 128, cache_ttl: float = 3600, metrics_file: str = None, tracer: Tracer = None,
+                 journal: JobJournal = None, retry: RetryPolicy = None, root: str = None) -> None:
+        """
+        Initialize the class
+
+        Args:
+            host (str, optional):
+                Address the daemon listens on. Default to '127.0.0.1' (local connections only).
+            port (int, optional):
+                Port the daemon listens on. Default to 8765.
+            proxy (tuple[str, int], optional):
+                Proxy used for all the queries, if needed. Default to None.
+            verbose (int, optional):
+                Toggle verbose (1 or 0). Default to 0.
+            cache_size (int, optional):
+                Maximum number of results kept in memory. Default to 128, 0 disables the cache.
+            cache_ttl (float, optional):
+                Time after which a result kept in memory expires (in second). Default to 3600.
+            metrics_file (str, optional):
+                JSON-lines file to which the metrics of each query are appended. Default to None.
+            tracer (Tracer, optional):
+                Tracer in which each query is recorded. Default to None.
+            journal (JobJournal, optional):
+                Journal of the submitted jobs. Default to None.
+            retry (RetryPolicy, optional):
+                Policy used to retry the requests failing with a transient error. Default to RetryPolicy().
+            root (str, optional):
+                Directory in which the finders write their files and read the files given in the requests (path, name,
+                gaia_data, moc). Relative paths are taken from it, and paths outside of it are rejected. Default to the
+                working directory of the daemon.
+        """
+
+        self.host = host
+        self.port = port
+        self.proxy = proxy
+        self.verbose = verbose
+        self.cache = ResultCache(cache_size, cache_ttl)
+        self.metrics_file = metrics_file
+        self.tracer = tracer
+        self.journal = journal
+        self.retry = retry
+        self.root = pathlib.Path(root if root is not None else ".").resolve()
+        self.start = time.time()
+        self.requests = 0
+        self.server = None
+
+    def warm_up(self) -> None:
+        """
+        Import the dependencies and load the parallax zero-point tables before the first request
+        """
+
+        from .findgaia import load_zpt_tables
+        for module, _, _ in FINDERS.values():
+            importlib.import_module("." + module, __package__)
+        load_zpt_tables()
+
+    def key(self, request: dict) -> str:
+        """
+        Key of a request in the cache
+
+        Args:
+            request (dict): Request
+
+        Returns:
+            str: Key of the request
+        """
+
+        return json.dumps(request, sort_keys = True)
+
+    def resolve_path(self, path: str) -> str:
+        """
+        Absolute path of a file or a directory given in a request, which must be in the root directory
+
+        Args:
+            path (str): Path, relative to the root directory or absolute
+
+        Returns:
+            str: Absolute path
+        """
+
+        resolved = (self.root / path).resolve()
+        if resolved != self.root and self.root not in resolved.parents:
+            raise QueryError(f"Path {path} is outside of the root directory of the daemon ({self.root})")
+
+        return str(resolved)
+
+    def check_paths(self, init: dict) -> dict:
+        """
+        Check that the files read and written by a finder are in the root directory
+
+        Args:
+            init (dict): Arguments of the constructor of the finder
+
+        Returns:
+            dict: Arguments, with the paths made absolute (path set to the root directory if not given)
+        """
+
+        init = dict(init)
+        init["path"] = init.get("path") if init.get("path") is not None else str(self.root)
+        for argument in PATH_ARGUMENTS:
+            if isinstance(init.get(argument), str):
+                init[argument] = self.resolve_path(init[argument])
+        if init.get("name") is not None:
+            self.resolve_path(pathlib.Path(init["path"], str(init["name"])))
+
+        return init
+
+    def run_request(self, request: dict) -> tuple:
+        """
+        Run a request, or get its result from the cache
+
+        Args:
+            request (dict): Request (finder, init, call, args)
+
+        Returns:
+            tuple: Data (pd.DataFrame, None if the data have been saved by the finder), metrics (dict) and whether the result comes from the cache
+        """
+
+        if request.get("finder") not in FINDERS:
+            raise QueryError(f"Unknown finder: {request.get('finder')}")
+        module, name, methods = FINDERS[request["finder"]]
+        call = request.get("call", methods[0])
+        if call not in methods:
+            raise QueryError(f"Method {call} is not available for the finder {request['finder']}")
+
+        init = self.check_paths(request.get("init", {}))
+        args = request.get("args", {})
+        returns_data = call == "query_obs" or args.get("return_data", False)
+
+        key = self.key(request)
+        if returns_data:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached[0], cached[1], True
+
+        finder_class = getattr(importlib.import_module("." + module, __package__), name)
+        shared = {"proxy": self.proxy, "verbose": self.verbose, "metrics_file": self.metrics_file,
+                  "tracer": self.tracer, "journal": self.journal, "retry": self.retry}
+        try:
+            inspect.signature(finder_class).bind(**init, **shared)
+            inspect.signature(getattr(finder_class, call)).bind(None, **args)
+        except TypeError as error:
+            raise QueryError(f"Invalid arguments: {error}") from error
+
+        finder = finder_class(**init, **shared)
+        data = getattr(finder, call)(**args)
+
+        metrics = finder.metrics.as_dict()
+        if returns_data:
+            self.cache.put(key, (data, metrics))
+
+        return data, metrics, False
+
+    def status(self) -> dict:
+        """
+        State of the daemon
+
+        Returns:
+            dict: Uptime, number of requests and statistics of the cache
+        """
+
+        return {"uptime": time.time() - self.start, "requests": self.requests, "cache": self.cache.stats()}
+
+    def serve_forever(self) -> None:
+        """
+        Start the daemon, until it is interrupted
+        """
+
+        daemon = self
+
+        class Handler(httpserver.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                if daemon.verbose:
+                    super().log_message(format, *args)
+
+            def send_json(self, status, content):
+                body = json.dumps(content).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_chunk(self, line):
+                data = (line + "\n").encode('utf-8')
+                self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+
+            def do_GET(self):
+                if self.path == "/status":
+                    self.send_json(200, daemon.status())
+                else:
+                    self.send_json(404, {"error": "NotFound", "message": self.path})
+
+            def do_POST(self):
+                if self.path != "/query":
+                    self.send_json(404, {"error": "NotFound", "message": self.path})
+                    return
+
+                daemon.requests += 1
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    data, metrics, cached = daemon.run_request(request)
+                except json.JSONDecodeError as error:
+                    self.send_json(400, {"error": "QueryError", "message": f"Invalid request: {error}"})
+                    return
+                except ObsfinderError as error:
+                    status = ERRORS.get(error.__class__.__name__, (None, 500))[1]
+                    self.send_json(status, {"error": error.__class__.__name__, "message": str(error)})
+                    return
+                except Exception as error:
+                    self.send_json(500, {"error": error.__class__.__name__, "message": str(error)})
+                    return
+
+                header = {"metrics": metrics, "cached": cached}
+                if data is not None:
+                    header.update({"columns": [str(column) for column in data.columns], "rows": len(data),
+                                   "dtypes": {str(column): str(dtype) for column, dtype in data.dtypes.items()}})
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                self.send_chunk(json.dumps(header, default = _to_json))
+                if data is not None:
+                    for start in range(0, len(data), CHUNK_ROWS):
+                        part = data.iloc[start:start + CHUNK_ROWS]
+                        rows = list(zip(*[part[column].tolist() for column in data.columns]))
+                        self.send_chunk(json.dumps(rows, default = _to_json))
+                self.wfile.write(b"0\r\n\r\n")
+
+        self.warm_up()
+        self.server = httpserver.ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        if self.verbose:
+            print(f"Daemon listening on http://{self.host}:{self.server.server_address[1]}")
+
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+
+    def shutdown(self) -> None:
+        """
+        Stop the daemon started by serve_forever (from another thread)
+        """
+
+        if self.server is not None:
+            self.server.shutdown()
+
+class DaemonClient():
+    """
+    This class sends queries to a QueryDaemon. It keeps its connection to the daemon open between queries.
+    A client must not be shared by several threads.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 8765, timeout: float = None) -> None:
+        """
+        Initialize the class
+
+        Args:
+            host (str, optional):
+                Address of the daemon. Default to '127.0.0.1'.
+            port (int, optional):
+                Port of the daemon. Default to 8765.
+            timeout (float, optional):
+                Timeout of the connection to the daemon (in second). Default to None (no timeout).
+        """
+
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connection = None
+        self.metrics = None
+
+    def request(self, method: str, path: str, body: bytes = None):
+        """
+        Send a request to the daemon, opening the connection if needed
+
+        Returns:
+            httplib.HTTPResponse: Response of the daemon (not read)
+        """
+
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = httplib.HTTPConnection(self.host, self.port, timeout = self.timeout)
+            try:
+                self.connection.request(method, path, body, {"Content-Type": "application/json"} if body is not None else {})
+                return self.connection.getresponse()
+            except (OSError, httplib.HTTPException) as error:
+                self.close()
+                if attempt == 1:
+                    raise TransientNetworkError(f"Daemon {self.host}:{self.port} unreachable: {error!r}") from error
+
+    def close(self) -> None:
+        """
+        Close the connection to the daemon
+        """
+
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def status(self) -> dict:
+        """
+        Get the state of the daemon
+
+        Returns:
+            dict: Uptime, number of requests and statistics of the cache
+        """
+
+        return json.loads(self.request("GET", "/status").read())
+
+    def query(self, finder: str, init: dict = None, call: str = None, args: dict = None) -> pd.DataFrame:
+        """
+        Run the method of a finder on the daemon
+
+        Args:
+            finder (str): Finder to use ('gaia', '2mass', 'gaia+2mass', 'gaia_query' or 'simbad')
+            init (dict, optional): Arguments of the constructor of the finder. Default to None.
+            call (str, optional): Method to call. Default to the main method of the finder.
+            args (dict, optional): Arguments of the method. Default to None.
+
+        Returns:
+            pd.DataFrame: Data returned by the method, None if the data have been saved by the daemon.
+            The metrics of the query are stored in self.metrics, and in data.attrs['metrics'].
+        """
+
+        request = {"finder": finder, "init": init if init is not None else {}, "args": args if args is not None else {}}
+        if call is not None:
+            request["call"] = call
+
+        response = self.request("POST", "/query", json.dumps(request).encode('utf-8'))
+
+        if response.status != 200:
+            error = json.loads(response.read())
+            error_class = ERRORS.get(error["error"], (ObsfinderError, 500))[0]
+            if error_class is JobFailed:
+                raise JobFailed("?", "ERROR", error["message"])
+            raise error_class(error["message"])
+
+        header = json.loads(response.readline())
+        self.metrics = header["metrics"]
+        if "columns" not in header:
+            response.read()
+            return None
+
+        rows = []
+        for line in response:
+            rows.extend(json.loads(line))
+
+        data = pd.DataFrame(rows, columns = header["columns"])
+        for column, dtype in header["dtypes"].items():
+            if dtype != "object" and str(data[column].dtype) != dtype:
+                data[column] = data[column].astype(dtype)
+        data.attrs['metrics'] = self.metrics
+
+        return data
+
+    def get_obs(self, type: str, lvalue: float, bvalue: float, psize: float = 5, path: str = None, name: str = None, pi: int = 1,
+                return_data: bool = True) -> pd.DataFrame:
+        """
+        Get the observations of a pixel, as Finder.get_obs
+
+        Args:
+            type (str): Type of query ('gaia', '2mass' or 'gaia+2mass')
+            lvalue (float): Longitude of the center of the pixel (in degree)
+            bvalue (float): Latitude of the center of the pixel (in degree)
+            psize (float, optional): Size of the pixel (in arcmin). Default to 5.
+            path (str, optional): Directory in which the daemon saves the file, if return_data is False. Default to None.
+            name (str, optional): Name of the file. Default to None (default name).
+            pi (int, optional): Add the PI in the query (gaia only). Default to 1.
+            return_data (bool, optional): Return the data instead of saving them. Default to True.
+
+        Returns:
+            pd.DataFrame: Observations of the pixel, None if return_data is False
+        """
+
+        if path is None and not return_data:
+            path = str(pathlib.Path().resolve())
+
+        init = {"lvalue": lvalue, "bvalue": bvalue, "psize": psize, "path": path, "name": name}
+        if type != '2mass':
+            init["pi"] = pi
+
+        return self.query(type, init, "get_obs", {"return_data": return_data})
+
+def main() -> int:
+    """
+    Main function used when the script is called from a command line
+    """
+
+    parser = argparse.ArgumentParser(description = "Run a local daemon executing the queries of the obsfinder tools")
+    parser.add_argument('-host', type = str, required = False, help = "Address the daemon listens on", default = "127.0.0.1")
+    parser.add_argument('-port', type = int, required = False, help = "Port the daemon listens on", default = 8765)
+    parser.add_argument('-cache', type = int, required = False, help = "Maximum number of results kept in memory", default = 128)
+    parser.add_argument('-ttl', type = float, required = False, help = "Time after which a result kept in memory expires (in second)", default = 3600)
+    parser.add_argument('-v', type = int, required = False, help = "Verbose", default = 0)
+    parser.add_argument('-proxy', type = str, required = False, help = "Proxy to use, if needed. Format: 'adresse:port'", default = None)
+    parser.add_argument('-metrics', type = str, required = False, help = "JSON-lines file to append the metrics of each query to", default = None)
+    parser.add_argument('-trace', type = str, required = False, help = "File to write the trace of the queries to, written when the daemon stops", default = None)
+    parser.add_argument('-journal', type = str, required = False, help = "Journal file of the submitted jobs", default = None)
+    parser.add_argument('-retries', type = int, required = False, help = "Maximum number of attempts of a request failing with a transient error", default = 5)
+    parser.add_argument('-root', type = str, required = False, help = "Directory the queries can write files to, default to the working directory", default = None)
+
+    args = parser.parse_args()
+
+    if args.proxy != None:
+        proxy = (args.proxy.split(':')[0], int(args.proxy.split(':')[1]))
+    else:
+        proxy = None
+
+    tracer = Tracer(args.trace) if args.trace != None else None
+    journal = JobJournal(args.journal, verbose = args.v) if args.journal != None else None
+
+    daemon = QueryDaemon(args.host, args.port, proxy = proxy, verbose = args.v, cache_size = args.cache, cache_ttl = args.ttl,
+                         metrics_file = args.metrics, tracer = tracer, journal = journal,
+                         retry = RetryPolicy(max_attempts = args.retries, verbose = args.v), root = args.root)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if tracer != None:
+            tracer.write()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
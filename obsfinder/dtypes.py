@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from .lazy import lazy_import
+
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+
+# Identifiers that do not fit in a float
+INTEGERS = ['source_id']
+
+# Flags stored as small integers in compact mode
+FLAGS = {'astrometric_params_solved': 'int8'}
+
+# Coordinates kept as float64 in compact mode: they feed the grid index, the deduplication by position
+# and the cross-match radius, and float32 is only good to about 0.1 arcsec on the longitudes
+COORDINATES = ['l', 'b', 'ra', 'dec', 'glon', 'glat']
+
+def column_dtype(column: str, compact: bool = False):
+    """
+    Type in which a numeric column of the finders is held and written
+
+    Args:
+        column (str): Name of the column
+        compact (bool, optional): Compact mode: float32 for the magnitudes, errors and parallaxes (about 7 significant digits),
+            small integers for the flags, the coordinates staying float64. Default to False (float64).
+
+    Returns:
+        numpy.dtype: Type of the column
+    """
+
+    if column in INTEGERS:
+        return np.dtype(np.int64)
+    if compact and column in FLAGS:
+        return np.dtype(FLAGS[column])
+    if column in COORDINATES:
+        return np.dtype(np.float64)
+
+    return np.dtype(np.float32 if compact else np.float64)
+
+def cast_columns(data: pd.DataFrame, columns: list = None, compact: bool = False) -> pd.DataFrame:
+    """
+    Cast the numeric columns of query results to their type (see column_dtype). Flags having empty values are cast to floats.
+
+    Args:
+        data (pd.DataFrame): Results of a query
+        columns (list, optional): Columns to cast, the ones missing from the data are ignored. Default to None (all the columns).
+        compact (bool, optional): Compact mode (see column_dtype). Default to False.
+
+    Returns:
+        pd.DataFrame: Data with the columns cast
+    """
+
+    columns = data.columns if columns is None else [column for column in columns if column in data.columns]
+
+    dtypes = {}
+    for column in columns:
+        dtype = column_dtype(column, compact)
+        if dtype.kind == 'i' and column not in INTEGERS and data[column].isna().any():
+            dtype = column_dtype('', compact)
+        dtypes[column] = dtype
+
+    return data.astype(dtypes)
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+class ObsfinderError(Exception):
+    """
+    Base class of the errors raised by obsfinder
+    """
+
+class QueryError(ObsfinderError, ValueError):
+    """
+    The query is invalid (wrong zone definition, query rejected by the server, ...). Retrying will not help.
+    """
+
+class JobFailed(ObsfinderError):
+    """
+    The job ended in the ERROR or ABORTED phase, or disappeared from the server.
+    """
+
+    def __init__(self, jobid: str, phase: str, message: str = "") -> None:
+        """
+        Initialize the class
+
+        Args:
+            jobid (str): Job id
+            phase (str): Last phase of the job
+            message (str, optional): Error message returned by the server. Default to "".
+        """
+
+        self.jobid = jobid
+        self.phase = phase
+        self.message = message
+        super().__init__(f"Job {jobid} failed (phase: {phase}){': ' + message if message else ''}")
+
+class TransientNetworkError(ObsfinderError):
+    """
+    Temporary failure while talking to the server (connection error, 5xx status, missing job location, ...).
+    The request can be retried.
+    """
+
+    def __init__(self, message: str, sent: bool = True) -> None:
+        """
+        Initialize the class
+
+        Args:
+            message (str): Description of the failure
+            sent (bool, optional): Whether the request may have reached the server. False if the connection could not
+                be opened, so that a request creating a job can be sent again safely. Default to True.
+        """
+
+        self.sent = sent
+        super().__init__(message)
@@ -1,23 +1,37 @@
 #!/usr/bin/env python3
 
-from xml.dom.minidom import parseString
-import http.client as httplib
-import urllib.parse as urllib
-import pandas as pd
-import numpy as np
+from __future__ import annotations
+from .metrics import QueryMetrics
+from .tap import TapService
+from .tracing import Tracer
+from .journal import JobJournal
+from .errors import ObsfinderError, QueryError
+from .retry import RetryPolicy
+from .catalog import write_index
+from .dtypes import column_dtype, cast_columns
+from .coverage import pixel_boxes, subtract_boxes, find_previous, find_previous_moc, read_previous, merge_obs, write_coverage, write_moc
+from .moc import MOC, box_conditions
+from .lazy import lazy_import
 import argparse
 import pathlib
-import h5py
-import time
-import csv
 import sys
 
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+h5py = lazy_import("h5py")
+
+# Column of the data written in each dataset of the hdf5 file of Find2mass
+DATASETS = {'J': 'j_m', 'J_err': 'j_msigcom', 'H': 'h_m', 'H_err': 'h_msigcom', 'K': 'k_m', 'K_err': 'k_msigcom', 'l': 'glon', 'b': 'glat'}
+
 class Find2mass():
     """
     This class contains tools to query caltech server and retreive 2mass data.
     """
     
-    def __init__(self, lvalue: float, bvalue: float, psize: float, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None) -> None:
+    def __init__(self, lvalue: float, bvalue: float, psize: float, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None,
+                metrics_file: str = None, metrics_callback = None, tracer = None, journal = None,
+                keep_results: bool = False, retry: RetryPolicy = None, grow: bool = False, moc = None, compact: bool = False,
+                condition: str = "") -> None:
         """
         Initialize the class
 
@@ -36,6 +50,30 @@ class Find2mass():
                 Toggle verbose (1 or 0). Default to 0.
             name (str, optional):
                 Name of the catalog. Default name is 'observations_2mass_{bvalue}_{lvalue}_{psize}'
+            metrics_file (str, optional):
+                JSON-lines file to which the metrics of each call to get_obs are appended. Default to None.
+            metrics_callback (callable, optional):
+                Function called with the QueryMetrics of each call to get_obs. Default to None.
+            tracer (Tracer, optional):
+                Tracer in which the pixel and each phase of the query are recorded as spans. Default to None.
+            journal (JobJournal, optional):
+                Journal of the submitted jobs, used to reuse the jobs of a previous run that stopped mid-way. Default to None.
+            keep_results (bool, optional):
+                Keep the jobs on the server once their results are downloaded. Default to False, jobs are deleted.
+            retry (RetryPolicy, optional):
+                Policy used to retry the requests failing with a transient error (5xx status, connection lost, ...). Default to RetryPolicy().
+            grow (bool, optional):
+                Reuse the hdf5 file of the working directory covering the largest part of the pixel (see previous_obs): only the part of
+                the pixel it does not cover is downloaded, and the output file holds the sources of both. Default to False.
+            moc (MOC or str, optional):
+                Coverage map (or path of a FITS or JSON MOC file) to get instead of the pixel (see query_moc). With grow, the file of the
+                working directory whose coverage map has the largest intersection with it is reused. Default to None.
+            compact (bool, optional):
+                Hold and write the magnitudes and errors as float32 (see dtypes.column_dtype), the coordinates staying float64,
+                which roughly halves the memory and the size of the output file. Default to False (float64).
+            condition (str, optional):
+                Additional ADQL condition on the sources of fp_psc, e.g. "ext_key IS NULL" to only keep the point sources
+                that are not part of an extended source. Default to "".
         """
 
         self.host = "irsa.ipac.caltech.edu"
@@ -51,11 +89,26 @@ class Find2mass():
         self.proxy = proxy
         self.verbose = verbose
         self.filename = name
+        self.metrics_file = metrics_file
+        self.metrics_callback = metrics_callback
+        self.tracer = tracer
+        self.journal = journal
+        self.keep_results = keep_results
+        self.retry = retry
+        self.grow = grow
+        self.moc = MOC.read(moc) if isinstance(moc, str) else moc
+        self.compact = compact
+        self.condition = condition
+        self.coverage = None
+        self.delivered = None
+        self.metrics = QueryMetrics('2mass', tracer = tracer, lvalue = lvalue, bvalue = bvalue, psize = psize)
+        self.tap = TapService(self.host, self.port, self.pathinfo, proxy = proxy, verbose = verbose, journal = journal, keep_results = keep_results, retry = retry,
+                              params = {"FORMAT": "csv", "PHASE": "RUN"}, submit_suffix = "?")
 
         if self.path == None:
             self.path = str(pathlib.Path().resolve())
 
-    def query_obs(self, lmin: float, lmax: float) -> pd.DataFrame:
+    def query_obs(self, lmin: float, lmax: float, bmin: float = None, bmax: float = None) -> pd.DataFrame:
         """
         Make a query to caltech server to retreive 2mas J, H an K bands,
         their uncertainty, as well as the longitude and lattitude of each
@@ -68,104 +121,61 @@ class Find2mass():
                 Lowest value in longitude (in degree)
             lmax (float):
                 Highest value in longitude (in degree)
+            bmin (float, optional):
+                Lowest value in latitude (in degree). Default to the bottom of the pixel.
+            bmax (float, optional):
+                Highest value in latitude (in degree). Default to the top of the pixel.
 
         Returns:
             pd.DataFrame: Dataframe containing the data
         """
 
+        bmin = bmin if bmin != None else self.bvalue - self.psize/2
+        bmax = bmax if bmax != None else self.bvalue + self.psize/2
         zone = f"glon BETWEEN {lmin} AND {lmax} \
-                 AND glat BETWEEN {self.bvalue - self.psize/2} AND {self.bvalue + self.psize/2}"
-            
-        query = self.query + zone
-
-        # Encode the query
-        params = urllib.urlencode({
-        "QUERY":   f"{query}", \
-        "FORMAT":  "csv", \
-        "PHASE":  "RUN", \
-        })
-
-        # Use proxy if needed
-        if self.proxy != None:
-            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-            connection.set_tunnel(self.host, self.port)
-        else:
-            connection=httplib.HTTPSConnection(self.host, self.port)
+                 AND glat BETWEEN {bmin} AND {bmax}"
 
-        # Send the query
-        connection.request("POST", self.pathinfo + "?", params)
+        return self.query_zone(zone)
 
-        #Status
-        response = connection.getresponse()
+    def query_moc(self, moc: MOC) -> pd.DataFrame:
+        """
+        Make a query to caltech server to retreive the sources of a coverage map. The 2MASS table has no
+        HEALPix index, the sources are selected by boxes of equatorial coordinates enclosing the cells of
+        the coverage (see moc.box_conditions), then the ones outside of the coverage are removed.
 
-        if self.verbose:
-            print ("Status: " +str(response.status), "Reason: " + str(response.reason))
+        Args:
+            moc (MOC):
+                Coverage map of the sources
 
-        #Server job location (URL)
-        location = response.getheader("location")
-        if self.verbose:
-            print ("Location: " + location)
+        Returns:
+            pd.DataFrame: Dataframe containing the data
+        """
 
-        #Jobid
-        jobid = location[location.rfind('/')+1:]
-        if self.verbose:
-            print ("Job id: " + jobid)
+        conditions = box_conditions(moc, "ra", "dec")
+        self.metrics.count('moc_queries', len(conditions))
 
-        connection.close()
+        data = pd.concat([self.query_zone(condition) for condition in conditions], ignore_index=True)
 
+        return data[moc.contains(data['glon'], data['glat'], frame = 'galactic')]
 
-        # Check job status, wait until finished
-        while True:
-            # Use proxy if needed
-            if self.proxy != None:
-                connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-                connection.set_tunnel(self.host, self.port)
-            else:
-                connection=httplib.HTTPSConnection(self.host, self.port)
-
-            connection.request("GET", self.pathinfo + "/" + jobid)
-            response = connection.getresponse()
-            data = response.read()
-            dom = parseString(data)
-            phaseElement = dom.getElementsByTagName('uws:phase')[0]
-            phaseValueElement = phaseElement.firstChild
-            phase = phaseValueElement.toxml()
-            if self.verbose:
-                print ("Status: " + phase)
-            #Check finished
-            if phase == 'COMPLETED': break
-
-            if phase == 'ERROR':
-                print("Critical failure: Error during the query")
-                exit()
-
-            #wait and repeat
-            time.sleep(0.2)
-
-        connection.close()
-
-        # Get results
-        if self.verbose:
-            print("Retrieving data...")
+    def query_zone(self, zone: str) -> pd.DataFrame:
+        """
+        Make a query to caltech server to retreive the sources of a zone
 
-        # Use proxy if needed
-        if self.proxy != None:
-            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-            connection.set_tunnel(self.host, self.port)
-        else:
-            connection=httplib.HTTPSConnection(self.host, self.port)
+        Args:
+            zone (str):
+                ADQL condition selecting the sources
 
-        connection.request("GET", self.pathinfo + "/" + jobid + "/results/result")
-        response = connection.getresponse()
+        Returns:
+            pd.DataFrame: Dataframe containing the data
+        """
+
+        query = self.query + (f"({zone}) AND {self.condition}" if self.condition != "" else zone)
 
-        data = response.read().decode('iso-8859-1')
-        data = data.split()
-        data = list((csv.reader(data, delimiter=',')))
-        data = pd.DataFrame(data[1:], columns = data[0])
-        data = data.replace(r'^\s*$', np.nan, regex=True)
-        data = data.astype(float)
+        data = self.tap.run(query, self.metrics)
 
-        connection.close()
+        with self.metrics.timer('parse'):
+            data = cast_columns(data, compact = self.compact)
 
         return data
     
@@ -196,16 +206,20 @@ class Find2mass():
             data (pd.DataFrame): Data to save
         """
 
-        if self.filename == None:
+        if self.filename == None and self.moc is not None:
+            # Name of the output file, identified by its coverage map
+            self.filename = f"{self.path}/observations_2mass_moc_{self.moc.digest()}.hdf5"
+        elif self.filename == None:
             # Name of the output file
             self.filename = f"{self.path}/observations_2mass_{self.bvalue:.6f}_{self.lvalue:.6f}_{self.psize:.6f}.hdf5"
         else:
             self.filename = f"{self.path}/{self.filename}"
 
-        if self.filename.split('.')[-1] == 'hdf5':
-            self.write_hdf5(data)
-        else:
-            np.savetxt(self.filename, data, header="J,J_err,H,H_err,K,K_err,l,b", delimiter=',', comments='')
+        with self.metrics.timer('write', rows = len(data)):
+            if self.filename.split('.')[-1] == 'hdf5':
+                self.write_hdf5(data)
+            else:
+                np.savetxt(self.filename, data, header="J,J_err,H,H_err,K,K_err,l,b", delimiter=',', comments='')
 
         if self.verbose:
             print('Done!')
@@ -221,49 +235,123 @@ class Find2mass():
             return_data (bool): Whether to return the data or save it directly. Default is False
 
         Returns:
-            pd.DataFrame: DataFrame with one row per object. Columns with multiple values are stored as lists. Only returned if return_data is True
+            pd.DataFrame: DataFrame with one row per object. Columns with multiple values are stored as lists. Only returned if return_data is True.
+                          The metrics of the query are available in its attrs['metrics'].
         """
 
-        # If longitude zone definition contains negative and positive longitudes
-        if self.lvalue - self.psize/2 < 0 and self.lvalue + self.psize/2 > 0:
-            if self.verbose:
-                print("Query split in two parts")
+        self.metrics = QueryMetrics('2mass', tracer = self.tracer, lvalue = self.lvalue, bvalue = self.bvalue, psize = self.psize * 60)
 
-            data_part1 = self.query_obs(360 + self.lvalue - self.psize/2, 360)
-            data_part2 = self.query_obs(0, self.lvalue + self.psize/2)
+        with self.metrics.span('pixel', catalog = '2mass', lvalue = self.lvalue, bvalue = self.bvalue, psize = self.psize * 60):
+            # Sources of the coverage map, minus the part already downloaded
+            if self.moc is not None:
+                previous, delivered = self.previous_obs(moc = self.moc) if self.grow else (None, MOC())
+                missing = self.moc - delivered
+                data = self.query_moc(missing) if not missing.is_empty() else None
+                self.delivered = delivered | self.moc
 
-            data = pd.concat([data_part1, data_part2], ignore_index=True)
-        
-        # If longitude zone definition is entirely inferior to 0
-        elif self.lvalue - self.psize/2 < 0 and self.lvalue + self.psize/2 <= 0:
-            if self.verbose:
-                print("Negative longitude range, aborting")
-                exit()
+            # If longitude zone definition is entirely inferior to 0
+            elif self.lvalue - self.psize/2 < 0 and self.lvalue + self.psize/2 <= 0:
+                raise QueryError(f"Negative longitude range ({self.lvalue - self.psize/2} to {self.lvalue + self.psize/2}), longitudes must be in [0, 360]")
+
+            # Zone split in two parts if it contains negative and positive longitudes, minus the part already downloaded
+            else:
+                boxes = pixel_boxes(self.lvalue, self.bvalue, self.psize)
+                previous, coverage = self.previous_obs(boxes) if self.grow else (None, [])
+                missing = subtract_boxes(boxes, coverage)
+                self.metrics.count('boxes', len(missing))
+
+                if self.verbose and len(missing) > 1:
+                    print(f"Query split in {len(missing)} parts")
+
+                data = pd.concat([self.query_obs(*box) for box in missing], ignore_index=True) if len(missing) > 0 else None
+                self.coverage = coverage + missing
+
+            if data is not None:
+                # Clean observations
+                with self.metrics.timer('clean', rows_before = len(data)) as span:
+                    data = self.clean_obs(data)
+                    span['rows_after'] = len(data)
+                self.metrics.count('rows_clean', len(data))
+
+            if previous is not None:
+                # 2MASS sources have no identifier in the output file, the ones on the edges are found by their position
+                data = merge_obs(previous, data, ['glon', 'glat'])
+
+            if return_data:
+                self.metrics.finish(self.metrics_callback, self.metrics_file)
+                data.attrs['metrics'] = self.metrics.as_dict()
+                return data
+            else:
+                # Save observations
+                self.save_obs(data)
+                self.metrics.finish(self.metrics_callback, self.metrics_file)
         
+    def write_hdf5(self, data: pd.DataFrame) -> None:
+        with h5py.File(self.filename, 'w') as f:
+            self.write_datasets(f, data)
+            if self.coverage != None:
+                write_coverage(f, '2mass', self.coverage, **self.options())
+            if self.delivered is not None:
+                write_moc(f, '2mass', self.delivered, **self.options())
 
-        # If zone definition is in the range [0, 360]
-        else:
-            data = self.query_obs(self.lvalue - self.psize/2, self.lvalue + self.psize/2)
+    def options(self) -> dict:
+        """
+        Options recorded in the output file, that a file must have been written with to be reused by previous_obs
+
+        Returns:
+            dict: Compact mode and additional condition if set
+        """
+
+        options = dict(compact = 1) if self.compact else dict()
+        if self.condition != "":
+            options['condition'] = self.condition
+
+        return options
 
-        # Clean observations
-        data = self.clean_obs(data)
+    def write_datasets(self, group, data: pd.DataFrame) -> None:
+        """
+        Write the columns of the output file as datasets of an hdf5 file or group
+
+        Args:
+            group (h5py.Group): File or group in which the datasets are created
+            data (pd.DataFrame): Data to write (sorted by cell of the grid index before being written)
+        """
 
-        if return_data:
-            return data
+        order = write_index(group, data['glon'], data['glat'])
+        data = data.iloc[order]
+
+        for dataset, column in DATASETS.items():
+            group.create_dataset(dataset, data = data[column], dtype = column_dtype(column, self.compact))
+
+    def previous_obs(self, boxes: list = None, moc: MOC = None) -> tuple[pd.DataFrame, list]:
+        """
+        Find the hdf5 file of the working directory covering the largest part of the pixel, or of the coverage map, among the
+        files written by Find2mass (see coverage.find_previous and find_previous_moc), and read its sources
+
+        Args:
+            boxes (list, optional): Boxes covered by the pixel (see coverage.pixel_boxes). Default to None.
+            moc (MOC, optional): Coverage map, used instead of the boxes. Default to None.
+
+        Returns:
+            tuple[pd.DataFrame, list]: Sources of the file (None if there is none), and boxes (or MOC) covered by the file
+        """
+
+        if moc is not None:
+            filename, coverage = find_previous_moc(self.path, '2mass', moc, **self.options())
         else:
-            # Save observations
-            self.save_obs(data)
-        
-    def write_hdf5(self, data: pd.DataFrame) -> None:
-        with h5py.File(self.filename, 'w') as f:
-            f.create_dataset('J', data = data['j_m'], dtype = float)
-            f.create_dataset('J_err', data = data['j_msigcom'], dtype = float)
-            f.create_dataset('H', data = data['h_m'], dtype = float)
-            f.create_dataset('H_err', data = data['h_msigcom'], dtype = float)
-            f.create_dataset('K', data = data['k_m'], dtype = float)
-            f.create_dataset('K_err', data = data['k_msigcom'])
-            f.create_dataset('l', data = data['glon'], dtype = float)
-            f.create_dataset('b', data = data['glat'], dtype = float)
+            filename, coverage = find_previous(self.path, '2mass', boxes, **self.options())
+        if filename == None:
+            return None, coverage
+
+        with self.metrics.timer('reuse', filename = filename) as span:
+            data = read_previous(filename, DATASETS)
+            span['rows'] = len(data)
+        self.metrics.count('rows_reused', len(data))
+
+        if self.verbose:
+            print(f"Reusing the {len(data)} sources of {filename}")
+
+        return data, coverage
 
 def main() -> int:
     """
@@ -271,16 +359,26 @@ def main() -> int:
     """
     # Arguments definition
     parser = argparse.ArgumentParser()
-    parser.add_argument('-l', type = float, required = True, help = "Square center value in Galactic longitude (deg)")
-    parser.add_argument('-b', type = float, required = True, help = "Square center value in Galactic latitude (deg)")
+    parser.add_argument('-l', type = float, required = False, help = "Square center value in Galactic longitude (deg). Required if -moc is not used", default = None)
+    parser.add_argument('-b', type = float, required = False, help = "Square center value in Galactic latitude (deg). Required if -moc is not used", default = None)
     parser.add_argument('-p', type = float, required = False, help = "Pixel size (arcminute)", default = 5)
     parser.add_argument('-v', type = int, required = False, help = "Verbose", default = 0)
     parser.add_argument('-d', type = str, required = False, help = "Working directory", default = None)
     parser.add_argument('-n', type = str, required = False, help = "Name of the output file", default = None)
     parser.add_argument('-proxy', type = str, required = False, help = "Proxy to use host:port", default = None)
+    parser.add_argument('-metrics', type = str, required = False, help = "JSON-lines file to which the query metrics are appended", default = None)
+    parser.add_argument('-trace', type = str, required = False, help = "File in which the Chrome trace-event JSON of the query is written", default = None)
+    parser.add_argument('-journal', type = str, required = False, help = "Journal of the submitted jobs, used to resume a run that stopped mid-way", default = None)
+    parser.add_argument('-keep', type = int, required = False, help = "Keep the jobs on the server once their results are downloaded", default = 0)
+    parser.add_argument('-retries', type = int, required = False, help = "Maximum number of attempts of a request failing with a transient error", default = 5)
+    parser.add_argument('-moc', type = str, required = False, help = "FITS or JSON MOC file of the coverage to get instead of a pixel", default = None)
+    parser.add_argument('-grow', type = int, required = False, help = "Only download the part of the pixel not covered by the hdf5 files of the working directory, and merge it with their sources", default = 0)
+    parser.add_argument('-compact', type = int, required = False, help = "Hold and write the magnitudes and errors as float32", default = 0)
 
     # Get arguments value
     args = parser.parse_args()
+    if args.moc == None and (args.l == None or args.b == None):
+        parser.error("-l and -b are required if -moc is not used")
     long = args.l
     latt = args.b
     psize = args.p
@@ -293,8 +391,20 @@ def main() -> int:
     else:
         proxy = None
 
-    ftmass = Find2mass(lvalue = long, bvalue = latt, path = path, psize = psize, proxy = proxy, verbose = verbose, name = name)
-    ftmass.get_obs()
+    tracer = Tracer(args.trace) if args.trace != None else None
+    journal = JobJournal(args.journal, verbose = args.v) if args.journal != None else None
+
+    ftmass = Find2mass(lvalue = long, bvalue = latt, path = path, psize = psize, proxy = proxy, verbose = verbose, name = name, metrics_file = args.metrics, tracer = tracer, journal = journal, keep_results = args.keep,
+                        retry = RetryPolicy(max_attempts = args.retries, verbose = verbose), grow = args.grow, moc = args.moc,
+                        compact = args.compact)
+    try:
+        ftmass.get_obs()
+    except ObsfinderError as error:
+        print(f"Error: {error}")
+        return 1
+    finally:
+        if tracer != None:
+            tracer.write()
 
     return 0
 
@@ -3,9 +3,19 @@
 from .findgaia import Findgaia
 from .find2mass import Find2mass
 from .findgaia2mass import Findgaia2mass
+from .tracing import Tracer
+from .journal import JobJournal
+from .retry import RetryPolicy
+from .metrics import QueryMetrics
+from .errors import ObsfinderError
+from .daemon import DaemonClient
+from .lazy import lazy_import
 import argparse
 import sys
 
+futures = lazy_import("concurrent.futures")
+h5py = lazy_import("h5py")
+
 class Finder():
     """
     This class contains tools to query the Gaia archive and retreive data from Gaia DR3.
@@ -13,13 +23,16 @@ class Finder():
     def __init__(self):
         pass
     
-    def get_obs(self, type: str, lvalue: float, bvalue: float, psize: float, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None, pi: int = 1) -> None:
+    def get_obs(self, type: str, lvalue: float, bvalue: float, psize: float, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None, pi: int = 1,
+                metrics_file: str = None, metrics_callback = None, tracer: Tracer = None, journal: JobJournal = None,
+                keep_results: bool = False, retry: RetryPolicy = None) -> None:
         """
         Initialize the class
 
         Args:
             type (str):
-                Type of query to perform. Can be 'gaia', '2mass' or 'gaia2mass'.
+                Type of query to perform. Can be 'gaia', '2mass' or 'gaia+2mass', or several of them separated by commas
+                (e.g. 'gaia,2mass'), queried at the same time and saved in a single file (see get_obs_multi).
             lvalue (float): 
                 Square center value in Galactic longitude (in degree)
             bvalue (float): 
@@ -36,37 +49,277 @@ class Finder():
                 Name of the catalog. Default name is 'observations_gaia_{bvalue}_{lvalue}_{psize}.csv'
             pi (int, optional):
                 Apply offset correction to the parallaxes. Default to 1, parallaxes are corrected.
+            metrics_file (str, optional):
+                JSON-lines file to which the metrics of the query are appended. Default to None.
+            metrics_callback (callable, optional):
+                Function called with the QueryMetrics of the query. Default to None.
+            tracer (Tracer, optional):
+                Tracer in which the pixel and each phase of the query are recorded as spans. Default to None.
+            journal (JobJournal, optional):
+                Journal of the submitted jobs, used to reuse the jobs of a previous run that stopped mid-way. Default to None.
+            keep_results (bool, optional):
+                Keep the jobs on the server once their results are downloaded. Default to False, jobs are deleted.
+            retry (RetryPolicy, optional):
+                Policy used to retry the requests failing with a transient error. Default to RetryPolicy().
+        """
+
+        if "," in type:
+            self.get_obs_multi(type.split(","), lvalue, bvalue, psize, path, proxy, verbose, name, pi, metrics_file, metrics_callback, tracer, journal, keep_results, retry)
+            return
+
+        finder = self.make_finder(type, lvalue, bvalue, psize, path, proxy, verbose, name, pi, metrics_file, metrics_callback, tracer, journal, keep_results, retry)
+        if finder is None:
+            return
+
+        self.query = finder.get_obs()
+        self.metrics = finder.metrics
+
+    def make_finder(self, type: str, lvalue: float, bvalue: float, psize: float, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None, pi: int = 1,
+                    metrics_file: str = None, metrics_callback = None, tracer: Tracer = None, journal: JobJournal = None,
+                    keep_results: bool = False, retry: RetryPolicy = None) -> object:
+        """
+        Create the finder corresponding to the type of query. Arguments are the same as get_obs.
+
+        Returns:
+            object: Findgaia, Find2mass or Findgaia2mass instance. None for 'simbad'.
         """
 
         # Define case according to the type of query
         if type == 'gaia':
-            self.query = Findgaia(lvalue, bvalue, psize, path, proxy, verbose, name, pi).get_obs()
+            return Findgaia(lvalue, bvalue, psize, path, proxy, verbose, name, pi, metrics_file, metrics_callback, tracer, journal, keep_results, retry)
         elif type == '2mass':
-            self.query = Find2mass(lvalue, bvalue, psize, path, proxy, verbose, name).get_obs()
+            return Find2mass(lvalue, bvalue, psize, path, proxy, verbose, name, metrics_file, metrics_callback, tracer, journal, keep_results, retry)
         elif type == 'gaia+2mass':
-            self.query = Findgaia2mass(lvalue, bvalue, psize, path, proxy, verbose, name, pi).get_obs()
+            return Findgaia2mass(lvalue, bvalue, psize, path, proxy, verbose, name, pi, metrics_file, metrics_callback, tracer, journal, keep_results, retry)
         elif type == 'simbad':
             print("The 'simbad' type of query is not available with this command. Please use the 'pyfindsimbad' command line tool to query the simbad database.")
+            return None
         else:
             raise ValueError(f"Unknown type of query: {type}")
+
+    def get_obs_multi(self, types: list, lvalue: float, bvalue: float, psize: float, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None, pi: int = 1,
+                      metrics_file: str = None, metrics_callback = None, tracer: Tracer = None, journal: JobJournal = None,
+                      keep_results: bool = False, retry: RetryPolicy = None) -> QueryMetrics:
+        """
+        Query several catalogs for the same pixel at the same time, each one on its own archive, and save
+        them in a single hdf5 file with one group per catalog ('gaia', '2mass', 'gaia+2mass'), holding the
+        datasets of the file of that catalog. The time of the query is the one of the slowest archive.
+        If both 'gaia' and 'gaia+2mass' are queried, the Gaia sources are only downloaded once, the
+        cross-match adding the 2MASS counterparts of the sources of 'gaia' (see Findgaia2mass.reuse_gaia_obs).
+        Arguments are the same as get_obs.
+
+        Args:
+            types (list):
+                Types of query to perform, among 'gaia', '2mass' and 'gaia+2mass'.
+            name (str, optional):
+                Name of the file. Default name is 'observations_{type1}_{type2}_{bvalue}_{lvalue}_{psize}.hdf5'
+
+        Returns:
+            QueryMetrics: Metrics of the pixel, summing the ones of each catalog
+        """
+
+        finders = {}
+        for type in dict.fromkeys(types):
+            finder = self.make_finder(type, lvalue, bvalue, psize, path, proxy, verbose, None, pi, metrics_file, metrics_callback, tracer, journal, keep_results, retry)
+            if finder is not None:
+                finders[type] = finder
+
+        self.metrics = QueryMetrics(','.join(finders), tracer = tracer, lvalue = lvalue, bvalue = bvalue, psize = psize)
+        if len(finders) == 0:
+            return self.metrics
+
+        def run(type):
+            # Gaia sources downloaded and corrected once, the cross-match only adds their 2MASS counterparts
+            if type == 'gaia+2mass' and 'gaia' in results:
+                finders[type].gaia_data = results['gaia'].result()
+            return finders[type].get_obs(return_data = True)
+
+        with futures.ThreadPoolExecutor(max_workers = len(finders), thread_name_prefix = "catalog") as executor:
+            results = {}
+            for type in sorted(finders, key = lambda type: type != 'gaia'):
+                results[type] = executor.submit(run, type)
+            results = {type: results[type].result() for type in finders}
+
+        for finder in finders.values():
+            self.metrics.merge(finder.metrics)
+
+        path = next(iter(finders.values())).path
+        if name == None:
+            name = f"observations_{'_'.join(type.replace('+', '') for type in finders)}_{bvalue:.6f}_{lvalue:.6f}_{psize / 60:.6f}.hdf5"
+        self.filename = f"{path}/{name}"
+
+        with self.metrics.timer('write', rows = sum(len(data) for data in results.values())):
+            with h5py.File(self.filename, 'w') as f:
+                for type, data in results.items():
+                    finders[type].write_datasets(f.create_group(type), data)
+
+        if verbose:
+            print(f"Nb sources: {', '.join(f'{type} {len(data)}' for type, data in results.items())}")
+        print(f"Observations saved in {self.filename}")
+
+        self.metrics.finish()
+
+        return self.metrics
+
+    def get_obs_batch(self, type: str, pixels: list, psize: float = 5, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, pi: int = 1,
+                      workers: int = 4, metrics_file: str = None, metrics_callback = None, tracer: Tracer = None, journal: JobJournal = None,
+                      keep_results: bool = False, retry: RetryPolicy = None) -> list:
+        """
+        Query several pixels concurrently. Each pixel is saved in its own file, with the default name.
+        A pixel that fails (after the retries of transient errors) does not stop the others: its error
+        is stored in the 'error' attribute of its metrics, and the pixel is listed in self.failures.
+
+        Args:
+            type (str):
+                Type of query to perform. Can be 'gaia', '2mass' or 'gaia+2mass', or several of them separated by commas.
+                Other types raise a ValueError before any pixel is queried.
+            pixels (list):
+                List of pixels to query, each defined as (lvalue, bvalue) or (lvalue, bvalue, psize)
+            psize (float, optional):
+                Pixel size (in arcmin), used for pixels without their own size. Default to 5.
+            path (str):
+                Working directory
+            proxy (tuple[str, int], optional):
+                Proxy to use, if needed. Tuple containing the adresse of the proxy and the port to use. Default to None.
+            verbose (int, optional):
+                Toggle verbose (1 or 0). Default to 0.
+            pi (int, optional):
+                Apply offset correction to the parallaxes. Default to 1, parallaxes are corrected.
+            workers (int, optional):
+                Number of pixels queried at the same time. Default to 4.
+            metrics_file (str, optional):
+                JSON-lines file to which the metrics of each pixel are appended. Default to None.
+            metrics_callback (callable, optional):
+                Function called with the QueryMetrics of each pixel. Default to None.
+            tracer (Tracer, optional):
+                Tracer in which each pixel and each phase of the queries are recorded as spans. Default to None.
+            journal (JobJournal, optional):
+                Journal of the submitted jobs, shared by all pixels. When a batch is run again with the same journal,
+                jobs still executing are re-attached and completed ones are downloaded without being submitted again. Default to None.
+            keep_results (bool, optional):
+                Keep the jobs on the server once their results are downloaded. Default to False, jobs are deleted.
+            retry (RetryPolicy, optional):
+                Policy used to retry the requests failing with a transient error. Default to RetryPolicy().
+
+        Returns:
+            list: QueryMetrics of each pixel, in the same order as pixels
+        """
+
+        # Checked before starting, a wrong type would make every pixel fail
+        for name in type.split(","):
+            if name not in ('gaia', '2mass', 'gaia+2mass', 'simbad'):
+                raise ValueError(f"Unknown type of query: {name}")
+        if type == 'simbad':
+            raise ValueError("The 'simbad' type of query is not available for a batch of pixels. Please use the 'pyfindsimbad' command line tool to query the simbad database.")
+
+        self.failures = []
+
+        def run(pixel):
+            if "," in type:
+                return self.run_multi(type.split(","), pixel, psize, path, proxy, verbose, pi, metrics_file, metrics_callback, tracer, journal, keep_results, retry)
+
+            finder = self.make_finder(type, pixel[0], pixel[1], pixel[2] if len(pixel) > 2 else psize, path, proxy, verbose, None, pi,
+                                      metrics_file, metrics_callback, tracer, journal, keep_results, retry)
+            try:
+                finder.get_obs()
+            except Exception as error:
+                # Isolate the failure to this pixel, the metrics are still reported
+                print(f"Pixel l={pixel[0]} b={pixel[1]} failed: {error}")
+                finder.metrics.attributes["error"] = f"{error.__class__.__name__}: {error}"
+                finder.metrics.finish(metrics_callback, metrics_file)
+                self.failures.append((pixel, error))
+
+            return finder.metrics
+
+        with futures.ThreadPoolExecutor(max_workers = workers, thread_name_prefix = "pixel") as executor:
+            self.metrics = list(executor.map(run, pixels))
+
+        return self.metrics
+
+    def run_multi(self, types: list, pixel: tuple, psize: float, path: str, proxy: tuple[str, int], verbose: int, pi: int,
+                  metrics_file: str, metrics_callback, tracer: Tracer, journal: JobJournal, keep_results: bool, retry: RetryPolicy) -> QueryMetrics:
+        """
+        Query several catalogs for a pixel of a batch (see get_obs_multi), isolating its failure as get_obs_batch does
+
+        Returns:
+            QueryMetrics: Metrics of the pixel
+        """
+
+        finder = Finder()
+        try:
+            return finder.get_obs_multi(types, pixel[0], pixel[1], pixel[2] if len(pixel) > 2 else psize, path, proxy, verbose, None, pi,
+                                        metrics_file, metrics_callback, tracer, journal, keep_results, retry)
+        except Exception as error:
+            print(f"Pixel l={pixel[0]} b={pixel[1]} failed: {error}")
+            metrics = getattr(finder, 'metrics', None) or QueryMetrics(','.join(types), tracer = tracer, lvalue = pixel[0], bvalue = pixel[1])
+            metrics.attributes["error"] = f"{error.__class__.__name__}: {error}"
+            metrics.finish(metrics_callback, metrics_file)
+            self.failures.append((pixel, error))
+            return metrics
         
+def daemon_main(args) -> int:
+    """
+    Send the queries of the command line to a daemon, which saves the files
+
+    Args:
+        args (argparse.Namespace): Arguments of the command line
+
+    Returns:
+        int: Exit status
+    """
+
+    host, port = args.daemon.split(':')[0], int(args.daemon.split(':')[1])
+    if args.pixels != None:
+        with open(args.pixels) as f:
+            pixels = [tuple(float(value) for value in line.split()) for line in f if line.strip() and not line.startswith('#')]
+        name = None
+    else:
+        pixels = [(args.l, args.b)]
+        name = args.n
+
+    def run(pixel):
+        client = DaemonClient(host, port)
+        try:
+            client.get_obs(args.type, pixel[0], pixel[1], pixel[2] if len(pixel) > 2 else args.p, path = args.d, name = name, return_data = False)
+            return None
+        except ObsfinderError as error:
+            print(f"Pixel l={pixel[0]} b={pixel[1]} failed: {error}")
+            return error
+        finally:
+            client.close()
+
+    with futures.ThreadPoolExecutor(max_workers = args.workers) as executor:
+        failures = [error for error in executor.map(run, pixels) if error is not None]
+
+    return 1 if len(failures) > 0 else 0
+
 def main() -> int:
     """
     Main function used when the script is called from a command line
     """
     # Arguments definition
     parser = argparse.ArgumentParser()
-    parser.add_argument('-type', type = str, help = "Type of query to perform. Can be 'gaia', '2mass' or 'gaia2mass'")
-    parser.add_argument('-l', type = float, required = True, help = "Square center value in Galactic longitude (deg)")
-    parser.add_argument('-b', type = float, required = True, help = "Square center value in Galactic latitude (deg)")
+    parser.add_argument('-type', type = str, help = "Type of query to perform. Can be 'gaia', '2mass' or 'gaia+2mass', or several of them separated by commas (e.g. 'gaia,2mass') to query them at the same time and save them in a single file")
+    parser.add_argument('-l', type = float, required = False, help = "Square center value in Galactic longitude (deg). Required if -pixels is not used", default = None)
+    parser.add_argument('-b', type = float, required = False, help = "Square center value in Galactic latitude (deg). Required if -pixels is not used", default = None)
     parser.add_argument('-p', type = float, required = False, help = "Pixel size (arcminute)", default = 5)
     parser.add_argument('-v', type = int, required = False, help = "Verbose", default = 0)
     parser.add_argument('-d', type = str, required = False, help = "Working directory", default = None)
     parser.add_argument('-n', type = str, required = False, help = "Name of the output file", default = None)
     parser.add_argument('-proxy', type = str, required = False, help = "Proxy to use host:port", default = None)
+    parser.add_argument('-metrics', type = str, required = False, help = "JSON-lines file to which the query metrics are appended", default = None)
+    parser.add_argument('-trace', type = str, required = False, help = "File in which the Chrome trace-event JSON of the queries is written", default = None)
+    parser.add_argument('-journal', type = str, required = False, help = "Journal of the submitted jobs, used to resume a run that stopped mid-way", default = None)
+    parser.add_argument('-keep', type = int, required = False, help = "Keep the jobs on the server once their results are downloaded", default = 0)
+    parser.add_argument('-retries', type = int, required = False, help = "Maximum number of attempts of a request failing with a transient error", default = 5)
+    parser.add_argument('-pixels', type = str, required = False, help = "File containing one pixel per line, defined as 'l b' or 'l b p'", default = None)
+    parser.add_argument('-daemon', type = str, required = False, help = "Send the queries to a local daemon (see pyfinderd). Format: 'adresse:port'", default = None)
+    parser.add_argument('-workers', type = int, required = False, help = "Number of pixels queried at the same time when -pixels is used", default = 4)
 
     # Get arguments value
     args = parser.parse_args()
+    if args.pixels == None and (args.l == None or args.b == None):
+        parser.error("-l and -b are required if -pixels is not used")
     long = args.l
     latt = args.b
     psize = args.p
@@ -79,8 +332,31 @@ def main() -> int:
     else:
         proxy = None
 
+    tracer = Tracer(args.trace) if args.trace != None else None
+    retry = RetryPolicy(max_attempts = args.retries, verbose = verbose)
+    journal = JobJournal(args.journal, verbose = args.v) if args.journal != None else None
+
+    if args.daemon != None:
+        return daemon_main(args)
+
     ftmass = Finder()
-    ftmass.get_obs(type=args.type ,lvalue = args.l, bvalue = args.b, path = args.d, psize = args.p, proxy = args.proxy, verbose = args.v, name = args.n)
+    try:
+        if args.pixels != None:
+            with open(args.pixels) as f:
+                pixels = [tuple(float(value) for value in line.split()) for line in f if line.strip() and not line.startswith('#')]
+            ftmass.get_obs_batch(type = args.type, pixels = pixels, psize = psize, path = path, proxy = proxy, verbose = verbose, workers = args.workers,
+                                 metrics_file = args.metrics, tracer = tracer, journal = journal, keep_results = args.keep, retry = retry)
+            if len(ftmass.failures) > 0:
+                print(f"{len(ftmass.failures)} of {len(pixels)} pixels failed")
+                return 1
+        else:
+            ftmass.get_obs(type=args.type ,lvalue = long, bvalue = latt, path = path, psize = psize, proxy = proxy, verbose = verbose, name = name, metrics_file = args.metrics, tracer = tracer, journal = journal, keep_results = args.keep, retry = retry)
+    except ObsfinderError as error:
+        print(f"Error: {error}")
+        return 1
+    finally:
+        if tracer != None:
+            tracer.write()
 
     return 0
 
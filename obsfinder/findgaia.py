@@ -1,27 +1,53 @@
 #!/usr/bin/env python3
 
-from xml.dom.minidom import parseString
-import http.client as httplib
-import urllib.parse as urllib
-from zero_point import zpt
-import pandas as pd
-import numpy as np
+from __future__ import annotations
+from .metrics import QueryMetrics
+from .tap import TapService
+from .tracing import Tracer
+from .journal import JobJournal
+from .errors import ObsfinderError, QueryError
+from .retry import RetryPolicy
+from .votable import write_votable
+from .catalog import write_index
+from .dtypes import column_dtype, cast_columns
+from .coverage import pixel_boxes, subtract_boxes, find_previous, find_previous_moc, read_previous, merge_obs, write_coverage, write_moc
+from .moc import MOC, GAIA_ORDER, source_id_conditions
+from .lazy import lazy_import
 import argparse
 import warnings
+import threading
 import pathlib
-import h5py
-import time
-import csv
 import sys
 
+zpt = lazy_import("zero_point.zpt")
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+h5py = lazy_import("h5py")
+futures = lazy_import("concurrent.futures")
+
+_zpt_lock = threading.Lock()
+_zpt_loaded = False
+
+def load_zpt_tables() -> None:
+    """
+    Load the tables of the parallax zero point, once per process
+    """
+
+    global _zpt_loaded
+
+    with _zpt_lock:
+        if not _zpt_loaded:
+            zpt.load_tables()
+            _zpt_loaded = True
+
 def correct_parallaxes(data: pd.DataFrame) -> pd.DataFrame:
 
-    zpt.load_tables()
+    load_zpt_tables()
     zero_point = zpt.get_zpt(data["phot_g_mean_mag"], data["nu_eff_used_in_astrometry"],
             data["pseudocolour"],data["ecl_lat"],
             data["astrometric_params_solved"], _warnings=True)
 
-    data["parallax"] -= zero_point
+    data["parallax"] = (data["parallax"] - zero_point).astype(data["parallax"].dtype)
 
     return data
 
@@ -50,25 +76,80 @@ def attach_mag_uncertainty(data: pd.DataFrame) -> pd.DataFrame:
 
     # Compute the uncertainty on the magnitude
     if 'phot_bp_mean_flux_over_error' in data.columns:
-        data['phot_bp_mean_flux_over_error'] = mag_uncertainty(data['phot_bp_mean_flux_over_error'].astype(float))
+        data['phot_bp_mean_flux_over_error'] = mag_uncertainty(pd.to_numeric(data['phot_bp_mean_flux_over_error']))
         data.rename(columns={'phot_bp_mean_flux_over_error': 'phot_bp_mean_mag_error'}, inplace=True)
 
     if 'phot_g_mean_flux_over_error' in data.columns:
-        data['phot_g_mean_flux_over_error'] = mag_uncertainty(data['phot_g_mean_flux_over_error'].astype(float))
+        data['phot_g_mean_flux_over_error'] = mag_uncertainty(pd.to_numeric(data['phot_g_mean_flux_over_error']))
         data.rename(columns={'phot_g_mean_flux_over_error': 'phot_g_mean_mag_error'}, inplace=True)
 
     if 'phot_rp_mean_flux_over_error' in data.columns:
-        data['phot_rp_mean_flux_over_error'] = mag_uncertainty(data['phot_rp_mean_flux_over_error'].astype(float))
+        data['phot_rp_mean_flux_over_error'] = mag_uncertainty(pd.to_numeric(data['phot_rp_mean_flux_over_error']))
         data.rename(columns={'phot_rp_mean_flux_over_error': 'phot_rp_mean_mag_error'}, inplace=True)
 
     return data
 
+# Column of the data written in each dataset of the hdf5 file of Findgaia
+DATASETS = {'source_id': 'source_id', 'BP': 'phot_bp_mean_mag', 'BP_err': 'phot_bp_mean_mag_error', 'G': 'phot_g_mean_mag',
+            'G_err': 'phot_g_mean_mag_error', 'RP': 'phot_rp_mean_mag', 'RP_err': 'phot_rp_mean_mag_error',
+            'parallax': 'parallax', 'parallax_err': 'parallax_error', 'l': 'l', 'b': 'b'}
+
+# Columns queried by Findgaia to clean the sources and write the datasets, then the ones needed by the parallax zero point
+REQUIRED_COLUMNS = ['source_id', 'phot_bp_mean_mag', 'phot_bp_mean_flux_over_error', 'phot_g_mean_mag', 'phot_g_mean_flux_over_error',
+                    'phot_rp_mean_mag', 'phot_rp_mean_flux_over_error', 'parallax', 'parallax_error', 'l', 'b']
+PARALLAX_COLUMNS = ['nu_eff_used_in_astrometry', 'pseudocolour', 'ecl_lat', 'astrometric_params_solved']
+
+GAIA_SOURCE = "gaiadr3.gaia_source"
+GAIA_SOURCE_LITE = "gaiadr3.gaia_source_lite"
+
+def write_column(group, name: str, values: pd.Series) -> None:
+    """
+    Write a column requested by the user as a dataset: numbers as int64 (integers without empty value) or float, other values as utf-8 strings
+
+    Args:
+        group (h5py.Group): File or group in which the dataset is created
+        name (str): Name of the dataset
+        values (pd.Series): Values of the column
+    """
+
+    if pd.api.types.is_integer_dtype(values) and not values.isna().any():
+        group.create_dataset(name, data = values.to_numpy(dtype = np.int64))
+    elif pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values):
+        group.create_dataset(name, data = values.to_numpy(dtype = float, na_value = np.nan))
+    else:
+        group.create_dataset(name, data = values.fillna('').astype(str).to_numpy(dtype = object), dtype = h5py.string_dtype())
+
+def read_obs(filename: str) -> pd.DataFrame:
+    """
+    Read the Gaia sources saved in an hdf5 file by Findgaia, with the column names of the returned data
+
+    Args:
+        filename (str): Path of the hdf5 file (or 'file.hdf5/group' for a group of the file written by Finder.get_obs_multi)
+
+    Returns:
+        pd.DataFrame: Gaia sources, already cleaned and corrected
+    """
+
+    group = ''
+    if '.hdf5/' in filename:
+        filename, group = filename.split('.hdf5/', 1)
+        filename += '.hdf5'
+
+    with h5py.File(filename, 'r') as f:
+        group = f[group] if group != '' else f
+        if 'source_id' not in group:
+            raise QueryError(f"{filename} has no source_id dataset, it was written by an older version of Findgaia")
+        return pd.DataFrame({column: group[dataset][()] for dataset, column in DATASETS.items()})
+
 class Findgaia():
     """
     This class contains tools to query the Gaia archive and retreive data from Gaia DR3.
     """
     
-    def __init__(self, lvalue: float, bvalue: float, psize: float, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None, pi: int = 1) -> None:
+    def __init__(self, lvalue: float, bvalue: float, psize: float, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None, pi: int = 1,
+                metrics_file: str = None, metrics_callback = None, tracer = None, journal = None,
+                keep_results: bool = False, retry: RetryPolicy = None, grow: bool = False, moc = None, columns: list = None, lite = None,
+                compact: bool = False) -> None:
         """
         Initialize the class
 
@@ -89,17 +170,40 @@ class Findgaia():
                 Name of the catalog. Default name is 'observations_gaia_{bvalue}_{lvalue}_{psize}.csv'
             pi (int, optional):
                 Apply offset correction to the parallaxes. Default to 1, parallaxes are corrected.
+            metrics_file (str, optional):
+                JSON-lines file to which the metrics of each call to get_obs are appended. Default to None.
+            metrics_callback (callable, optional):
+                Function called with the QueryMetrics of each call to get_obs. Default to None.
+            tracer (Tracer, optional):
+                Tracer in which the pixel and each phase of the query are recorded as spans. Default to None.
+            journal (JobJournal, optional):
+                Journal of the submitted jobs, used to reuse the jobs of a previous run that stopped mid-way. Default to None.
+            keep_results (bool, optional):
+                Keep the jobs on the server once their results are downloaded. Default to False, jobs are deleted.
+            retry (RetryPolicy, optional):
+                Policy used to retry the requests failing with a transient error (5xx status, connection lost, ...). Default to RetryPolicy().
+            grow (bool, optional):
+                Reuse the hdf5 file of the working directory covering the largest part of the pixel (see previous_obs): only the part of
+                the pixel it does not cover is downloaded, and the output file holds the sources of both. Default to False.
+            moc (MOC or str, optional):
+                Coverage map (or path of a FITS or JSON MOC file) to get instead of the pixel (see query_moc). With grow, the file of the
+                working directory whose coverage map has the largest intersection with it is reused. Default to None.
+            columns (list, optional):
+                Columns of gaia_source to retreive in addition to the default ones. They are written as datasets of the same name
+                in the output file. Default to None.
+            lite (bool, optional):
+                Query gaiadr3.gaia_source_lite (True) or gaiadr3.gaia_source (False). Default to None: gaia_source_lite if it has
+                all the columns needed (see select_table).
+            compact (bool, optional):
+                Hold and write the magnitudes, errors and parallaxes as float32, and the flags as small integers, the coordinates
+                staying float64 (see dtypes.column_dtype), which roughly halves the memory and the size of the output file. Default to False (float64).
         """
 
         self.host = "gea.esac.esa.int"
         self.port = 443
         self.pathinfo = "/tap-server/tap/async"
-        self.query = "SELECT source_id, phot_bp_mean_mag, phot_bp_mean_flux_over_error, \
-                phot_g_mean_mag, phot_g_mean_flux_over_error,\
-                phot_rp_mean_mag, phot_rp_mean_flux_over_error, \
-                parallax, parallax_error ,l, b, nu_eff_used_in_astrometry, pseudocolour, ecl_lat, astrometric_params_solved\
-                FROM gaiadr3.gaia_source \
-                WHERE "
+        self.query = None
+        self.table = None
         self.lvalue = lvalue
         self.bvalue = bvalue
         self.path = path
@@ -108,6 +212,24 @@ class Findgaia():
         self.verbose = verbose
         self.filename = name
         self.pi = pi
+        self.metrics_file = metrics_file
+        self.metrics_callback = metrics_callback
+        self.tracer = tracer
+        self.journal = journal
+        self.keep_results = keep_results
+        self.retry = retry
+        self.grow = grow
+        self.moc = MOC.read(moc) if isinstance(moc, str) else moc
+        self.columns = [column.strip().lower() for column in columns] if columns != None else []
+        self.lite = lite
+        self.compact = compact
+        self.coverage = None
+        self.delivered = None
+        self.metrics = QueryMetrics('gaia', tracer = tracer, lvalue = lvalue, bvalue = bvalue, psize = psize)
+        self.tap = TapService(self.host, self.port, self.pathinfo, proxy = proxy, verbose = verbose, journal = journal, keep_results = keep_results, retry = retry,
+                              params = {"REQUEST": "doQuery", "LANG": "ADQL", "FORMAT": "csv", "PHASE": "RUN",
+                                        "JOBNAME": "Any name (optional)", "JOBDESCRIPTION": "Any description (optional)"},
+                              headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"})
 
         if not self.verbose:
             warnings.filterwarnings("ignore")
@@ -115,7 +237,7 @@ class Findgaia():
         if self.path == None:
             self.path = str(pathlib.Path().resolve())
 
-    def query_obs(self, lmin: float, lmax: float) -> pd.DataFrame:
+    def query_obs(self, lmin: float, lmax: float, bmin: float = None, bmax: float = None) -> pd.DataFrame:
         """
         Make a query to gaia archive to retreive gaia flux in G, B and R bands
         and their uncertainty, as well as the longitude and lattitude of each
@@ -128,118 +250,120 @@ class Findgaia():
                 Lowest value in longitude (in degree)
             lmax (float):
                 Highest value in longitude (in degree)
+            bmin (float, optional):
+                Lowest value in latitude (in degree). Default to the bottom of the pixel.
+            bmax (float, optional):
+                Highest value in latitude (in degree). Default to the top of the pixel.
 
         Returns:
             pd.DataFrame: Dataframe containing the data
         """
 
-        zone = f"gaiadr3.gaia_source.l BETWEEN {lmin} AND {lmax} \
-                 AND gaiadr3.gaia_source.b BETWEEN {self.bvalue - self.psize/2} AND {self.bvalue + self.psize/2}"
-            
+        bmin = bmin if bmin != None else self.bvalue - self.psize/2
+        bmax = bmax if bmax != None else self.bvalue + self.psize/2
+        table = self.select_table()
+        zone = f"{table}.l BETWEEN {lmin} AND {lmax} \
+                 AND {table}.b BETWEEN {bmin} AND {bmax}"
+
+        return self.query_zone(zone)
+
+    def query_moc(self, moc: MOC) -> pd.DataFrame:
+        """
+        Make queries to gaia archive to retreive the sources of a coverage map. The sources are selected by
+        ranges of source_id, which holds the index of their HEALPix cell of order 12, so that each source of
+        the coverage is downloaded once. Cells finer than order 12 are then applied to the sources.
+
+        Args:
+            moc (MOC):
+                Coverage map of the sources
+
+        Returns:
+            pd.DataFrame: Dataframe containing the data
+        """
+
+        conditions = source_id_conditions(moc, f"{self.select_table()}.source_id")
+        self.metrics.count('moc_queries', len(conditions))
+
+        data = pd.concat([self.query_zone(condition) for condition in conditions], ignore_index=True)
+
+        if moc.max_order > GAIA_ORDER:
+            data = data[moc.contains(data['l'], data['b'], frame = 'galactic')]
+
+        return data
+
+    def query_zone(self, zone: str) -> pd.DataFrame:
+        """
+        Make a query to gaia archive to retreive the sources of a zone
+
+        Args:
+            zone (str):
+                ADQL condition selecting the sources
+
+        Returns:
+            pd.DataFrame: Dataframe containing the data
+        """
+
+        self.select_table()
         query = self.query + zone
 
-        # Encode the query
-        params = urllib.urlencode({\
-            "REQUEST": "doQuery", \
-            "LANG":    "ADQL", \
-            "FORMAT":  "csv", \
-            "PHASE":  "RUN", \
-            "JOBNAME":  "Any name (optional)", \
-            "JOBDESCRIPTION":  "Any description (optional)", \
-            "QUERY":   f"{query}"
-            })
-
-        headers = {\
-            "Content-type": "application/x-www-form-urlencoded", \
-            "Accept":       "text/plain" \
-            }
-
-        # Use proxy if needed
-        if self.proxy != None:
-            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-            connection.set_tunnel(self.host, self.port)
-        else:
-            connection=httplib.HTTPSConnection(self.host, self.port)
+        data = self.tap.run(query, self.metrics)
 
-        # Send the query
-        connection.request("POST", self.pathinfo, params, headers)
+        with self.metrics.timer('parse'):
+            # source_id does not fit in a float, the columns of the user keep their own type
+            data = cast_columns(data, REQUIRED_COLUMNS + PARALLAX_COLUMNS, self.compact)
 
-        #Status
-        response = connection.getresponse()
-        if self.verbose:
-            print ("Status: " +str(response.status), "Reason: " + str(response.reason))
+        return data
 
-        #Server job location (URL)
-        location = response.getheader("location")
-        if self.verbose:
-            print ("Location: " + location)
+    def query_columns(self) -> list:
+        """
+        Columns of the query: the ones needed to clean the sources and write the output file, those of the parallax
+        zero point if pi is set, then the columns of the user
 
-        #Jobid
-        jobid = location[location.rfind('/')+1:]
-        if self.verbose:
-            print ("Job id: " + jobid)
+        Returns:
+            list: Names of the columns
+        """
 
-        connection.close()
+        columns = REQUIRED_COLUMNS + (PARALLAX_COLUMNS if self.pi else []) + self.columns
 
+        return list(dict.fromkeys(columns))
 
-        # Check job status, wait until finished
-        while True:
-            # Use proxy if needed
-            if self.proxy != None:
-                connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-                connection.set_tunnel(self.host, self.port)
-            else:
-                connection=httplib.HTTPSConnection(self.host, self.port)
-
-            connection.request("GET", self.pathinfo + "/" + jobid)
-            response = connection.getresponse()
-            data = response.read()
-            dom = parseString(data)
-            phaseElement = dom.getElementsByTagName('uws:phase')[0]
-            phaseValueElement = phaseElement.firstChild
-            phase = phaseValueElement.toxml()
-            if self.verbose:
-                print ("Status: " + phase)
-            #Check finished
-            if phase == 'COMPLETED': break
+    def extra_columns(self) -> list:
+        """
+        Columns of the user not already written in the output file
 
-            if phase == 'ERROR':
-                print("Critical failure: Error during the query")
-                print(data)
-                exit()
+        Returns:
+            list: Names of the columns
+        """
 
-            #wait and repeat
-            time.sleep(0.2)
+        return [column for column in self.columns if column not in REQUIRED_COLUMNS]
 
-        connection.close()
+    def select_table(self) -> str:
+        """
+        Choose the table of the queries, once: gaiadr3.gaia_source_lite when every column of the query (see query_columns)
+        exists in it, gaiadr3.gaia_source otherwise. The columns of gaia_source_lite are read from the metadata of the
+        archive (see schema.TableSchema), cached on disk, so that no request is needed once it is known. If the metadata
+        cannot be fetched, gaia_source is used.
 
-        # Get results
-        if self.verbose:
-            print("Retrieving data...")
+        Returns:
+            str: Name of the table
+        """
 
-        # Use proxy if needed
-        if self.proxy != None:
-            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-            connection.set_tunnel(self.host, self.port)
-        else:
-            connection=httplib.HTTPSConnection(self.host, self.port)
+        if self.table == None:
+            columns = self.query_columns()
 
-        connection.request("GET", self.pathinfo + "/" + jobid + "/results/result")
-        response = connection.getresponse()
+            if self.lite == None:
+                known = self.tap.schema.tables(self.tap, [GAIA_SOURCE_LITE]).get(GAIA_SOURCE_LITE, {}) if self.tap.schema is not None else {}
+                lite = len(known) > 0 and all(column in known for column in columns)
+            else:
+                lite = bool(self.lite)
 
-        data = response.read().decode('iso-8859-1')
-        data = data.split()
-        data = list((csv.reader(data, delimiter=',')))
-        data = pd.DataFrame(data[1:], columns = data[0])
-        data = data.replace(r'^\s*$', np.nan, regex=True)
-        # data_temp = data['source_id'].astype(int)
-        data = data.astype(float)
-        # data['source_id'] = data_temp
-        # del data_temp
+            self.table = GAIA_SOURCE_LITE if lite else GAIA_SOURCE
+            self.query = f"SELECT {', '.join(columns)} FROM {self.table} WHERE "
 
-        connection.close()
+            if self.verbose:
+                print(f"Querying {self.table}")
 
-        return data
+        return self.table
     
     def clean_obs(self, data: pd.DataFrame) -> pd.DataFrame:
         """
@@ -282,17 +406,23 @@ class Findgaia():
             data (pd.DataFrame): Data to save
         """
 
-        if self.filename == None:
+        if self.filename == None and self.moc is not None:
+            # Name of the output file, identified by its coverage map
+            self.filename = f"{self.path}/observations_gaia_moc_{self.moc.digest()}.hdf5"
+        elif self.filename == None:
             # Name of the output file
             self.filename = f"{self.path}/observations_gaia_{self.bvalue:.6f}_{self.lvalue:.6f}_{self.psize:.6f}.hdf5"
         else:
             self.filename = f"{self.path}/{self.filename}"
 
-        if self.filename.split('.')[-1] == 'hdf5':
-            self.write_hdf5(data)
-        else:
-            data = data[['phot_bp_mean_mag', 'phot_bp_mean_mag_error', 'phot_g_mean_mag', 'phot_g_mean_mag_error', 'phot_rp_mean_mag', 'phot_rp_mean_mag_error', 'parallax', 'parallax_error', 'l', 'b']]
-            np.savetxt(self.filename, data, header="BP,BP_err,G,G_err,RP,RP_err,parallax,parallax_err,l,b", delimiter=',', comments='')
+        with self.metrics.timer('write', rows = len(data)):
+            if self.filename.split('.')[-1] == 'hdf5':
+                self.write_hdf5(data)
+            else:
+                extra = self.extra_columns()
+                data = data[['phot_bp_mean_mag', 'phot_bp_mean_mag_error', 'phot_g_mean_mag', 'phot_g_mean_mag_error', 'phot_rp_mean_mag', 'phot_rp_mean_mag_error', 'parallax', 'parallax_error', 'l', 'b'] + extra]
+                fmt = ['%.18e'] * 10 + ['%.18e' if pd.api.types.is_numeric_dtype(data[column]) else '%s' for column in extra]
+                np.savetxt(self.filename, data, fmt = fmt, header = ",".join(["BP,BP_err,G,G_err,RP,RP_err,parallax,parallax_err,l,b"] + extra), delimiter=',', comments='')
 
         if self.verbose:
             print('Done!')
@@ -302,16 +432,75 @@ class Findgaia():
 
     def write_hdf5(self, data: pd.DataFrame) -> None:
         with h5py.File(self.filename, 'w') as f:
-            f.create_dataset('BP', data=data['phot_bp_mean_mag'], dtype = float)
-            f.create_dataset('BP_err', data=data['phot_bp_mean_mag_error'], dtype = float)
-            f.create_dataset('G', data=data['phot_g_mean_mag'], dtype = float)
-            f.create_dataset('G_err', data=data['phot_g_mean_mag_error'], dtype = float)
-            f.create_dataset('RP', data=data['phot_rp_mean_mag'], dtype = float)
-            f.create_dataset('RP_err', data=data['phot_rp_mean_mag_error'], dtype = float)
-            f.create_dataset('parallax', data=data['parallax'], dtype = float)
-            f.create_dataset('parallax_err', data=data['parallax_error'], dtype = float)
-            f.create_dataset('l', data=data['l'], dtype = float)
-            f.create_dataset('b', data=data['b'], dtype = float)
+            self.write_datasets(f, data)
+            if self.coverage != None:
+                write_coverage(f, 'gaia', self.coverage, **self.options())
+            if self.delivered is not None:
+                write_moc(f, 'gaia', self.delivered, **self.options())
+
+    def options(self) -> dict:
+        """
+        Options recorded in the output file, that a file must have been written with to be reused by previous_obs
+
+        Returns:
+            dict: Parallax correction, columns of the user if there are some, and compact mode if set
+        """
+
+        options = dict(pi = int(self.pi))
+        if len(self.extra_columns()) > 0:
+            options['columns'] = ",".join(self.extra_columns())
+        if self.compact:
+            options['compact'] = 1
+
+        return options
+
+    def write_datasets(self, group, data: pd.DataFrame) -> None:
+        """
+        Write the columns of the output file as datasets of an hdf5 file or group
+
+        Args:
+            group (h5py.Group): File or group in which the datasets are created
+            data (pd.DataFrame): Data to write (sorted by cell of the grid index before being written)
+        """
+
+        order = write_index(group, data['l'], data['b'])
+        data = data.iloc[order]
+
+        for dataset, column in DATASETS.items():
+            group.create_dataset(dataset, data = data[column], dtype = column_dtype(column, self.compact))
+
+        for column in self.extra_columns():
+            write_column(group, column, data[column])
+
+    def previous_obs(self, boxes: list = None, moc: MOC = None) -> tuple[pd.DataFrame, list]:
+        """
+        Find the hdf5 file of the working directory covering the largest part of the pixel, or of the coverage map, among the
+        files written by Findgaia with the same parallax correction and user columns (see coverage.find_previous and find_previous_moc), and read its sources
+
+        Args:
+            boxes (list, optional): Boxes covered by the pixel (see coverage.pixel_boxes). Default to None.
+            moc (MOC, optional): Coverage map, used instead of the boxes. Default to None.
+
+        Returns:
+            tuple[pd.DataFrame, list]: Sources of the file (None if there is none), and boxes (or MOC) covered by the file
+        """
+
+        if moc is not None:
+            filename, coverage = find_previous_moc(self.path, 'gaia', moc, **self.options())
+        else:
+            filename, coverage = find_previous(self.path, 'gaia', boxes, **self.options())
+        if filename == None:
+            return None, coverage
+
+        with self.metrics.timer('reuse', filename = filename) as span:
+            data = read_previous(filename, {**DATASETS, **{column: column for column in self.extra_columns()}})
+            span['rows'] = len(data)
+        self.metrics.count('rows_reused', len(data))
+
+        if self.verbose:
+            print(f"Reusing the {len(data)} sources of {filename}")
+
+        return data, coverage
 
     def maglimList(data: np.ndarray, level: int, percentile: float) -> np.ndarray:
         """
@@ -349,45 +538,67 @@ class Findgaia():
             return_data (bool): Whether to return the data or save it directly. Default is False
 
         Returns:
-            pd.DataFrame: DataFrame with one row per object. Columns with multiple values are stored as lists. Only returned if return_data is True
+            pd.DataFrame: DataFrame with one row per object. Columns with multiple values are stored as lists. Only returned if return_data is True.
+                          The metrics of the query are available in its attrs['metrics'].
         """
 
-        # If longitude zone definition contains negative and positive longitudes
-        if self.lvalue - self.psize/2 < 0 and self.lvalue + self.psize/2 > 0:
-            if self.verbose:
-                print("Query split in two parts")
-
-            data_part1 = self.query_obs(360 + self.lvalue - self.psize/2, 360)
-            data_part2 = self.query_obs(0, self.lvalue + self.psize/2)
+        table = self.select_table()
+        self.metrics = QueryMetrics('gaia', tracer = self.tracer, lvalue = self.lvalue, bvalue = self.bvalue, psize = self.psize * 60, table = table)
 
-            data = pd.concat([data_part1, data_part2], ignore_index=True)
-        
-        # If longitude zone definition is entirely inferior to 0
-        elif self.lvalue - self.psize/2 < 0 and self.lvalue + self.psize/2 <= 0:
-            if self.verbose:
-                print("Negative longitude range, aborting")
-                exit()
-        
+        with self.metrics.span('pixel', catalog = 'gaia', lvalue = self.lvalue, bvalue = self.bvalue, psize = self.psize * 60):
+            # Sources of the coverage map, minus the part already downloaded
+            if self.moc is not None:
+                previous, delivered = self.previous_obs(moc = self.moc) if self.grow else (None, MOC())
+                missing = self.moc - delivered
+                data = self.query_moc(missing) if not missing.is_empty() else None
+                self.delivered = delivered | self.moc
 
-        # If zone definition is in the range [0, 360]
-        else:
-            data = self.query_obs(self.lvalue - self.psize/2, self.lvalue + self.psize/2)
+            # If longitude zone definition is entirely inferior to 0
+            elif self.lvalue - self.psize/2 < 0 and self.lvalue + self.psize/2 <= 0:
+                raise QueryError(f"Negative longitude range ({self.lvalue - self.psize/2} to {self.lvalue + self.psize/2}), longitudes must be in [0, 360]")
 
-        # Clean observations
-        data = self.clean_obs(data)
-
-        # Attach magnitudes uncertainties
-        data = self.attach_mag_uncertainty(data)
-
-        if self.pi:
-            # Correct parallaxes offset
-            data = correct_parallaxes(data)
-
-        if return_data:
-            return data
-        else:
-            # Save observations
-            self.save_obs(data)
+            # Zone split in two parts if it contains negative and positive longitudes, minus the part already downloaded
+            else:
+                boxes = pixel_boxes(self.lvalue, self.bvalue, self.psize)
+                previous, coverage = self.previous_obs(boxes) if self.grow else (None, [])
+                missing = subtract_boxes(boxes, coverage)
+                self.metrics.count('boxes', len(missing))
+
+                if self.verbose and len(missing) > 1:
+                    print(f"Query split in {len(missing)} parts")
+
+                data = pd.concat([self.query_obs(*box) for box in missing], ignore_index=True) if len(missing) > 0 else None
+                self.coverage = coverage + missing
+
+            if data is not None:
+                # Clean observations
+                with self.metrics.timer('clean', rows_before = len(data)) as span:
+                    data = self.clean_obs(data)
+                    span['rows_after'] = len(data)
+                self.metrics.count('rows_clean', len(data))
+
+                # Attach magnitudes uncertainties
+                data = attach_mag_uncertainty(data)
+
+                if self.pi:
+                    # Correct parallaxes offset
+                    with self.metrics.timer('correction'):
+                        data = correct_parallaxes(data)
+
+                # Columns of the parallax correction are not needed anymore
+                data = data.drop(columns = [column for column in PARALLAX_COLUMNS if column in data.columns and column not in self.columns])
+
+            if previous is not None:
+                data = merge_obs(previous, data, ['source_id'])
+
+            if return_data:
+                self.metrics.finish(self.metrics_callback, self.metrics_file)
+                data.attrs['metrics'] = self.metrics.as_dict()
+                return data
+            else:
+                # Save observations
+                self.save_obs(data)
+                self.metrics.finish(self.metrics_callback, self.metrics_file)
 
 
 class FindGaiaQuery():
@@ -395,7 +606,9 @@ class FindGaiaQuery():
     def __init__(self, columns: str = "", path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None,
                 lite = None,
                 correct_parallax: bool = True,
-                get_mag_uncertainty: bool = False) -> None:
+                get_mag_uncertainty: bool = False,
+                metrics_file: str = None, metrics_callback = None, tracer = None, journal = None,
+                keep_results: bool = False, retry: RetryPolicy = None, batch_size: int = 50000, workers: int = 4) -> None:
         """
         Initialize the class
 
@@ -410,6 +623,22 @@ class FindGaiaQuery():
                 Toggle verbose (1 or 0). Default to 0.
             name (str, optional):
                 Name of the catalog. Default name is 'observations_2mass_{bvalue}_{lvalue}_{psize}'
+            metrics_file (str, optional):
+                JSON-lines file to which the metrics of each call to query_obs are appended. Default to None.
+            metrics_callback (callable, optional):
+                Function called with the QueryMetrics of each call to query_obs. Default to None.
+            tracer (Tracer, optional):
+                Tracer in which each phase of the query is recorded as a span. Default to None.
+            journal (JobJournal, optional):
+                Journal of the submitted jobs, used to reuse the jobs of a previous run that stopped mid-way. Default to None.
+            keep_results (bool, optional):
+                Keep the jobs on the server once their results are downloaded. Default to False, jobs are deleted.
+            retry (RetryPolicy, optional):
+                Policy used to retry the requests failing with a transient error (5xx status, connection lost, ...). Default to RetryPolicy().
+            batch_size (int, optional):
+                Maximum number of source_id uploaded in a single job by query_obs. Longer lists are split in several jobs. Default to 50000.
+            workers (int, optional):
+                Number of jobs run at the same time when a list of source_id is split. Default to 4.
         """
 
         self.host = "gea.esac.esa.int"
@@ -437,10 +666,30 @@ class FindGaiaQuery():
                         FROM gaiadr3.gaia_source{'_lite' if lite else ''}
                         WHERE """
 
+        # Query used for lists of source_id, uploaded as a table and joined on source_id
+        self.upload_query = f"""SELECT {user_columns}
+                        FROM gaiadr3.gaia_source{'_lite' if lite else ''}
+                        JOIN TAP_UPLOAD.source_ids AS up ON gaiadr3.gaia_source{'_lite' if lite else ''}.source_id = up.id
+                        """
+
         self.path = path
         self.proxy = proxy
         self.verbose = verbose
         self.filename = name
+        self.columns = columns
+        self.metrics_file = metrics_file
+        self.metrics_callback = metrics_callback
+        self.tracer = tracer
+        self.journal = journal
+        self.keep_results = keep_results
+        self.retry = retry
+        self.batch_size = batch_size
+        self.workers = workers
+        self.metrics = QueryMetrics('gaia_query', tracer = tracer)
+        self.tap = TapService(self.host, self.port, self.pathinfo, proxy = proxy, verbose = verbose, journal = journal, keep_results = keep_results, retry = retry,
+                              params = {"REQUEST": "doQuery", "LANG": "ADQL", "FORMAT": "csv", "PHASE": "RUN",
+                                        "JOBNAME": "Any name (optional)", "JOBDESCRIPTION": "Any description (optional)"},
+                              headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"})
 
         if not self.verbose:
             warnings.filterwarnings("ignore")
@@ -448,142 +697,83 @@ class FindGaiaQuery():
         if self.path == None:
             self.path = str(pathlib.Path().resolve())
 
-        self.correct_parallax = correct_parallax
+        self.correct_parallax = correct_parallax and "parallax" in columns
 
-    def query_obs(self, condition: str) -> pd.DataFrame:
+    def query_ids(self, source_ids, condition: str = "") -> pd.DataFrame:
         """
-        Make a query to gaia archive to retreive gaia flux in G, B and R bands
-        and their uncertainty, as well as the longitude and lattitude of each
-        source.
-        The returned data correspond to a square of size psize centered on the 
-        coordinates (lvalue, bvalue).
+        Get the sources of a list of source_id. The list is uploaded as a table of int64 (TAP_UPLOAD)
+        and joined on source_id, instead of being written in the query. Lists longer than batch_size
+        are split in several jobs, run in parallel.
 
         Args:
-            condition (str): 
-                Condition to apply to the query, for example "gaiadr3.gaia_source.l BETWEEN 10 AND 20 AND gaiadr3.gaia_source.b BETWEEN -5 AND 5"
+            source_ids (array-like): Gaia DR3 source_id to get
+            condition (str, optional): Additional condition to apply to the query. Default to "".
 
         Returns:
             pd.DataFrame: Dataframe containing the data
         """
 
-        query = self.query + condition
-
-        # Encode the query
-        params = urllib.urlencode({\
-            "REQUEST": "doQuery", \
-            "LANG":    "ADQL", \
-            "FORMAT":  "csv", \
-            "PHASE":  "RUN", \
-            "JOBNAME":  "Any name (optional)", \
-            "JOBDESCRIPTION":  "Any description (optional)", \
-            "QUERY":   f"{query}"
-            })
-
-        headers = {\
-            "Content-type": "application/x-www-form-urlencoded", \
-            "Accept":       "text/plain" \
-            }
-
-        # Use proxy if needed
-        if self.proxy != None:
-            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-            connection.set_tunnel(self.host, self.port)
-        else:
-            connection=httplib.HTTPSConnection(self.host, self.port)
+        source_ids = np.unique(np.asarray(source_ids, dtype=np.int64)).tolist()
+        chunks = [source_ids[start:start + self.batch_size] for start in range(0, len(source_ids), self.batch_size)]
+        query = self.upload_query + (f"WHERE {condition}" if condition != "" else "")
 
-        # Send the query
-        connection.request("POST", self.pathinfo, params, headers)
+        def run(chunk):
+            upload = write_votable("source_ids", {"id": ("long", chunk)})
+            return self.tap.run(query, self.metrics, uploads = {"source_ids": upload})
 
-        #Status
-        response = connection.getresponse()
-        if self.verbose:
-            print ("Status: " +str(response.status), "Reason: " + str(response.reason))
+        if len(chunks) <= 1:
+            return run(chunks[0] if len(chunks) == 1 else [])
 
-        #Server job location (URL)
-        location = response.getheader("location")
-        if self.verbose:
-            print ("Location: " + location)
+        with futures.ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "gaia") as executor:
+            parts = list(executor.map(run, chunks))
 
-        #Jobid
-        jobid = location[location.rfind('/')+1:]
-        if self.verbose:
-            print ("Job id: " + jobid)
-
-        connection.close()
-
-        # Check job status, wait until finished
-        while True:
-            # Use proxy if needed
-            if self.proxy != None:
-                connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-                connection.set_tunnel(self.host, self.port)
-            else:
-                connection=httplib.HTTPSConnection(self.host, self.port)
-
-            connection.request("GET", self.pathinfo + "/" + jobid)
-            response = connection.getresponse()
-            data = response.read()
-            dom = parseString(data)
-            phaseElement = dom.getElementsByTagName('uws:phase')[0]
-            phaseValueElement = phaseElement.firstChild
-            phase = phaseValueElement.toxml()
-            if self.verbose:
-                print ("Status: " + phase)
-            #Check finished
-            if phase == 'COMPLETED': break
+        return pd.concat(parts, ignore_index = True)
 
-            if phase == 'ERROR':
-                print("Critical failure: Error during the query")
-                print(data)
-                exit()
-
-            #wait and repeat
-            time.sleep(0.2)
+    def query_obs(self, condition: str = "", source_ids = None) -> pd.DataFrame:
+        """
+        Make a query to gaia archive to retreive gaia flux in G, B and R bands
+        and their uncertainty, as well as the longitude and lattitude of each
+        source.
+        The returned data correspond to a square of size psize centered on the 
+        coordinates (lvalue, bvalue).
 
-        connection.close()
+        Args:
+            condition (str): 
+                Condition to apply to the query, for example "gaiadr3.gaia_source.l BETWEEN 10 AND 20 AND gaiadr3.gaia_source.b BETWEEN -5 AND 5"
+            source_ids (array-like, optional):
+                Only get these source_id, uploaded as a table (see query_ids). The condition is then optional. Default to None.
 
-        # Get results
-        if self.verbose:
-            print("Retrieving data...")
+        Returns:
+            pd.DataFrame: Dataframe containing the data
+        """
 
-        # Use proxy if needed
-        if self.proxy != None:
-            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-            connection.set_tunnel(self.host, self.port)
+        if source_ids is None:
+            self.metrics = QueryMetrics('gaia_query', tracer = self.tracer, condition = condition)
+            data = self.tap.run(self.query + condition, self.metrics)
         else:
-            connection=httplib.HTTPSConnection(self.host, self.port)
-
-        connection.request("GET", self.pathinfo + "/" + jobid + "/results/result")
-        response = connection.getresponse()
-
-        data = response.read().decode('iso-8859-1')
-        data = data.split()
-        data = list((csv.reader(data, delimiter=',')))
-        data = pd.DataFrame(data[1:], columns = data[0])
-        data = data.replace(r'^\s*$', np.nan, regex=True)
-        # data_temp = data['source_id'].astype(int)
-        # data = data.astype(float)
-        # data['source_id'] = data_temp
-        # del data_temp
-
-        connection.close()
+            self.metrics = QueryMetrics('gaia_query', tracer = self.tracer, condition = condition, nb_source_ids = len(source_ids))
+            data = self.query_ids(source_ids, condition)
 
         if self.get_mag_uncertainty:
             data = attach_mag_uncertainty(data)
 
         if self.correct_parallax:
-            data = correct_parallaxes(data)
+            with self.metrics.timer('correction'):
+                data = correct_parallaxes(data)
 
             # Remove columns used for parallax correction if they are not in the user requested columns
-            if "nu_eff_used_in_astrometry" not in columns:
+            if "nu_eff_used_in_astrometry" not in self.columns:
                 data.drop(columns=["nu_eff_used_in_astrometry"], inplace=True)
-            if "pseudocolour" not in columns:
+            if "pseudocolour" not in self.columns:
                 data.drop(columns=["pseudocolour"], inplace=True)
-            if "ecl_lat" not in columns:
+            if "ecl_lat" not in self.columns:
                 data.drop(columns=["ecl_lat"], inplace=True)
-            if "astrometric_params_solved" not in columns:
+            if "astrometric_params_solved" not in self.columns:
                 data.drop(columns=["astrometric_params_solved"], inplace=True)
 
+        self.metrics.finish(self.metrics_callback, self.metrics_file)
+        data.attrs['metrics'] = self.metrics.as_dict()
+
         return data
 
 
@@ -593,17 +783,30 @@ def main() -> int:
     """
     # Arguments definition
     parser = argparse.ArgumentParser()
-    parser.add_argument('-l', type = float, required = True, help = "Square center value in Galactic longitude (deg)")
-    parser.add_argument('-b', type = float, required = True, help = "Square center value in Galactic latitude (deg)")
+    parser.add_argument('-l', type = float, required = False, help = "Square center value in Galactic longitude (deg). Required if -moc is not used", default = None)
+    parser.add_argument('-b', type = float, required = False, help = "Square center value in Galactic latitude (deg). Required if -moc is not used", default = None)
     parser.add_argument('-p', type = float, required = False, help = "Pixel size (arcminute)", default = 5)
     parser.add_argument('-v', type = int, required = False, help = "Verbose", default = 0)
     parser.add_argument('-d', type = str, required = False, help = "Working directory", default = None)
     parser.add_argument('-n', type = str, required = False, help = "Name of the output file", default = None)
     parser.add_argument('-proxy', type = str, required = False, help = "Proxy to use host:port", default = None)
+    parser.add_argument('-metrics', type = str, required = False, help = "JSON-lines file to which the query metrics are appended", default = None)
+    parser.add_argument('-trace', type = str, required = False, help = "File in which the Chrome trace-event JSON of the query is written", default = None)
+    parser.add_argument('-journal', type = str, required = False, help = "Journal of the submitted jobs, used to resume a run that stopped mid-way", default = None)
+    parser.add_argument('-keep', type = int, required = False, help = "Keep the jobs on the server once their results are downloaded", default = 0)
+    parser.add_argument('-retries', type = int, required = False, help = "Maximum number of attempts of a request failing with a transient error", default = 5)
     parser.add_argument('-pi', type = int, required=False, help = "Apply offset correction to the parallaxes", default = 1)
+    parser.add_argument('-moc', type = str, required = False, help = "FITS or JSON MOC file of the coverage to get instead of a pixel", default = None)
+    parser.add_argument('-grow', type = int, required = False, help = "Only download the part of the pixel not covered by the hdf5 files of the working directory, and merge it with their sources", default = 0)
+    parser.add_argument('-columns', type = str, required = False, help = "Columns of gaia_source to retreive in addition to the default ones, as 'column1,column2,...'", default = None)
+    parser.add_argument('-compact', type = int, required = False, help = "Hold and write the magnitudes, errors and parallaxes as float32", default = 0)
+    parser.add_argument('-lite', type = int, required = False, help = "Query gaia_source_lite (1) or gaia_source (0). Default to gaia_source_lite if it has all the columns needed", default = None)
 
     # Get arguments value
     args = parser.parse_args()
+    if args.moc == None and (args.l == None or args.b == None):
+        parser.error("-l and -b are required if -moc is not used")
+    columns = [column for column in args.columns.split(',') if column.strip() != ''] if args.columns != None else None
     long = args.l
     latt = args.b
     psize = args.p
@@ -617,8 +820,20 @@ def main() -> int:
     else:
         proxy = None
 
-    fgaia = Findgaia(lvalue = long, bvalue = latt, path = path, psize = psize, proxy = proxy, verbose = verbose, name = name, pi = pi)
-    fgaia.get_obs()
+    tracer = Tracer(args.trace) if args.trace != None else None
+    journal = JobJournal(args.journal, verbose = args.v) if args.journal != None else None
+
+    fgaia = Findgaia(lvalue = long, bvalue = latt, path = path, psize = psize, proxy = proxy, verbose = verbose, name = name, pi = pi, metrics_file = args.metrics, tracer = tracer, journal = journal, keep_results = args.keep,
+                        retry = RetryPolicy(max_attempts = args.retries, verbose = verbose), grow = args.grow, moc = args.moc,
+                        columns = columns, lite = bool(args.lite) if args.lite != None else None, compact = args.compact)
+    try:
+        fgaia.get_obs()
+    except ObsfinderError as error:
+        print(f"Error: {error}")
+        return 1
+    finally:
+        if tracer != None:
+            tracer.write()
 
     return 0
 
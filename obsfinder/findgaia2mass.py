@@ -1,25 +1,47 @@
 #!/usr/bin/env python3
 
-from xml.dom.minidom import parseString
-import http.client as httplib
-import urllib.parse as urllib
-from zero_point import zpt
-import pandas as pd
-import numpy as np
+from __future__ import annotations
+from .metrics import QueryMetrics
+from .tap import TapService
+from .tracing import Tracer
+from .journal import JobJournal
+from .errors import ObsfinderError, QueryError
+from .retry import RetryPolicy
+from .lazy import lazy_import
+from .findgaia import Findgaia, load_zpt_tables, read_obs
+from .find2mass import Find2mass
+from .xmatch import cross_match
+from .votable import write_votable
+from .catalog import write_index
+from .dtypes import column_dtype, cast_columns
+from .coverage import pixel_boxes, subtract_boxes, find_previous, find_previous_moc, read_previous, merge_obs, write_coverage, write_moc
+from .moc import MOC, GAIA_ORDER, source_id_conditions
 import argparse
 import warnings
 import pathlib
-import h5py
-import time
-import csv
 import sys
 
+zpt = lazy_import("zero_point.zpt")
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+h5py = lazy_import("h5py")
+futures = lazy_import("concurrent.futures")
+
+# Column of the data written in each dataset of the hdf5 file of Findgaia2mass
+DATASETS = {'source_id': 'source_id', 'BP': 'phot_bp_mean_mag', 'BP_err': 'phot_bp_mean_mag_error', 'G': 'phot_g_mean_mag',
+            'G_err': 'phot_g_mean_mag_error', 'RP': 'phot_rp_mean_mag', 'RP_err': 'phot_rp_mean_mag_error',
+            'parallax': 'parallax', 'parallax_err': 'parallax_error', 'J': 'j_m', 'J_err': 'j_msigcom', 'H': 'h_m',
+            'H_err': 'h_msigcom', 'K': 'ks_m', 'K_err': 'ks_msigcom', 'l': 'l', 'b': 'b'}
+
 class Findgaia2mass():
     """
     This class contains tools to query the Gaia archive and retreive data from Gaia DR3 and 2MASS cross match.
     """
     
-    def __init__(self, lvalue: float, bvalue: float, psize: float, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None, pi: int = 1) -> None:
+    def __init__(self, lvalue: float, bvalue: float, psize: float, path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None, pi: int = 1,
+                metrics_file: str = None, metrics_callback = None, tracer = None, journal = None,
+                keep_results: bool = False, retry: RetryPolicy = None, local: bool = False, radius: float = 1., best_neighbour: str = "first",
+                gaia_data = None, grow: bool = False, moc = None, compact: bool = False, batch_size: int = 50000, workers: int = 4) -> None:
         """
         Initialize the class
 
@@ -40,6 +62,45 @@ class Findgaia2mass():
                 Name of the catalog. Default name is 'observations_gaia_{bvalue}_{lvalue}_{psize}.csv'
             pi (int, optional):
                 Apply offset correction to the parallaxes. Default to 1, parallaxes are corrected.
+            metrics_file (str, optional):
+                JSON-lines file to which the metrics of each call to get_obs are appended. Default to None.
+            metrics_callback (callable, optional):
+                Function called with the QueryMetrics of each call to get_obs. Default to None.
+            tracer (Tracer, optional):
+                Tracer in which the pixel and each phase of the query are recorded as spans. Default to None.
+            journal (JobJournal, optional):
+                Journal of the submitted jobs, used to reuse the jobs of a previous run that stopped mid-way. Default to None.
+            keep_results (bool, optional):
+                Keep the jobs on the server once their results are downloaded. Default to False, jobs are deleted.
+            retry (RetryPolicy, optional):
+                Policy used to retry the requests failing with a transient error (5xx status, connection lost, ...). Default to RetryPolicy().
+            local (bool, optional):
+                Cross-match Gaia and 2MASS locally (see cross_match_obs) instead of using the cross-match tables of the Gaia archive. Default to False.
+            radius (float, optional):
+                Maximum separation of a Gaia source and its 2MASS counterpart in the local cross-match (in arcsecond). Default to 1.
+            best_neighbour (str, optional):
+                Selection of the counterparts in the local cross-match: 'first' (nearest 2MASS source of each Gaia source) or 'mutual'
+                (pairs of sources nearest to each other). Default to 'first'.
+            gaia_data (pd.DataFrame or str, optional):
+                Gaia sources of the pixel, already cleaned and corrected: data returned by Findgaia.get_obs, or path of the hdf5 file
+                it wrote (see findgaia.read_obs). Only the 2MASS counterparts of these sources are then downloaded (see reuse_gaia_obs).
+                Default to None.
+            grow (bool, optional):
+                Reuse the hdf5 file of the working directory covering the largest part of the pixel (see previous_obs): only the part of
+                the pixel it does not cover is downloaded, and the output file holds the sources of both. Not used with local or gaia_data.
+                Default to False.
+            moc (MOC or str, optional):
+                Coverage map (or path of a FITS or JSON MOC file) to get instead of the pixel (see query_moc). With grow, the file of the
+                working directory whose coverage map has the largest intersection with it is reused. Not used with gaia_data, and
+                cannot be used with local (QueryError). Default to None.
+            compact (bool, optional):
+                Hold and write the magnitudes, errors and parallaxes as float32, and the flags as small integers, the coordinates
+                staying float64 (see dtypes.column_dtype), which roughly halves the memory and the size of the output file. Default to False (float64).
+            batch_size (int, optional):
+                Maximum number of source_id of gaia_data uploaded in a single job by reuse_gaia_obs. Longer lists are split in several jobs.
+                Default to 50000.
+            workers (int, optional):
+                Number of jobs run at the same time when the source_id of gaia_data are split. Default to 4.
         """
 
         self.host = "gea.esac.esa.int"
@@ -57,6 +118,16 @@ class Findgaia2mass():
                 xjoin.original_psc_source_id = tmass.designation \
                 WHERE \
                 tmass.ext_key IS NULL AND "
+
+        # Query of the 2MASS counterparts of a list of source_id, uploaded as a table
+        self.xmatch_query = "SELECT xmatch.source_id, \
+                tmass.j_m, tmass.j_msigcom, tmass.h_m, tmass.h_msigcom, tmass.ks_m, tmass.ks_msigcom \
+                FROM gaiadr3.tmass_psc_xsc_best_neighbour AS xmatch \
+                JOIN gaiadr3.tmass_psc_xsc_join AS xjoin USING (clean_tmass_psc_xsc_oid) \
+                JOIN gaiadr1.tmass_original_valid AS tmass ON \
+                xjoin.original_psc_source_id = tmass.designation \
+                JOIN TAP_UPLOAD.source_ids AS up ON xmatch.source_id = up.id \
+                WHERE tmass.ext_key IS NULL"
         self.lvalue = lvalue
         self.bvalue = bvalue
         self.path = path
@@ -65,6 +136,30 @@ class Findgaia2mass():
         self.verbose = verbose
         self.filename = name
         self.pi = pi
+        self.metrics_file = metrics_file
+        self.metrics_callback = metrics_callback
+        self.tracer = tracer
+        self.journal = journal
+        self.keep_results = keep_results
+        self.retry = retry
+        if local and moc is not None:
+            raise QueryError("The local cross-match (local) only works on a pixel, not on a coverage map (moc)")
+        self.local = local
+        self.radius = radius
+        self.best_neighbour = best_neighbour
+        self.gaia_data = gaia_data
+        self.grow = grow
+        self.moc = MOC.read(moc) if isinstance(moc, str) else moc
+        self.compact = compact
+        self.batch_size = batch_size
+        self.workers = workers
+        self.coverage = None
+        self.delivered = None
+        self.metrics = QueryMetrics('gaia2mass', tracer = tracer, lvalue = lvalue, bvalue = bvalue, psize = psize)
+        self.tap = TapService(self.host, self.port, self.pathinfo, proxy = proxy, verbose = verbose, journal = journal, keep_results = keep_results, retry = retry,
+                              params = {"REQUEST": "doQuery", "LANG": "ADQL", "FORMAT": "csv", "PHASE": "RUN",
+                                        "JOBNAME": "Any name (optional)", "JOBDESCRIPTION": "Any description (optional)"},
+                              headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"})
 
         if not self.verbose:
             warnings.filterwarnings("ignore")
@@ -72,7 +167,7 @@ class Findgaia2mass():
         if self.path == None:
             self.path = str(pathlib.Path().resolve())
 
-    def query_obs(self, lmin: float, lmax: float) -> pd.DataFrame:
+    def query_obs(self, lmin: float, lmax: float, bmin: float = None, bmax: float = None) -> pd.DataFrame:
         """
         Make a query to gaia archive to retreive gaia flux in G, B and R bands
         and their uncertainty, as well as the longitude and lattitude of each
@@ -85,119 +180,139 @@ class Findgaia2mass():
                 Lowest value in longitude (in degree)
             lmax (float):
                 Highest value in longitude (in degree)
+            bmin (float, optional):
+                Lowest value in latitude (in degree). Default to the bottom of the pixel.
+            bmax (float, optional):
+                Highest value in latitude (in degree). Default to the top of the pixel.
 
         Returns:
             pd.DataFrame: Dataframe containing the data
         """
 
+        bmin = bmin if bmin != None else self.bvalue - self.psize/2
+        bmax = bmax if bmax != None else self.bvalue + self.psize/2
         zone = f"gaia.l BETWEEN {lmin} AND {lmax} \
-                 AND gaia.b BETWEEN {self.bvalue - self.psize/2} AND {self.bvalue + self.psize/2}"
-            
-        query = self.query + zone
+                 AND gaia.b BETWEEN {bmin} AND {bmax}"
 
-        # Encode the query
-        params = urllib.urlencode({\
-            "REQUEST": "doQuery", \
-            "LANG":    "ADQL", \
-            "FORMAT":  "csv", \
-            "PHASE":  "RUN", \
-            "JOBNAME":  "Any name (optional)", \
-            "JOBDESCRIPTION":  "Any description (optional)", \
-            "QUERY":   f"{query}"
-            })
-
-        headers = {\
-            "Content-type": "application/x-www-form-urlencoded", \
-            "Accept":       "text/plain" \
-            }
-
-        # Use proxy if needed
-        if self.proxy != None:
-            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-            connection.set_tunnel(self.host, self.port)
-        else:
-            connection=httplib.HTTPSConnection(self.host, self.port)
+        return self.query_zone(zone)
 
-        # Send the query
-        connection.request("POST", self.pathinfo, params, headers)
+    def query_moc(self, moc: MOC) -> pd.DataFrame:
+        """
+        Make queries to gaia archive to retreive the sources of a coverage map. The sources are selected by
+        ranges of source_id, which holds the index of their HEALPix cell of order 12, so that each source of
+        the coverage is downloaded once. Cells finer than order 12 are then applied to the sources.
 
-        #Status
-        response = connection.getresponse()
-        if self.verbose:
-            print ("Status: " +str(response.status), "Reason: " + str(response.reason))
+        Args:
+            moc (MOC):
+                Coverage map of the sources
 
-        #Server job location (URL)
-        location = response.getheader("location")
-        if self.verbose:
-            print ("Location: " + location)
+        Returns:
+            pd.DataFrame: Dataframe containing the data
+        """
 
-        #Jobid
-        jobid = location[location.rfind('/')+1:]
-        if self.verbose:
-            print ("Job id: " + jobid)
+        conditions = source_id_conditions(moc, "gaia.source_id")
+        self.metrics.count('moc_queries', len(conditions))
 
-        connection.close()
+        data = pd.concat([self.query_zone(condition) for condition in conditions], ignore_index=True)
 
+        if moc.max_order > GAIA_ORDER:
+            data = data[moc.contains(data['l'], data['b'], frame = 'galactic')]
 
-        # Check job status, wait until finished
-        while True:
-            # Use proxy if needed
-            if self.proxy != None:
-                connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-                connection.set_tunnel(self.host, self.port)
-            else:
-                connection=httplib.HTTPSConnection(self.host, self.port)
-
-            connection.request("GET", self.pathinfo + "/" + jobid)
-            response = connection.getresponse()
-            data = response.read()
-            dom = parseString(data)
-            phaseElement = dom.getElementsByTagName('uws:phase')[0]
-            phaseValueElement = phaseElement.firstChild
-            phase = phaseValueElement.toxml()
-            if self.verbose:
-                print ("Status: " + phase)
-            #Check finished
-            if phase == 'COMPLETED': break
-
-            if phase == 'ERROR':
-                print("Critical failure: Error during the query")
-                print(data)
-                exit()
-
-            #wait and repeat
-            time.sleep(0.2)
-
-        connection.close()
-
-        # Get results
-        if self.verbose:
-            print("Retrieving data...")
+        return data
 
-        # Use proxy if needed
-        if self.proxy != None:
-            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-            connection.set_tunnel(self.host, self.port)
-        else:
-            connection=httplib.HTTPSConnection(self.host, self.port)
+    def query_zone(self, zone: str) -> pd.DataFrame:
+        """
+        Make a query to gaia archive to retreive the sources of a zone
 
-        connection.request("GET", self.pathinfo + "/" + jobid + "/results/result")
-        response = connection.getresponse()
+        Args:
+            zone (str):
+                ADQL condition selecting the sources
+
+        Returns:
+            pd.DataFrame: Dataframe containing the data
+        """
 
-        data = response.read().decode('iso-8859-1')
-        data = data.split()
-        data = list((csv.reader(data, delimiter=',')))
-        data = pd.DataFrame(data[1:], columns = data[0])
-        data = data.replace(r'^\s*$', np.nan, regex=True)
-        # data_temp = data['source_id'].astype(int)
-        data = data.astype(float)
-        # data['source_id'] = data_temp
-        # del data_temp
+        query = self.query + zone
 
-        connection.close()
+        data = self.tap.run(query, self.metrics)
+
+        with self.metrics.timer('parse'):
+            # source_id does not fit in a float
+            data = cast_columns(data, compact = self.compact)
 
         return data
     
+    def reuse_gaia_obs(self) -> pd.DataFrame:
+        """
+        Add the 2MASS photometry to Gaia sources already downloaded and corrected (gaia_data). Only the
+        source_id of these sources are uploaded, and only their 2MASS counterparts are downloaded, instead
+        of all the Gaia columns of the pixel. Lists longer than batch_size are split in several jobs, run in parallel.
+
+        Returns:
+            pd.DataFrame: Gaia sources having a 2MASS counterpart, with the columns of the archive cross-match
+        """
+
+        gaia = read_obs(self.gaia_data) if isinstance(self.gaia_data, str) else self.gaia_data
+
+        source_ids = np.unique(np.asarray(gaia["source_id"], dtype = np.int64)).tolist()
+        chunks = [source_ids[start:start + self.batch_size] for start in range(0, len(source_ids), self.batch_size)]
+
+        def run(chunk):
+            upload = write_votable("source_ids", {"id": ("long", chunk)})
+            return self.tap.run(self.xmatch_query, self.metrics, uploads = {"source_ids": upload})
+
+        if len(chunks) <= 1:
+            tmass = run(chunks[0] if len(chunks) == 1 else [])
+        else:
+            with futures.ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "gaia2mass") as executor:
+                tmass = pd.concat(list(executor.map(run, chunks)), ignore_index = True)
+
+        with self.metrics.timer('clean', rows_before = len(tmass)) as span:
+            tmass = tmass.dropna(subset = ["j_m", "j_msigcom", "h_m", "h_msigcom", "ks_m", "ks_msigcom"])
+            tmass = cast_columns(tmass, compact = self.compact)
+            data = gaia.astype({"source_id": np.int64}).merge(tmass.astype({"source_id": np.int64}), on = "source_id", how = "inner")
+            span['rows_after'] = len(data)
+        self.metrics.count('rows_clean', len(data))
+
+        return data
+
+    def cross_match_obs(self) -> pd.DataFrame:
+        """
+        Get the Gaia sources of the pixel with Findgaia and the 2MASS sources with Find2mass, both queries
+        running at the same time on their own archive, then match each Gaia source to its nearest 2MASS
+        source within the radius (see xmatch.cross_match). The 2MASS zone is enlarged by the radius, so
+        that the counterparts of the sources on the edges of the pixel are found.
+        The Gaia data are cleaned, and corrected if pi is set, by Findgaia.
+
+        Returns:
+            pd.DataFrame: Matched sources, with the columns of the archive cross-match
+        """
+
+        options = dict(path = self.path, proxy = self.proxy, verbose = self.verbose, tracer = self.tracer, journal = self.journal,
+                       keep_results = self.keep_results, retry = self.retry, compact = self.compact)
+        fgaia = Findgaia(self.lvalue, self.bvalue, self.psize * 60, pi = self.pi, **options)
+        # Same 2MASS sources as the cross-match of the archive: no source that is part of an extended source
+        f2mass = Find2mass(self.lvalue, self.bvalue, self.psize * 60 + 2 * self.radius / 60, condition = "ext_key IS NULL", **options)
+
+        with futures.ThreadPoolExecutor(max_workers = 2, thread_name_prefix = "gaia2mass") as executor:
+            gaia = executor.submit(fgaia.get_obs, return_data = True)
+            tmass = executor.submit(f2mass.get_obs, return_data = True)
+            gaia, tmass = gaia.result(), tmass.result()
+
+        self.metrics.merge(fgaia.metrics)
+        self.metrics.merge(f2mass.metrics)
+
+        with self.metrics.timer('xmatch', rows_gaia = len(gaia), rows_2mass = len(tmass)) as span:
+            index_gaia, index_2mass, _ = cross_match(gaia["l"], gaia["b"], tmass["glon"], tmass["glat"],
+                                                     radius = self.radius, best_neighbour = self.best_neighbour)
+            tmass = tmass.iloc[index_2mass][["j_m", "j_msigcom", "h_m", "h_msigcom", "k_m", "k_msigcom"]]
+            tmass = tmass.rename(columns = {"k_m": "ks_m", "k_msigcom": "ks_msigcom"}).reset_index(drop = True)
+            data = pd.concat([gaia.iloc[index_gaia].reset_index(drop = True), tmass], axis = 1)
+            span['matches'] = len(data)
+        self.metrics.count('matches', len(data))
+
+        return data
+
     def clean_obs(self, data: pd.DataFrame) -> pd.DataFrame:
         """
         Clean the observationnal data
@@ -240,18 +355,22 @@ class Findgaia2mass():
             data (pd.DataFrame): Data to save
         """
 
-        if self.filename == None:
+        if self.filename == None and self.moc is not None:
+            # Name of the output file, identified by its coverage map
+            self.filename = f"{self.path}/observations_gaia2mass_moc_{self.moc.digest()}.hdf5"
+        elif self.filename == None:
             # Name of the output file
             self.filename = f"{self.path}/observations_gaia2mass_{self.bvalue:.6f}_{self.lvalue:.6f}_{self.psize:.6f}.hdf5"
         else:
             self.filename = f"{self.path}/{self.filename}"
 
-        if self.filename.split('.')[-1] == 'hdf5':
-            self.write_hdf5(data)
-        else:
-            data = data[['phot_bp_mean_mag', 'phot_bp_mean_mag_error', 'phot_g_mean_mag', 'phot_g_mean_mag_error', 'phot_rp_mean_mag', 'phot_rp_mean_mag_error', 'parallax', 'parallax_error',
-                         'j_m', 'j_msigcom', 'h_m', 'h_msigcom', 'ks_m', 'ks_msigcom', 'l', 'b']]
-            np.savetxt(self.filename, data, header="BP,BP_err,G,G_err,RP,RP_err,parallax,parallax_err,J,J_err,H,H_err,K,K_err,l,b", delimiter=',', comments='')
+        with self.metrics.timer('write', rows = len(data)):
+            if self.filename.split('.')[-1] == 'hdf5':
+                self.write_hdf5(data)
+            else:
+                data = data[['phot_bp_mean_mag', 'phot_bp_mean_mag_error', 'phot_g_mean_mag', 'phot_g_mean_mag_error', 'phot_rp_mean_mag', 'phot_rp_mean_mag_error', 'parallax', 'parallax_error',
+                             'j_m', 'j_msigcom', 'h_m', 'h_msigcom', 'ks_m', 'ks_msigcom', 'l', 'b']]
+                np.savetxt(self.filename, data, header="BP,BP_err,G,G_err,RP,RP_err,parallax,parallax_err,J,J_err,H,H_err,K,K_err,l,b", delimiter=',', comments='')
 
         if self.verbose:
             print('Done!')
@@ -261,22 +380,71 @@ class Findgaia2mass():
 
     def write_hdf5(self, data: pd.DataFrame) -> None:
         with h5py.File(self.filename, 'w') as f:
-            f.create_dataset('BP', data=data['phot_bp_mean_mag'], dtype = float)
-            f.create_dataset('BP_err', data=data['phot_bp_mean_mag_error'], dtype = float)
-            f.create_dataset('G', data=data['phot_g_mean_mag'], dtype = float)
-            f.create_dataset('G_err', data=data['phot_g_mean_mag_error'], dtype = float)
-            f.create_dataset('RP', data=data['phot_rp_mean_mag'], dtype = float)
-            f.create_dataset('RP_err', data=data['phot_rp_mean_mag_error'], dtype = float)
-            f.create_dataset('parallax', data=data['parallax'], dtype = float)
-            f.create_dataset('parallax_err', data=data['parallax_error'], dtype = float)
-            f.create_dataset('J', data = data['j_m'], dtype = float)
-            f.create_dataset('J_err', data = data['j_msigcom'], dtype = float)
-            f.create_dataset('H', data = data['h_m'], dtype = float)
-            f.create_dataset('H_err', data = data['h_msigcom'], dtype = float)
-            f.create_dataset('K', data = data['ks_m'], dtype = float)
-            f.create_dataset('K_err', data = data['ks_msigcom'])
-            f.create_dataset('l', data=data['l'], dtype = float)
-            f.create_dataset('b', data=data['b'], dtype = float)
+            self.write_datasets(f, data)
+            if self.coverage != None:
+                write_coverage(f, 'gaia2mass', self.coverage, **self.options())
+            if self.delivered is not None:
+                write_moc(f, 'gaia2mass', self.delivered, **self.options())
+
+    def options(self) -> dict:
+        """
+        Options recorded in the output file, that a file must have been written with to be reused by previous_obs
+
+        Returns:
+            dict: Parallax correction, cross-match, and compact mode if set
+        """
+
+        options = dict(pi = int(self.pi), local = int(self.local))
+        if self.compact:
+            options['compact'] = 1
+
+        return options
+
+    def write_datasets(self, group, data: pd.DataFrame) -> None:
+        """
+        Write the columns of the output file as datasets of an hdf5 file or group
+
+        Args:
+            group (h5py.Group): File or group in which the datasets are created
+            data (pd.DataFrame): Data to write (sorted by cell of the grid index before being written)
+        """
+
+        order = write_index(group, data['l'], data['b'])
+        data = data.iloc[order]
+
+        for dataset, column in DATASETS.items():
+            group.create_dataset(dataset, data = data[column], dtype = column_dtype(column, self.compact))
+
+    def previous_obs(self, boxes: list = None, moc: MOC = None) -> tuple[pd.DataFrame, list]:
+        """
+        Find the hdf5 file of the working directory covering the largest part of the pixel, or of the coverage map, among the files
+        written by Findgaia2mass with the same parallax correction and cross-match (see coverage.find_previous and find_previous_moc),
+        and read its sources
+
+        Args:
+            boxes (list, optional): Boxes covered by the pixel (see coverage.pixel_boxes). Default to None.
+            moc (MOC, optional): Coverage map, used instead of the boxes. Default to None.
+
+        Returns:
+            tuple[pd.DataFrame, list]: Sources of the file (None if there is none), and boxes (or MOC) covered by the file
+        """
+
+        if moc is not None:
+            filename, coverage = find_previous_moc(self.path, 'gaia2mass', moc, **self.options())
+        else:
+            filename, coverage = find_previous(self.path, 'gaia2mass', boxes, **self.options())
+        if filename == None:
+            return None, coverage
+
+        with self.metrics.timer('reuse', filename = filename) as span:
+            data = read_previous(filename, DATASETS)
+            span['rows'] = len(data)
+        self.metrics.count('rows_reused', len(data))
+
+        if self.verbose:
+            print(f"Reusing the {len(data)} sources of {filename}")
+
+        return data, coverage
 
     def maglimList(data: np.ndarray, level: int, percentile: float) -> np.ndarray:
         """
@@ -346,12 +514,12 @@ class Findgaia2mass():
     
     def correct_parallaxes(self, data: pd.DataFrame) -> pd.DataFrame:
 
-        zpt.load_tables()
+        load_zpt_tables()
         zero_point = zpt.get_zpt(data["phot_g_mean_mag"], data["nu_eff_used_in_astrometry"],
                    data["pseudocolour"],data["ecl_lat"],
                    data["astrometric_params_solved"], _warnings=True)
 
-        data["parallax"] -= zero_point
+        data["parallax"] = (data["parallax"] - zero_point).astype(data["parallax"].dtype)
 
         return data
         
@@ -363,42 +531,76 @@ class Findgaia2mass():
             return_data (bool): Whether to return the data or save it directly. Default is False
 
         Returns:
-            pd.DataFrame: DataFrame with one row per object. Columns with multiple values are stored as lists. Only returned if return_data is True
+            pd.DataFrame: DataFrame with one row per object. Columns with multiple values are stored as lists. Only returned if return_data is True.
+                          The metrics of the query are available in its attrs['metrics'].
         """
 
-        # If longitude zone definition contains negative and positive longitudes
-        if self.lvalue - self.psize/2 < 0 and self.lvalue + self.psize/2 > 0:
-            if self.verbose:
-                print("Query split in two parts")
-
-            data_part1 = self.query_obs(360 + self.lvalue - self.psize/2, 360)
-            data_part2 = self.query_obs(0, self.lvalue + self.psize/2)
+        self.metrics = QueryMetrics('gaia2mass', tracer = self.tracer, lvalue = self.lvalue, bvalue = self.bvalue, psize = self.psize * 60)
 
-            data = pd.concat([data_part1, data_part2], ignore_index=True)
-        
-        # If longitude zone definition is entirely inferior to 0
-        elif self.lvalue - self.psize/2 < 0 and self.lvalue + self.psize/2 <= 0:
-            if self.verbose:
-                print("Negative longitude range, aborting")
-                exit()
-        
+        with self.metrics.span('pixel', catalog = 'gaia2mass', lvalue = self.lvalue, bvalue = self.bvalue, psize = self.psize * 60):
+            previous = None
 
-        # If zone definition is in the range [0, 360]
-        else:
-            data = self.query_obs(self.lvalue - self.psize/2, self.lvalue + self.psize/2)
+            # 2MASS counterparts of Gaia sources already cleaned and corrected
+            if self.gaia_data is not None:
+                data = self.reuse_gaia_obs()
 
-        # Clean observations
-        data = self.clean_obs(data)
+            # Local cross-match of the Gaia and 2MASS sources, already cleaned and corrected
+            elif self.local:
+                data = self.cross_match_obs()
 
-        # Attach magnitudes uncertainties
-        data = self.attach_mag_uncertainty(data)
+            # Sources of the coverage map, minus the part already downloaded
+            elif self.moc is not None:
+                previous, delivered = self.previous_obs(moc = self.moc) if self.grow else (None, MOC())
+                missing = self.moc - delivered
+                data = self.query_moc(missing) if not missing.is_empty() else None
+                self.delivered = delivered | self.moc
 
-        if self.pi:
-            # Correct parallaxes offset
-            data = self.correct_parallaxes(data)
+            # If longitude zone definition is entirely inferior to 0
+            elif self.lvalue - self.psize/2 < 0 and self.lvalue + self.psize/2 <= 0:
+                raise QueryError(f"Negative longitude range ({self.lvalue - self.psize/2} to {self.lvalue + self.psize/2}), longitudes must be in [0, 360]")
 
-        # Save observations
-        self.save_obs(data)
+            # Zone split in two parts if it contains negative and positive longitudes, minus the part already downloaded
+            else:
+                boxes = pixel_boxes(self.lvalue, self.bvalue, self.psize)
+                previous, coverage = self.previous_obs(boxes) if self.grow else (None, [])
+                missing = subtract_boxes(boxes, coverage)
+                self.metrics.count('boxes', len(missing))
+
+                if self.verbose and len(missing) > 1:
+                    print(f"Query split in {len(missing)} parts")
+
+                data = pd.concat([self.query_obs(*box) for box in missing], ignore_index=True) if len(missing) > 0 else None
+                self.coverage = coverage + missing
+
+            if not self.local and self.gaia_data is None and data is not None:
+                # Clean observations
+                with self.metrics.timer('clean', rows_before = len(data)) as span:
+                    data = self.clean_obs(data)
+                    span['rows_after'] = len(data)
+                self.metrics.count('rows_clean', len(data))
+
+                # Attach magnitudes uncertainties
+                data = self.attach_mag_uncertainty(data)
+
+                if self.pi:
+                    # Correct parallaxes offset
+                    with self.metrics.timer('correction'):
+                        data = self.correct_parallaxes(data)
+
+                # Columns of the parallax correction are not needed anymore
+                data = data.drop(columns = ["nu_eff_used_in_astrometry", "pseudocolour", "ecl_lat", "astrometric_params_solved"])
+
+            if previous is not None:
+                data = merge_obs(previous, data, ['source_id'])
+
+            if return_data:
+                self.metrics.finish(self.metrics_callback, self.metrics_file)
+                data.attrs['metrics'] = self.metrics.as_dict()
+                return data
+            else:
+                # Save observations
+                self.save_obs(data)
+                self.metrics.finish(self.metrics_callback, self.metrics_file)
         
 
 def main() -> int:
@@ -407,17 +609,33 @@ def main() -> int:
     """
     # Arguments definition
     parser = argparse.ArgumentParser()
-    parser.add_argument('-l', type = float, required = True, help = "Square center value in Galactic longitude (deg)")
-    parser.add_argument('-b', type = float, required = True, help = "Square center value in Galactic latitude (deg)")
+    parser.add_argument('-l', type = float, required = False, help = "Square center value in Galactic longitude (deg). Required if -moc is not used", default = None)
+    parser.add_argument('-b', type = float, required = False, help = "Square center value in Galactic latitude (deg). Required if -moc is not used", default = None)
     parser.add_argument('-p', type = float, required = False, help = "Pixel size (arcminute)", default = 5)
     parser.add_argument('-v', type = int, required = False, help = "Verbose", default = 0)
     parser.add_argument('-d', type = str, required = False, help = "Working directory", default = None)
     parser.add_argument('-n', type = str, required = False, help = "Name of the output file", default = None)
     parser.add_argument('-proxy', type = str, required = False, help = "Proxy to use host:port", default = None)
+    parser.add_argument('-metrics', type = str, required = False, help = "JSON-lines file to which the query metrics are appended", default = None)
+    parser.add_argument('-trace', type = str, required = False, help = "File in which the Chrome trace-event JSON of the query is written", default = None)
+    parser.add_argument('-journal', type = str, required = False, help = "Journal of the submitted jobs, used to resume a run that stopped mid-way", default = None)
+    parser.add_argument('-keep', type = int, required = False, help = "Keep the jobs on the server once their results are downloaded", default = 0)
+    parser.add_argument('-retries', type = int, required = False, help = "Maximum number of attempts of a request failing with a transient error", default = 5)
     parser.add_argument('-pi', type = int, required=False, help = "Apply offset correction to the parallaxes", default = 1)
+    parser.add_argument('-local', type = int, required = False, help = "Cross-match Gaia and 2MASS locally instead of using the cross-match tables of the Gaia archive", default = 0)
+    parser.add_argument('-radius', type = float, required = False, help = "Maximum separation of the sources matched locally (arcsecond)", default = 1.)
+    parser.add_argument('-gaiafile', type = str, required = False, help = "hdf5 file written by pyfindgaia for the same pixel: only the 2MASS counterparts of its sources are downloaded", default = None)
+    parser.add_argument('-moc', type = str, required = False, help = "FITS or JSON MOC file of the coverage to get instead of a pixel", default = None)
+    parser.add_argument('-grow', type = int, required = False, help = "Only download the part of the pixel not covered by the hdf5 files of the working directory, and merge it with their sources", default = 0)
+    parser.add_argument('-compact', type = int, required = False, help = "Hold and write the magnitudes, errors and parallaxes as float32", default = 0)
+    parser.add_argument('-best', type = str, required = False, help = "Selection of the counterparts matched locally: 'first' (nearest 2MASS source of each Gaia source) or 'mutual'", default = "first")
 
     # Get arguments value
     args = parser.parse_args()
+    if args.moc == None and (args.l == None or args.b == None):
+        parser.error("-l and -b are required if -moc is not used")
+    if args.moc != None and args.local:
+        parser.error("-local cannot be used with -moc")
     long = args.l
     latt = args.b
     psize = args.p
@@ -431,8 +649,20 @@ def main() -> int:
     else:
         proxy = None
 
-    fgaia = Findgaia2mass(lvalue = long, bvalue = latt, path = path, psize = psize, proxy = proxy, verbose = verbose, name = name, pi = pi)
-    fgaia.get_obs()
+    tracer = Tracer(args.trace) if args.trace != None else None
+    journal = JobJournal(args.journal, verbose = args.v) if args.journal != None else None
+
+    fgaia = Findgaia2mass(lvalue = long, bvalue = latt, path = path, psize = psize, proxy = proxy, verbose = verbose, name = name, pi = pi, metrics_file = args.metrics, tracer = tracer, journal = journal, keep_results = args.keep,
+                        retry = RetryPolicy(max_attempts = args.retries, verbose = verbose), local = args.local, radius = args.radius, best_neighbour = args.best,
+                        gaia_data = args.gaiafile, grow = args.grow, moc = args.moc, compact = args.compact)
+    try:
+        fgaia.get_obs()
+    except ObsfinderError as error:
+        print(f"Error: {error}")
+        return 1
+    finally:
+        if tracer != None:
+            tracer.write()
 
     return 0
 
@@ -1,15 +1,23 @@
-from xml.dom.minidom import parseString
-import http.client as httplib
-import urllib.parse as urllib
-import pandas as pd
-import numpy as np
+from __future__ import annotations
+
+from .metrics import QueryMetrics
+from .tap import TapService
+from .tracing import Tracer
+from .journal import JobJournal
+from .errors import ObsfinderError
+from .retry import RetryPolicy
+from .votable import write_votable
+from .idcache import IdentifierCache, normalize_identifier
+from .lazy import lazy_import
 import argparse
 import pathlib
-import h5py
-import time
-import csv
 import sys
 
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+h5py = lazy_import("h5py")
+futures = lazy_import("concurrent.futures")
+
 def _compact_values(values: list) -> object:
     values = [value for value in values if pd.notna(value)]
     if len(values) == 0:
@@ -27,12 +35,60 @@ def _as_list(value: object) -> list:
         return []
     return [value]
 
+def _is_numeric(series: pd.Series) -> bool:
+    """
+    Whether a column only holds numbers (scalars or lists of numbers), missing values aside
+
+    Args:
+        series (pd.Series): Column to check
+
+    Returns:
+        bool: True if the column can be stored as float
+    """
+
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return True
+    return pd.api.types.infer_dtype(series.explode(), skipna = True) in ("integer", "floating", "mixed-integer-float", "empty")
+
+def _group_values(data: pd.DataFrame, key: str) -> pd.DataFrame:
+    """
+    Group the rows sharing the same key into a single row. A column with several distinct values
+    in a group is stored as a list (see _compact_values). Groups made of a single row, the most
+    common case, are kept as they are, so that only the duplicated keys are aggregated.
+
+    Args:
+        data (pd.DataFrame): Data to group
+        key (str): Column used as key. Rows without key are dropped.
+
+    Returns:
+        pd.DataFrame: One row per key, in the order of their first occurrence. Columns without any value are dropped.
+    """
+
+    data = data[data[key].notna()]
+    sizes = data.groupby(key, sort=False)[key].transform("size")
+
+    parts = [data[sizes == 1]]
+    if (sizes > 1).any():
+        parts.append(data[sizes > 1].groupby(key, sort=False)
+                     .agg(lambda series: _compact_values(series.dropna().unique().tolist())).reset_index())
+
+    grouped = pd.concat(parts, ignore_index = True)
+
+    # Restore the order of first occurrence
+    first = pd.Series(np.arange(data[key].nunique()), index = data[key].drop_duplicates().to_numpy())
+    grouped = grouped.iloc[np.argsort(grouped[key].map(first).to_numpy(), kind = "stable")].reset_index(drop = True)
+
+    return grouped.dropna(axis = 1, how = "all")
+
 class FindSimbad():
     """
     This class contains tools to query Simbad and retreive some data given an object name.
     """
     
-    def __init__(self, columns: str = "", mag: str = "", path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None) -> None:
+    def __init__(self, columns: str = "", mag: str = "", path: str = None, proxy: tuple[str, int] = None, verbose: int = 0, name: str = None,
+                metrics_file: str = None, metrics_callback = None, tracer = None, journal = None,
+                keep_results: bool = False, retry: RetryPolicy = None, batch_size: int = 10000, workers: int = 4,
+                gaia_ident: bool = True, layout: str = "groups", cache: IdentifierCache = None) -> None:
         """
         Initialize the class
 
@@ -49,25 +105,61 @@ class FindSimbad():
                 Toggle verbose (1 or 0). Default to 0.
             name (str, optional):
                 Name of the catalog. Default name is 'observations_2mass_{bvalue}_{lvalue}_{psize}'
+            metrics_file (str, optional):
+                JSON-lines file to which the metrics of each call to get_obs are appended. Default to None.
+            metrics_callback (callable, optional):
+                Function called with the QueryMetrics of each call to get_obs. Default to None.
+            tracer (Tracer, optional):
+                Tracer in which each phase of the queries is recorded as a span. Default to None.
+            journal (JobJournal, optional):
+                Journal of the submitted jobs, used to reuse the jobs of a previous run that stopped mid-way. Default to None.
+            keep_results (bool, optional):
+                Keep the jobs on the server once their results are downloaded. Default to False, jobs are deleted.
+            retry (RetryPolicy, optional):
+                Policy used to retry the requests failing with a transient error (5xx status, connection lost, ...). Default to RetryPolicy().
+            batch_size (int, optional):
+                Maximum number of identifiers (or Gaia source_id in get_obs_with_gaia) uploaded in a single job. Longer lists are split in several jobs. Default to 10000.
+            workers (int, optional):
+                Number of jobs run at the same time when a list of identifiers is split. Default to 4.
+            gaia_ident (bool, optional):
+                Get the Gaia DR3 identifier of each object from a second join on ident, so that the server only returns
+                this identifier. If False, the full list of identifiers (ids.ids) is downloaded and the Gaia DR3 identifier
+                is extracted from it. Default to True.
+            layout (str, optional):
+                Layout of the file written by save_obs: 'groups' (one group per object) or 'columnar' (one dataset per column,
+                with offsets for the columns with multiple values). Default to 'groups'.
+            cache (IdentifierCache, optional):
+                Persistent cache of the identifiers already resolved. Only the identifiers missing from the cache are queried. Default to None.
         """
 
         self.host = "simbad.u-strasbg.fr"
         self.port = 443
         self.pathinfo = "/simbad/sim-tap/async"
 
-        base_columns = ["basic.OID", "ident.id", "ident.oidref", "ids.ids"]
+        if layout not in ("groups", "columnar"):
+            raise ValueError(f"Unknown layout '{layout}', use 'groups' or 'columnar'")
+        self.layout = layout
+
+        if gaia_ident:
+            base_columns = ["basic.OID", "ident.id", "ident.oidref", "gaia.id AS gaiadr3"]
+            ids_join = "LEFT OUTER JOIN ident AS gaia ON gaia.oidref = basic.oid AND gaia.id LIKE 'Gaia DR3 %'"
+            if "ids." in str(columns):
+                ids_join += "\n LEFT OUTER JOIN ids ON ids.oidref = ident.oidref"
+        else:
+            base_columns = ["basic.OID", "ident.id", "ident.oidref", "ids.ids"]
+            ids_join = "LEFT OUTER JOIN ids ON ids.oidref = ident.oidref"
         extra_joins = ""
 
         if mag != "":
-            # mag_column = mag.strip()
-            extra_joins = """\n LEFT OUTER JOIN flux ON flux.oidref = basic.oid\n
-                            LEFT OUTER JOIN filter on filter.filtername = flux.filter\n"""
-
-            self.extra_query = f"""AND filter.filtername IN ({', '.join([f"'{band.strip()}'" for band in mag])})"""
-            self.mag = mag #mag_column.split(',')
-            mag_columns = ["filter.filtername", "flux.flux", "flux.flux_err"]
+            # One join on flux per band, so that the server returns one row per object, with the columns 'band' and 'band_err'
+            self.mag = [band.strip() for band in mag]
+            mag_columns = []
+            for index, band in enumerate(self.mag):
+                # Aliases by position: the filters of Simbad differ by case (U and u), unlike ADQL identifiers
+                alias = f"f_{index}"
+                extra_joins += f"\n LEFT OUTER JOIN flux AS {alias} ON {alias}.oidref = basic.oid AND {alias}.filter = '{band}'"
+                mag_columns += [f'{alias}.flux AS "{band}"', f'{alias}.flux_err AS "{band}_err"']
         else:
-            self.extra_query = ""
             self.mag = []
             mag_columns = []
 
@@ -79,12 +171,12 @@ class FindSimbad():
             non_basic_columns = np.unique(non_basic_columns)
 
             if len(non_basic_columns) > 0:
-                extra_joins += "\n ".join([f"LEFT OUTER JOIN {col} ON {col}.oidref = basic.oid" for col in non_basic_columns])
+                extra_joins += "".join([f"\n LEFT OUTER JOIN {col} ON {col}.oidref = basic.oid" for col in non_basic_columns])
 
             self.query = f"""SELECT {query_columns} 
                             FROM basic 
                             LEFT OUTER JOIN ident ON ident.oidref = basic.oid 
-                            LEFT OUTER JOIN ids ON ids.oidref = ident.oidref
+                            {ids_join}
                             {extra_joins}
                             WHERE """
         else:
@@ -92,25 +184,49 @@ class FindSimbad():
             self.query = f"""SELECT {query_columns} 
                             FROM basic 
                             LEFT OUTER JOIN ident ON ident.oidref = basic.oid 
-                            LEFT OUTER JOIN ids ON ids.oidref = ident.oidref 
+                            {ids_join}
                             {extra_joins}
                             WHERE """
+
+        # Query used for lists of identifiers, uploaded as a table and joined with ident
+        self.upload_query = f"""SELECT {query_columns}
+                            FROM TAP_UPLOAD.identifiers AS up
+                            JOIN ident ON ident.id = up.id
+                            JOIN basic ON basic.oid = ident.oidref
+                            {ids_join}
+                            {extra_joins}"""
+
+        # Same query, also returning the name uploaded for each row and the main identifier of the object, used to file the
+        # rows in the identifier cache
+        self.cache_query = self.upload_query.replace(f"SELECT {query_columns}", f"SELECT {query_columns}, up.id AS query_id, basic.main_id AS query_main_id", 1)
     
         self.path = path
         self.proxy = proxy
         self.verbose = verbose
         self.filename = name
+        self.metrics_file = metrics_file
+        self.metrics_callback = metrics_callback
+        self.tracer = tracer
+        self.journal = journal
+        self.keep_results = keep_results
+        self.retry = retry
+        self.batch_size = batch_size
+        self.workers = workers
+        self.cache = cache
+        self.metrics = QueryMetrics('simbad', tracer = tracer)
+        self.tap = TapService(self.host, self.port, self.pathinfo, proxy = proxy, verbose = verbose, journal = journal, keep_results = keep_results, retry = retry,
+                              params = {"LANG": "ADQL", "FORMAT": "csv", "PHASE": "RUN", "REQUEST": "doQuery"},
+                              headers = {"Content-type": "application/x-www-form-urlencoded", "Accept": "text/plain"},
+                              phase_tag = "phase", poll_interval = 0.5, priority = "interactive")
 
         if self.path == None:
             self.path = str(pathlib.Path().resolve())
 
     def query_obs(self, identifier: str) -> pd.DataFrame:
         """
-        Make a query to simbad to retreive 2mas J, H an K bands,
-        their uncertainty, as well as the longitude and lattitude of each
-        source.
-        The returned data correspond to a square of size psize centered on the 
-        coordinates (lvalue, bvalue).
+        Make a query to simbad to retreive the data of one or several objects. If an identifier cache
+        is set, only the identifiers missing from the cache (or expired) are queried, and the rows
+        returned by Simbad are added to the cache.
 
         Args:
             identifier (str): Object name to query, or list of object names to query. If list, object must be defined as ["object1", "object2", ...]
@@ -119,111 +235,78 @@ class FindSimbad():
             pd.DataFrame: Dataframe containing the data
         """
 
-        if type(identifier) == list:
-            identifier = [id.strip() for id in identifier]
-            query = " OR ".join([f"(ident.id = '{id}' {self.extra_query})" for id in identifier])
-        else:
-            query = f"ident.id = '{identifier}'"
-            
-        query = self.query + query
-
-        print(query)
-
-        # Encode the query
-        params = urllib.urlencode({
-        "QUERY":   f"{query}", \
-        "LANG":   "ADQL", \
-        "FORMAT":  "csv", \
-        "PHASE":  "RUN", \
-        "REQUEST": "doQuery"
-        })
-
-        # Use proxy if needed
-        if self.proxy != None:
-            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-            connection.set_tunnel(self.host, self.port)
-        else:
-            connection=httplib.HTTPSConnection(self.host, self.port)
-
-        headers = {\
-            "Content-type": "application/x-www-form-urlencoded", \
-            "Accept":       "text/plain" \
-            }
+        if self.cache is None:
+            return self.fetch_obs(identifier)
 
-        # Send the query
-        connection.request("POST", self.pathinfo, params, headers)
+        # Only the keys of the cache are normalized, the names are sent to Simbad as they were given
+        identifiers = identifier if type(identifier) == list else [identifier]
+        identifiers = list(dict.fromkeys(id.strip() for id in identifiers))
+        keys = {id: normalize_identifier(id) for id in identifiers}
+        unique_keys = list(dict.fromkeys(keys.values()))
 
-        #Status
-        response = connection.getresponse()
+        with self.metrics.timer('cache', identifiers = len(unique_keys)) as span:
+            cached, missing_keys = self.cache.lookup(self.upload_query, unique_keys)
+            span['hits'] = len(unique_keys) - len(missing_keys)
+        self.metrics.count('cache_hits', len(unique_keys) - len(missing_keys))
+        self.metrics.count('cache_misses', len(missing_keys))
 
         if self.verbose:
-            print ("Status: " +str(response.status), "Reason: " + str(response.reason))
+            print(f"{len(unique_keys) - len(missing_keys)} identifiers found in the cache, {len(missing_keys)} to query")
 
-        #Server job location (URL)
-        location = response.getheader("location")
-        if self.verbose:
-            print ("Location: " + location)
+        if len(missing_keys) == 0:
+            return cached
 
-        #Jobid
-        jobid = location[location.rfind('/')+1:]
-        if self.verbose:
-            print ("Job id: " + jobid)
+        missing_keys = set(missing_keys)
+        misses = [id for id in identifiers if keys[id] in missing_keys]
+        data = self.fetch_obs(misses, query = self.cache_query)
 
-        connection.close()
+        # Rows filed under the name they were returned for, not under the identifier matched by Simbad
+        queried = data.pop("query_id") if "query_id" in data.columns else pd.Series(index = data.index, dtype = object)
+        main_ids = data.pop("query_main_id") if "query_main_id" in data.columns else pd.Series(index = data.index, dtype = object)
+        self.cache.store(self.upload_query, list(dict.fromkeys(keys[id] for id in misses)), data, queried.map(normalize_identifier), main_ids)
 
+        if cached is None:
+            return data
 
-        # Check job status, wait until finished
-        while True:
-            # Use proxy if needed
-            if self.proxy != None:
-                connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-                connection.set_tunnel(self.host, self.port)
-            else:
-                connection=httplib.HTTPSConnection(self.host, self.port)
-
-            connection.request("GET", self.pathinfo + "/" + jobid)
-            response = connection.getresponse()
-            data = response.read()
-            dom = parseString(data)
-            phaseElement = dom.getElementsByTagName('phase')[0]
-            phaseValueElement = phaseElement.firstChild
-            phase = phaseValueElement.toxml()
-            if self.verbose:
-                print ("Status: " + phase)
-            #Check finished
-            if phase == 'COMPLETED': break
-
-            if phase == 'ERROR':
-                print("Critical failure: Error during the query")
-                exit()
-
-            #wait and repeat
-            time.sleep(0.5)
-
-        connection.close()
-
-        # Get results
-        if self.verbose:
-            print("Retrieving data...")
+        return pd.concat([cached, data], ignore_index = True)
 
-        # Use proxy if needed
-        if self.proxy != None:
-            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
-            connection.set_tunnel(self.host, self.port)
-        else:
-            connection=httplib.HTTPSConnection(self.host, self.port)
+    def fetch_obs(self, identifier: str, query: str = None) -> pd.DataFrame:
+        """
+        Query simbad for one or several objects, without using the identifier cache.
+
+        A list of object names is uploaded as a table (TAP_UPLOAD) and joined with the identifiers
+        of Simbad. Lists longer than batch_size are split in several jobs, run in parallel.
+
+        Args:
+            identifier (str): Object name to query, or list of object names to query. If list, object must be defined as ["object1", "object2", ...]
+            query (str, optional): Query run for a list of object names. Default to self.upload_query.
+
+        Returns:
+            pd.DataFrame: Dataframe containing the data
+        """
+
+        if type(identifier) == list:
+            identifier = list(dict.fromkeys(id.strip() for id in identifier))
+            chunks = [identifier[start:start + self.batch_size] for start in range(0, len(identifier), self.batch_size)]
+
+            def run(chunk):
+                upload = write_votable("identifiers", {"id": ("char", chunk)})
+                return self.tap.run(query if query != None else self.upload_query, self.metrics, uploads = {"identifiers": upload})
+
+            if len(chunks) == 1:
+                return run(chunks[0])
 
-        connection.request("GET", self.pathinfo + "/" + jobid + "/results/result")
-        response = connection.getresponse()
+            with futures.ThreadPoolExecutor(max_workers = self.workers, thread_name_prefix = "simbad") as executor:
+                parts = list(executor.map(run, chunks))
 
-        data = response.read().decode('iso-8859-1')
-        data = data.split()
-        data = list((csv.reader(data, delimiter=',')))
-        data = pd.DataFrame(data[1:], columns = data[0])
-        data = data.replace(r'^\s*$', np.nan, regex=True)
-        # data = data.astype(float)
+            return pd.concat(parts, ignore_index = True)
+
+        query = self.query + f"ident.id = '{identifier}'"
+
+        if self.verbose:
+            print(query)
 
-        connection.close()
+        data = self.tap.run(query, self.metrics)
 
         return data
     
@@ -242,53 +325,24 @@ class FindSimbad():
             print('Cleaning data...')
 
         # Keep only ident.id, ident.oidref and user defined columns if they exist
-        columns_to_keep = [col for col in data.columns if col not in ["oid", "id", "oidref", "ids"]]
+        columns_to_keep = [col for col in data.columns if col not in ["oid", "id", "oidref", "ids", "gaiadr3"]]
         id_data = data.get("id")
         
         cleaned_data = pd.DataFrame()
         cleaned_data['id'] = id_data
         
-        # Extract Gaia DR3 IDs for all rows
-        gaia_ids = data["ids"].apply(lambda x: next((item for item in str(x).split('|') if "GaiaDR3" in item), None))
-        cleaned_data['GaiaDR3'] = gaia_ids
+        # Gaia DR3 IDs for all rows, as 'GaiaDR3<source_id>', either returned by the server ('Gaia DR3 <source_id>')
+        # or extracted from the list of identifiers
+        gaia_column = "gaiadr3" if "gaiadr3" in data.columns else "ids"
+        gaia_ids = data[gaia_column].astype(str).str.extract(r"Gaia\s*DR3\s*(\d+)", expand=False)
+        cleaned_data['GaiaDR3'] = "GaiaDR3" + gaia_ids
         
         # Add user-defined columns if not all NaN
         for col in columns_to_keep:
             if (col in data.columns) & (not data[col].isnull().all()):
                     cleaned_data[col] = data[col]
 
-        # Clean duplicates due to one row per magnitude for simbad query
-        if "filtername" in cleaned_data.columns and len(self.mag) > 0:
-            # Keep as grouping keys all columns except the magnitude triplet
-            key_cols = [c for c in cleaned_data.columns if c not in ["filtername", "flux", "flux_err"]]
-
-            pivot = cleaned_data.pivot_table(
-                index=key_cols,
-                columns="filtername",
-                values=["flux", "flux_err"],
-                aggfunc="first"
-            )
-
-            # Flatten MultiIndex columns: ('flux','J') -> 'J', ('flux_err','J') -> 'J_err'
-            pivot.columns = [
-                f"{band}" if val == "flux" else f"{band}_err"
-                for val, band in pivot.columns
-            ]
-
-            new_cleaned_data = pivot.reset_index()
-
-            # Order columns: keys then bands in the order given by self.mag (if present)
-            band_cols = [c for band in self.mag for c in (band, f"{band}_err")]
-            ordered = [c for c in key_cols + band_cols if c in new_cleaned_data.columns]
-            new_cleaned_data = new_cleaned_data[ordered]
-        else:
-            new_cleaned_data = cleaned_data
-
-        for col in new_cleaned_data.columns:
-            if isinstance(new_cleaned_data[col].iloc[0], list):
-                new_cleaned_data[col] = new_cleaned_data[col].apply(lambda x: _compact_values(x) if isinstance(x, list) else x)
-
-        return new_cleaned_data
+        return cleaned_data
         
     def write_hdf5(self, data: pd.DataFrame) -> None:
         """
@@ -317,36 +371,68 @@ class FindSimbad():
             return_data (bool): Whether to return the data or save it directly. Default is False.
         """
 
+        self.metrics = QueryMetrics('simbad', tracer = self.tracer, nb_identifiers = len(identifier) if type(identifier) == list else 1)
+
         # Get data
         data = self.query_obs(identifier)
 
         # Clean data
-        data = self.clean_obs(data)
+        with self.metrics.timer('clean', rows_before = len(data)) as span:
+            data = self.clean_obs(data)
+            span['rows_after'] = len(data)
+        self.metrics.count('rows_clean', len(data))
 
         if return_data:
+            self.metrics.finish(self.metrics_callback, self.metrics_file)
+            data.attrs['metrics'] = self.metrics.as_dict()
             return data
         else:
             # Save observations
             self.save_obs(data)
+            self.metrics.finish(self.metrics_callback, self.metrics_file)
 
-    def convert_str_to_float(self, data: pd.DataFrame):
+    def merge_gaia(self, data_obs: pd.DataFrame, data_gaia: pd.DataFrame) -> pd.DataFrame:
         """
-        Convert columns in the DataFrame that are strings but represent numeric values to float.
+        Add the Gaia data to each object, joining the Gaia source_id on the GaiaDR3 identifiers of the
+        objects. An object with several Gaia identifiers gets, for each column, the value of the last
+        matching source (in the order of data_gaia) having one.
 
         Args:
-            data (pd.DataFrame): DataFrame to convert
+            data_obs (pd.DataFrame): Simbad data, one row per object
+            data_gaia (pd.DataFrame): Gaia data, with a source_id column
 
         Returns:
-            pd.DataFrame: DataFrame with converted columns
+            pd.DataFrame: Simbad data with the Gaia columns added
         """
-        for column in data.columns:
-            if pd.api.types.is_string_dtype(data[column]):
-                try:
-                    data[column] = pd.to_numeric(data[column], errors='raise')
-                except ValueError:
-                    # If conversion fails, keep the column as string
-                    continue
-        return data
+
+        if "GaiaDR3" not in data_obs.columns:
+            return data_obs
+
+        # One row per source, ranked by their last occurrence in data_gaia
+        gaia = _group_values(data_gaia, "source_id")
+        last = data_gaia["source_id"].drop_duplicates(keep = "last")
+        rank = pd.Series(np.arange(len(last)), index = last.to_numpy())
+        gaia.index = "GaiaDR3" + gaia["source_id"].astype(str)
+        gaia["_rank"] = gaia["source_id"].map(rank).to_numpy()
+
+        # Object / Gaia identifier pairs
+        links = data_obs["GaiaDR3"].map(_as_list).explode().dropna()
+        links = links.to_frame("key").join(gaia.drop(columns = "source_id"), on = "key", how = "inner")
+        if links.empty:
+            return data_obs
+
+        # Last non empty value of each column for each object
+        links = links.sort_values("_rank", kind = "stable")
+        values = links.drop(columns = ["key", "_rank"]).groupby(level = 0, sort = False).last()
+
+        for column in values.columns:
+            column_values = values[column].reindex(data_obs.index)
+            if column in data_obs.columns:
+                data_obs[column] = column_values.where(column_values.notna(), data_obs[column])
+            else:
+                data_obs[column] = column_values
+
+        return data_obs
 
     def get_obs_with_gaia(self, identifier, gaia_columns: list, gaia_condition: str = "", lite: bool = True, correct_parallax: bool = False,
                             get_mag_uncertainty: bool = True, return_data: bool = False) -> pd.DataFrame:
@@ -377,92 +463,70 @@ class FindSimbad():
                 if self.verbose:
                     print("Warning: Parallax correction requires querying the full Gaia DR3 catalog.")
 
+        self.metrics = QueryMetrics('simbad', tracer = self.tracer, nb_identifiers = len(identifier) if type(identifier) == list else 1)
+
         # Get data from simbad
         data_simbad = self.query_obs(identifier)
 
-        print(data_simbad)
+        if self.verbose:
+            print(data_simbad)
 
         # Clean data
-        data_simbad = self.clean_obs(data_simbad)
+        with self.metrics.timer('clean', rows_before = len(data_simbad)) as span:
+            data_simbad = self.clean_obs(data_simbad)
+            span['rows_after'] = len(data_simbad)
 
         # Gaia Ids
         gaia_ids = data_simbad["GaiaDR3"].dropna().unique()
-        gaia_ids = [r.replace("GaiaDR3", "") for r in gaia_ids]
+        gaia_ids = [int(r.replace("GaiaDR3", "")) for r in gaia_ids]
 
-        object_rows = []
-        for obj_id, group in data_simbad.groupby("id", sort=False):
-            row = {"id": obj_id}
-
-            for column in group.columns:
-                if column == "id":
-                    continue
-
-                values = group[column].dropna().unique().tolist()
-                if len(values) > 0:
-                    row[column] = _compact_values(values)
-
-            object_rows.append(row)
-
-        data_obs = pd.DataFrame(object_rows)
+        # One row per object
+        data_obs = _group_values(data_simbad, "id")
+        self.metrics.count('rows_clean', len(data_obs))
 
         if len(gaia_ids) == 0:
+            self.metrics.finish(self.metrics_callback, self.metrics_file)
             return data_obs
 
-        # Make gaia condition to get data only for those gaia ids
-        gaia_condition = f"gaiadr3.gaia_source{'_lite' if lite else ''}.source_id IN ({', '.join(map(str, gaia_ids))})" + (f" AND {gaia_condition}" if gaia_condition != "" else "")
-
         gaia_columns = ["source_id"] + gaia_columns
 
         # Get data from gaia
-        fgq = FindGaiaQuery(columns = gaia_columns, path = self.path, proxy = self.proxy, verbose = self.verbose, name = self.filename, lite = lite, correct_parallax = correct_parallax, get_mag_uncertainty = get_mag_uncertainty)
-        data_gaia = fgq.query_obs(gaia_condition)
+        fgq = FindGaiaQuery(columns = gaia_columns, path = self.path, proxy = self.proxy, verbose = self.verbose, name = self.filename, lite = lite, correct_parallax = correct_parallax, get_mag_uncertainty = get_mag_uncertainty,
+                            metrics_file = self.metrics_file, metrics_callback = self.metrics_callback, tracer = self.tracer,
+                            journal = self.journal, keep_results = self.keep_results, retry = self.retry,
+                            batch_size = self.batch_size, workers = self.workers)
+        # Lookups of identified objects are served before the bulk queries of the pixels
+        fgq.tap.priority = self.tap.priority
+
+        # Get data only for those gaia ids, uploaded as a table
+        data_gaia = fgq.query_obs(gaia_condition, source_ids = gaia_ids)
 
         if data_gaia.empty:
+            self.metrics.finish(self.metrics_callback, self.metrics_file)
             return data_obs
 
-        # Add the Gaia data to each object
-        for gaia_obj_id in data_gaia["source_id"]:
-            for obj_idx, row in data_obs.iterrows():
-                gaia_ids_for_object = _as_list(row.get("GaiaDR3", []))
-                if f"GaiaDR3{gaia_obj_id}" in gaia_ids_for_object:
-                    for column in data_gaia.columns:
-                        if column != "source_id":
-                            gaia_values = data_gaia[data_gaia["source_id"] == gaia_obj_id][column].dropna().unique().tolist()
-                            if len(gaia_values) > 0:
-                                data_obs.at[obj_idx, column] = _compact_values(gaia_values)
-
-        data_obs = self.convert_str_to_float(data_obs)
+        with self.metrics.timer('merge', rows = len(data_obs)):
+            data_obs = self.merge_gaia(data_obs, data_gaia)
 
         if return_data:
+            self.metrics.finish(self.metrics_callback, self.metrics_file)
+            data_obs.attrs['metrics'] = self.metrics.as_dict()
             return data_obs
         else:
             self.save_obs(data_obs)
+            self.metrics.finish(self.metrics_callback, self.metrics_file)
 
 
-    def save_obs(self, data: pd.DataFrame, filename: str = None) -> None:
+    def obs_filename(self, filename: str = None) -> str:
         """
-        Save the data from get_obs_with_gaia to an HDF5 file with hierarchical structure.
-        Creates one group per object, with datasets for each column.
-        Numeric values (scalars or lists) are stored as float64. Strings stay as strings.
+        Name of the file written by save_obs
 
         Args:
-            data (pd.DataFrame): DataFrame returned from get_obs_with_gaia
             filename (str, optional): Output file path. Uses self.filename if not provided.
-        """
 
-        # Merge duplicate rows for the same object id, if any
-        if "id" in data.columns and data["id"].duplicated().any():
-            object_rows = []
-            for obj_id, group in data.groupby("id", sort=False):
-                row = {"id": obj_id}
-                for col in group.columns:
-                    if col == "id":
-                        continue
-                    values = group[col].dropna().tolist()
-                    if len(values) > 0:
-                        row[col] = _compact_values(values)
-                object_rows.append(row)
-            data = pd.DataFrame(object_rows)
+        Returns:
+            str: Path of the hdf5 file
+        """
 
         if filename is None:
             if self.filename:
@@ -472,10 +536,52 @@ class FindSimbad():
         elif not filename.endswith('.hdf5'):
             filename = f"{filename}.hdf5"
 
+        return filename
+
+    def save_obs(self, data: pd.DataFrame, filename: str = None) -> None:
+        """
+        Save the data from get_obs_with_gaia to an HDF5 file, with the layout defined by self.layout:
+        - 'groups': one group per object, with datasets for each column.
+        - 'columnar': one dataset per column (see write_columnar).
+        Numeric columns (scalars or lists) are stored as float64, the other ones as strings.
+
+        Args:
+            data (pd.DataFrame): DataFrame returned from get_obs_with_gaia
+            filename (str, optional): Output file path. Uses self.filename if not provided.
+        """
+
+        # Merge duplicate rows for the same object id, if any
+        if "id" in data.columns and data["id"].duplicated().any():
+            data = _group_values(data, "id")
+
+        filename = self.obs_filename(filename)
+
         if self.verbose:
             print(f'Saving data to {filename}...')
 
+        with self.metrics.timer('write', rows = len(data), layout = self.layout):
+            if self.layout == "columnar":
+                self.write_columnar(data, filename)
+            else:
+                self.write_groups(data, filename)
+
+        if self.verbose:
+            print('Done!')
+            print(f"Saved {len(data)} objects to {filename}")
+
+    def write_groups(self, data: pd.DataFrame, filename: str) -> None:
+        """
+        Write the data with one group per object, with one dataset per column.
+
+        Args:
+            data (pd.DataFrame): Data to write, one row per object
+            filename (str): Output file path
+        """
+
         with h5py.File(filename, 'w') as f:
+            # Columns holding numbers (scalars or lists) are stored as float64, the others as strings
+            numeric = {column: _is_numeric(data[column]) for column in data.columns}
+
             # Create a group for each object
             for _, row in data.iterrows():
                 obj_id = row.get('id', 'unknown')
@@ -488,52 +594,74 @@ class FindSimbad():
                     
                     value = row[col]
                     
+                    if isinstance(value, list):
+                        if numeric[col]:
+                            obj_group.create_dataset(col, data=np.array(value, dtype=float))
+                        else:
+                            obj_group.create_dataset(col, data=np.array([str(v) for v in value], dtype=h5py.string_dtype(encoding='utf-8')))
                     # Skip None, NaN, empty strings
-                    if value is None or (isinstance(value, str) and value == ''):
+                    elif pd.isna(value) or (isinstance(value, str) and value == ''):
                         continue
-                    if isinstance(value, float) and np.isnan(value):
-                        continue
-                    
-                    # Handle lists (convert strings to float if possible)
-                    if isinstance(value, list):
-                        try:
-                            # Try to convert to float for numeric values
-                            numeric_array = np.array(value, dtype=float)
-                            obj_group.create_dataset(col, data=numeric_array)
-                        except (ValueError, TypeError):
-                            # Keep as string for non-numeric values
-                            obj_group.create_dataset(
-                                col, 
-                                data=np.array(value, dtype=h5py.string_dtype(encoding='utf-8'))
-                            )
-                    # Handle scalars
+                    elif numeric[col]:
+                        obj_group.create_dataset(col, data=float(value))
                     else:
-                        try:
-                            # Try to convert string numbers to float
-                            if isinstance(value, str):
-                                float_val = float(value)
-                                obj_group.create_dataset(col, data=float_val)
-                            else:
-                                # Store numbers as-is
-                                obj_group.create_dataset(col, data=value)
-                        except (ValueError, TypeError):
-                            # Keep as string if conversion fails
-                            obj_group.create_dataset(
-                                col,
-                                data=str(value),
-                                dtype=h5py.string_dtype(encoding='utf-8')
-                            )
+                        obj_group.create_dataset(col, data=str(value), dtype=h5py.string_dtype(encoding='utf-8'))
 
-        if self.verbose:
-            print('Done!')
-            print(f"Saved {len(data)} objects to {filename}")
+    def write_columnar(self, data: pd.DataFrame, filename: str) -> None:
+        """
+        Write the data with one dataset per column, in the order of the 'id' dataset. Columns without
+        multiple values are written as a single dataset (float64, or variable-length utf-8 strings).
+        Columns with multiple values for some objects are written as a group holding the flattened values
+        ('values') and the position of the values of each object ('offsets', of length nb_objects + 1):
+        the values of object i are values[offsets[i]:offsets[i+1]]. Missing values are nan for numbers,
+        empty strings for strings, and no value for multi-valued columns.
+
+        Args:
+            data (pd.DataFrame): Data to write, one row per object
+            filename (str): Output file path
+        """
+
+        data = data.reset_index(drop = True)
+        string_dtype = h5py.string_dtype(encoding='utf-8')
+
+        with h5py.File(filename, 'w') as f:
+            f.attrs['layout'] = "columnar"
+            f.attrs['nb_objects'] = len(data)
+            f.create_dataset('id', data = data['id'].astype(str).to_numpy(dtype = object), dtype = string_dtype)
+
+            for column in data.columns:
+                if column == 'id':
+                    continue
+
+                series = data[column]
+                ragged = series.map(lambda value: isinstance(value, list)).any()
+
+                if ragged:
+                    values = series.explode()
+                    values = values[values.notna() & (values.astype(str) != "")]
+                    counts = values.groupby(level = 0).size().reindex(data.index, fill_value = 0)
+                    group = f.create_group(column)
+                    group.create_dataset('offsets', data = np.concatenate([[0], np.cumsum(counts.to_numpy())]).astype(np.int64))
+                    target, name = group, 'values'
+                else:
+                    values = series
+                    target, name = f, column
+
+                if _is_numeric(values):
+                    target.create_dataset(name, data = values.to_numpy(dtype = np.float64, na_value = np.nan))
+                else:
+                    missing = values.isna() | (values.astype(str) == "")
+                    strings = values.astype(str).where(~missing, "")
+                    target.create_dataset(name, data = strings.to_numpy(dtype = object), dtype = string_dtype)
 
-    def load_obs_with_gaia(self, filename: str = None) -> pd.DataFrame:
+    def load_obs_with_gaia(self, filename: str = None, columns: list = None, objects: list = None) -> pd.DataFrame:
         """
-        Load data saved with save_obs from an HDF5 file.
+        Load data saved with save_obs from an HDF5 file, whatever its layout.
 
         Args:
             filename (str, optional): Path to HDF5 file. Uses self.filename if not provided.
+            columns (list, optional): Only load these columns. Default to None (all columns).
+            objects (list, optional): Only load these objects (ids). Default to None (all objects).
 
         Returns:
             pd.DataFrame: DataFrame with the loaded data (preserving types: lists as lists, scalars as scalars/floats)
@@ -547,49 +675,124 @@ class FindSimbad():
         if self.verbose:
             print(f'Loading data from {filename}...')
 
-        data = []
         with h5py.File(filename, 'r') as f:
-            # Iterate through each object group
-            for obj_id in f.keys():
-                obj_group = f[obj_id]
-                row = {'id': obj_id}
-                
-                # Extract all datasets from the group
-                for col in obj_group.keys():
-                    dataset = obj_group[col]
-                    value = dataset[()]
-                    
-                    # If it's an array, convert to list (for multi-value columns)
-                    if isinstance(value, np.ndarray):
-                        if value.ndim == 0:
-                            # Scalar stored as array - extract the value
-                            row[col] = value.item()
-                        else:
-                            # Array - convert to list
-                            row[col] = value.tolist()
-                    # If it's bytes (string), decode it
-                    elif isinstance(value, bytes):
-                        row[col] = value.decode('utf-8')
-                    else:
-                        row[col] = value
-                
-                data.append(row)
+            if f.attrs.get('layout') == "columnar":
+                result = self.read_columnar(f, columns, objects)
+            else:
+                result = self.read_groups(f, columns, objects)
 
-        result = pd.DataFrame(data)
-        
         if self.verbose:
             print('Done!')
             print(f"Loaded {len(result)} objects from {filename}")
         
         return result
 
+    def read_columnar(self, f, columns: list = None, objects: list = None) -> pd.DataFrame:
+        """
+        Read the data written by write_columnar. Only the selected columns are read, and only the rows
+        of the selected objects (the smallest contiguous block containing them for multi-valued columns).
+
+        Args:
+            f (h5py.File): Open file
+            columns (list, optional): Columns to read. Default to None (all columns).
+            objects (list, optional): Ids of the objects to read. Default to None (all objects).
+
+        Returns:
+            pd.DataFrame: Data, one row per object
+        """
+
+        ids = f['id'].asstr()[()]
+        if objects is not None:
+            rows = np.flatnonzero(pd.Index(ids).isin([str(obj) for obj in objects]))
+        else:
+            rows = np.arange(len(ids))
+
+        result = {'id': ids if objects is None else ids[rows]}
+        names = [name for name in f.keys() if name != 'id' and (columns is None or name in columns)]
+
+        for name in names:
+            item = f[name]
+            if isinstance(item, h5py.Group):
+                offsets = item['offsets'][()]
+                values = item['values']
+                if len(rows) == 0:
+                    result[name] = []
+                    continue
+
+                # Read the block of values covering the selected objects only
+                start, end = offsets[rows[0]], offsets[rows[-1] + 1]
+                block = values.asstr()[start:end] if h5py.check_string_dtype(values.dtype) else values[start:end]
+                cells = []
+                for row in rows:
+                    cell = block[offsets[row] - start:offsets[row + 1] - start]
+                    cells.append(np.nan if len(cell) == 0 else (cell[0] if len(cell) == 1 else cell.tolist()))
+                result[name] = cells
+            else:
+                source = item.asstr() if h5py.check_string_dtype(item.dtype) else item
+                if objects is None:
+                    values = source[()]
+                elif len(rows) == 0:
+                    values = source[0:0]
+                else:
+                    # Contiguous block covering the selected objects, much faster to read than a point selection
+                    values = source[rows[0]:rows[-1] + 1][rows - rows[0]]
+                if h5py.check_string_dtype(item.dtype):
+                    values = pd.Series(values, dtype = object).replace("", np.nan).to_numpy()
+                result[name] = values
+
+        return pd.DataFrame(result)
+
+    def read_groups(self, f, columns: list = None, objects: list = None) -> pd.DataFrame:
+        """
+        Read the data written by write_groups, one group per object.
+
+        Args:
+            f (h5py.File): Open file
+            columns (list, optional): Columns to read. Default to None (all columns).
+            objects (list, optional): Ids of the objects to read. Default to None (all objects).
+
+        Returns:
+            pd.DataFrame: Data, one row per object
+        """
+
+        data = []
+        # Iterate through each object group
+        for obj_id in (f.keys() if objects is None else [str(obj) for obj in objects if str(obj) in f]):
+            obj_group = f[obj_id]
+            row = {'id': obj_id}
+            
+            # Extract all datasets from the group
+            for col in obj_group.keys():
+                if columns is not None and col not in columns:
+                    continue
+                dataset = obj_group[col]
+                value = dataset[()]
+                
+                # If it's an array, convert to list (for multi-value columns)
+                if isinstance(value, np.ndarray):
+                    if value.ndim == 0:
+                        # Scalar stored as array - extract the value
+                        row[col] = value.item()
+                    else:
+                        # Array - convert to list
+                        row[col] = value.tolist()
+                # If it's bytes (string), decode it
+                elif isinstance(value, bytes):
+                    row[col] = value.decode('utf-8')
+                else:
+                    row[col] = value
+            
+            data.append(row)
+
+        return pd.DataFrame(data)
+
 def main() -> int:
     """
     Main function used when the script is called from a command line
     """
     # Arguments definition
     parser = argparse.ArgumentParser()
-    parser.add_argument('-id', required = True, help = "Simbad identifier of the object to query, or list of identifiers to query.")
+    parser.add_argument('-id', required = False, help = "Simbad identifier of the object to query, or list of identifiers to query.")
     parser.add_argument('-col', type = str, required = False, help = "Columns to retreive from simbad, in addition to the default columns 'ident.id'. Columns must be defined as 'column1, column2, ...'", default = "")
     parser.add_argument('-mag', type = str, required = False, help = "Magnitude bands to retreive from simbad. Must be defined as 'band1, band2, ...'", default = "")
     parser.add_argument('-v', type = int, required = False, help = "Verbose", default = 0)
@@ -597,10 +800,28 @@ def main() -> int:
     parser.add_argument('-n', type = str, required = False, help = "Name of the output file", default = None)
     parser.add_argument('-gaia', type = str, required = False, help = "Columns to retreive from gaia, Must be defined as 'column1, column2, ...'", default = "")
     parser.add_argument('-proxy', type = str, required = False, help = "Proxy to use host:port", default = None)
+    parser.add_argument('-metrics', type = str, required = False, help = "JSON-lines file to which the query metrics are appended", default = None)
+    parser.add_argument('-trace', type = str, required = False, help = "File in which the Chrome trace-event JSON of the queries is written", default = None)
+    parser.add_argument('-journal', type = str, required = False, help = "Journal of the submitted jobs, used to resume a run that stopped mid-way", default = None)
+    parser.add_argument('-keep', type = int, required = False, help = "Keep the jobs on the server once their results are downloaded", default = 0)
+    parser.add_argument('-idfile', type = str, required = False, help = "File containing one Simbad identifier per line, used instead of -id", default = None)
+    parser.add_argument('-batch', type = int, required = False, help = "Maximum number of identifiers uploaded in a single job", default = 10000)
+    parser.add_argument('-workers', type = int, required = False, help = "Number of jobs run at the same time when the identifiers are split", default = 4)
+    parser.add_argument('-gaiaident', type = int, required = False, help = "Get the Gaia DR3 identifier from a second join on ident (1), or from the full list of identifiers (0)", default = 1)
+    parser.add_argument('-layout', type = str, required = False, help = "Layout of the output file: 'groups' (one group per object) or 'columnar' (one dataset per column)", default = "groups")
+    parser.add_argument('-cache', type = str, required = False, help = "sqlite file caching the identifiers already resolved, so that only the new ones are queried", default = None)
+    parser.add_argument('-cachettl', type = float, required = False, help = "Time to live of the cached identifiers (in day)", default = 30)
+    parser.add_argument('-retries', type = int, required = False, help = "Maximum number of attempts of a request failing with a transient error", default = 5)
 
     # Get arguments value
     args = parser.parse_args()
-    ident = args.id.split(',')
+    if args.idfile != None:
+        with open(args.idfile) as f:
+            ident = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+    elif args.id != None:
+        ident = args.id.split(',')
+    else:
+        parser.error("-id or -idfile is required")
     columns = args.col.split(',') if args.col != "" else ""
     magnitudes = args.mag.split(',') if args.mag != "" else ""
     gaia = args.gaia.split(',') if args.gaia != "" else ""
@@ -613,11 +834,24 @@ def main() -> int:
     else:
         proxy = None
 
-    fsimbad = FindSimbad(path = path, proxy = proxy, verbose = verbose, name = name, columns = columns, mag = magnitudes)
-    if gaia != "":
-        fsimbad.get_obs_with_gaia(ident, gaia_columns=gaia)
-    else:
-        fsimbad.get_obs(ident)
+    tracer = Tracer(args.trace) if args.trace != None else None
+    journal = JobJournal(args.journal, verbose = args.v) if args.journal != None else None
+    cache = IdentifierCache(args.cache, ttl = args.cachettl * 86400) if args.cache != None else None
+
+    fsimbad = FindSimbad(path = path, proxy = proxy, verbose = verbose, name = name, columns = columns, mag = magnitudes, metrics_file = args.metrics, tracer = tracer, journal = journal, keep_results = args.keep,
+                        retry = RetryPolicy(max_attempts = args.retries, verbose = verbose), batch_size = args.batch, workers = args.workers,
+                        gaia_ident = args.gaiaident, layout = args.layout, cache = cache)
+    try:
+        if gaia != "":
+            fsimbad.get_obs_with_gaia(ident, gaia_columns=gaia)
+        else:
+            fsimbad.get_obs(ident)
+    except ObsfinderError as error:
+        print(f"Error: {error}")
+        return 1
+    finally:
+        if tracer != None:
+            tracer.write()
 
     return 0
 
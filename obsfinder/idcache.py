@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from .journal import normalize_query
+from .lazy import lazy_import
+import contextlib
+import threading
+import sqlite3
+import time
+
+pd = lazy_import("pandas")
+hashlib = lazy_import("hashlib")
+json = lazy_import("json")
+
+# Maximum number of parameters of a single sqlite statement
+SQL_BATCH = 500
+
+def normalize_identifier(identifier: str) -> str:
+    """
+    Normalize an object name, so that names differing only by their spacing share the same entry
+
+    Args:
+        identifier (str): Object name (e.g. 'HD  1', ' HIP 2')
+
+    Returns:
+        str: Normalized name (e.g. 'HD 1', 'HIP 2')
+    """
+
+    return " ".join(str(identifier).split())
+
+class IdentifierCache():
+    """
+    This class keeps a local and persistent cache of the Simbad identifiers already resolved. For
+    each normalized identifier and each query (i.e. set of columns), it stores the oid, the main
+    identifier and the Gaia DR3 identifier of the object, as well as the rows last returned by
+    Simbad. Identifiers unknown to Simbad are also recorded, so that they are not queried again.
+    Entries older than the time to live are ignored, and fetched again.
+
+    The cache is a sqlite database, which can be shared by several threads and processes.
+    """
+
+    def __init__(self, filename: str, ttl: float = 30 * 86400) -> None:
+        """
+        Initialize the class, creating the database if it does not exist
+
+        Args:
+            filename (str): Path of the sqlite database
+            ttl (float, optional): Time to live of the entries (in second). Default to 30 days.
+        """
+
+        self.filename = filename
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        with self.connect() as db:
+            db.execute("""CREATE TABLE IF NOT EXISTS identifiers (
+                            identifier TEXT NOT NULL,
+                            query TEXT NOT NULL,
+                            oid INTEGER,
+                            main_id TEXT,
+                            gaiadr3 TEXT,
+                            columns TEXT NOT NULL,
+                            rows TEXT NOT NULL,
+                            time REAL NOT NULL,
+                            PRIMARY KEY (identifier, query))""")
+
+    @contextlib.contextmanager
+    def connect(self):
+        """
+        Open a connection to the database, committed and closed on exit
+        """
+
+        with self.lock, contextlib.closing(sqlite3.connect(self.filename, timeout = 60)) as db:
+            with db:
+                yield db
+
+    def key(self, query: str) -> str:
+        """
+        Key identifying the columns returned by a query
+
+        Args:
+            query (str): ADQL query
+
+        Returns:
+            str: Key of the query
+        """
+
+        return hashlib.sha1(normalize_query(query).encode('utf-8')).hexdigest()
+
+    def lookup(self, query: str, identifiers: list) -> tuple[pd.DataFrame, list]:
+        """
+        Get the rows of the identifiers found in the cache
+
+        Args:
+            query (str): Query the rows were returned by
+            identifiers (list): Normalized identifiers
+
+        Returns:
+            tuple[pd.DataFrame, list]: Rows of the identifiers found in the cache (None if there is none), and identifiers not found (or expired)
+        """
+
+        key = self.key(query)
+        oldest = time.time() - self.ttl
+        found = {}
+
+        with self.connect() as db:
+            for start in range(0, len(identifiers), SQL_BATCH):
+                chunk = identifiers[start:start + SQL_BATCH]
+                cursor = db.execute(f"SELECT identifier, columns, rows FROM identifiers WHERE query = ? AND time >= ? "
+                                    f"AND identifier IN ({','.join('?' * len(chunk))})", [key, oldest, *chunk])
+                for identifier, columns, rows in cursor:
+                    found[identifier] = (json.loads(columns), json.loads(rows))
+
+        misses = [identifier for identifier in identifiers if identifier not in found]
+        if len(found) == 0:
+            return None, misses
+
+        columns = next(iter(found.values()))[0]
+        rows = [row for identifier in identifiers if identifier in found for row in found[identifier][1]]
+
+        return pd.DataFrame(rows, columns = columns), misses
+
+    def store(self, query: str, identifiers: list, data: pd.DataFrame, queried: pd.Series = None, main_ids: pd.Series = None) -> None:
+        """
+        Store the rows returned by Simbad for a list of identifiers. Identifiers without any row are
+        recorded as unknown.
+
+        Args:
+            query (str): Query the rows were returned by
+            identifiers (list): Normalized identifiers queried
+            data (pd.DataFrame): Rows returned by Simbad, with an 'id' column
+            queried (pd.Series, optional): Normalized identifier each row was returned for (e.g. the uploaded name). Default to None:
+                the normalized 'id' column, i.e. the identifier matched by Simbad.
+            main_ids (pd.Series, optional): Main identifier (basic.main_id) of the object of each row. Default to None: the
+                'main_id' column of the data, if any.
+        """
+
+        key = self.key(query)
+        now = time.time()
+        columns = json.dumps(list(data.columns))
+        if "id" not in data.columns:
+            data = data.assign(id = pd.Series(dtype = object))
+
+        # One value of each field per identifier, the first one found in its rows
+        names = pd.Series(list(queried), index = data.index) if queried is not None else data["id"].map(normalize_identifier)
+        fields = pd.DataFrame(index = data.index)
+        oid_column = next((column for column in data.columns if column.lower() == "oid"), None)
+        fields["oid"] = pd.to_numeric(data[oid_column], errors = "coerce") if oid_column != None else None
+        if main_ids is not None:
+            fields["main_id"] = pd.Series(list(main_ids), index = data.index, dtype = object)
+        else:
+            fields["main_id"] = data["main_id"] if "main_id" in data.columns else None
+        gaia_column = "gaiadr3" if "gaiadr3" in data.columns else "ids"
+        fields["gaiadr3"] = ("GaiaDR3" + data[gaia_column].astype(str).str.extract(r"Gaia\s*DR3\s*(\d+)", expand = False)
+                             if gaia_column in data.columns else None)
+        fields = fields.groupby(names, sort = False).first().to_dict("index")
+
+        rows = {}
+        records = data.astype(object).where(data.notna(), None).to_numpy().tolist()
+        for name, record in zip(names, records):
+            rows.setdefault(name, []).append(record)
+
+        entries = []
+        for identifier in identifiers:
+            if identifier in fields:
+                oid, main_id, gaiadr3 = fields[identifier]["oid"], fields[identifier]["main_id"], fields[identifier]["gaiadr3"]
+                entries.append((identifier, key, int(oid) if pd.notna(oid) else None, str(main_id) if pd.notna(main_id) else None,
+                                gaiadr3 if pd.notna(gaiadr3) else None, columns, json.dumps(rows[identifier]), now))
+            else:
+                entries.append((identifier, key, None, None, None, columns, "[]", now))
+
+        with self.connect() as db:
+            db.executemany("INSERT OR REPLACE INTO identifiers VALUES (?, ?, ?, ?, ?, ?, ?, ?)", entries)
+
+    def purge(self, expired_only: bool = True) -> int:
+        """
+        Remove entries from the cache
+
+        Args:
+            expired_only (bool, optional): Only remove the entries older than the time to live. Default to True.
+
+        Returns:
+            int: Number of entries removed
+        """
+
+        with self.connect() as db:
+            if expired_only:
+                cursor = db.execute("DELETE FROM identifiers WHERE time < ?", [time.time() - self.ttl])
+            else:
+                cursor = db.execute("DELETE FROM identifiers")
+
+        return cursor.rowcount
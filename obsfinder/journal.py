@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+from .lazy import lazy_import
+import threading
+import time
+import os
+
+hashlib = lazy_import("hashlib")
+json = lazy_import("json")
+
+def normalize_query(query: str) -> str:
+    """
+    Normalize an ADQL query, so that queries differing only by their spacing share the same key
+
+    Args:
+        query (str): ADQL query
+
+    Returns:
+        str: Normalized query
+    """
+
+    return " ".join(query.split())
+
+class JobJournal():
+    """
+    This class keeps a local journal of the jobs submitted to TAP services, mapping each
+    normalized query to its job URL and state. It allows a run that stopped mid-way to
+    re-attach to the jobs still executing on the server and to download the completed ones,
+    instead of submitting them again.
+
+    The journal is a JSON-lines file in which each line is the new state of a job, the last
+    line of a query being the current one. It can be shared by several threads.
+    """
+
+    def __init__(self, filename: str, verbose: int = 0) -> None:
+        """
+        Initialize the class, loading the journal if it already exists. Lines that cannot be read are skipped, and the
+        last line is removed if it was only partly written (run killed while recording a job).
+
+        Args:
+            filename (str): Path of the journal file
+            verbose (int, optional): Toggle verbose (1 or 0), to report the lines skipped. Default to 0.
+        """
+
+        self.filename = filename
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.entries = {}
+
+        if os.path.exists(self.filename):
+            with open(self.filename, 'rb+') as f:
+                content = f.read()
+                end = content.rfind(b"\n") + 1
+                if end < len(content):
+                    # Remove the partial line, so that the next entries start on a new line
+                    f.truncate(end)
+                    if self.verbose:
+                        print(f"Removed the partial last line of the journal {self.filename}")
+
+            for number, line in enumerate(content[:end].decode('utf-8', 'replace').splitlines(), 1):
+                if not line.strip():
+                    continue
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry["key"]] = entry
+                except (ValueError, KeyError, TypeError) as error:
+                    if self.verbose:
+                        print(f"Skipped line {number} of the journal {self.filename}: {error}")
+
+    def key(self, host: str, pathinfo: str, query: str, uploads: dict = None) -> str:
+        """
+        Key identifying a query on a given service
+
+        Args:
+            host (str): Host of the TAP service
+            pathinfo (str): Path of the asynchronous endpoint of the TAP service
+            query (str): ADQL query
+            uploads (dict, optional): Tables uploaded with the query, as {name: content}. Default to None.
+
+        Returns:
+            str: Key of the query
+        """
+
+        digest = hashlib.sha1(f"{host}{pathinfo}\n{normalize_query(query)}".encode('utf-8'))
+        for name, table in sorted((uploads or {}).items()):
+            digest.update(f"\n{name}\n".encode('utf-8'))
+            digest.update(table)
+
+        return digest.hexdigest()
+
+    def get(self, key: str) -> dict:
+        """
+        Get the current entry of a query
+
+        Args:
+            key (str): Key of the query
+
+        Returns:
+            dict: Entry of the query (key, host, pathinfo, jobid, location, state, time), None if the query is unknown
+        """
+
+        with self.lock:
+            return self.entries.get(key)
+
+    def record(self, key: str, state: str, **values) -> None:
+        """
+        Record the new state of a job
+
+        Args:
+            key (str): Key of the query
+            state (str): New state of the job ('SUBMITTED', 'COMPLETED', 'FETCHED', ...)
+            **values: Other values to update (host, pathinfo, jobid, location)
+        """
+
+        with self.lock:
+            entry = {**self.entries.get(key, {"key": key}), **values, "state": state, "time": time.time()}
+            self.entries[key] = entry
+            with open(self.filename, 'a') as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def jobs(self, states: list = None) -> list:
+        """
+        List the entries of the journal
+
+        Args:
+            states (list, optional): Only return the entries in one of these states. Default to None (all entries).
+
+        Returns:
+            list: Entries of the journal
+        """
+
+        with self.lock:
+            return [entry for entry in self.entries.values() if states is None or entry["state"] in states]
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import importlib
+import threading
+
+class LazyModule():
+    """
+    This class stands for a module that is only imported when one of its attributes is first used.
+    It keeps heavy dependencies (pandas, numpy, h5py, zero_point, ...) out of the start-up of the
+    command line tools, so that a call such as 'pyfindsimbad -h' does not pay for them.
+    """
+
+    def __init__(self, name: str) -> None:
+        """
+        Initialize the class
+
+        Args:
+            name (str): Full name of the module (e.g. 'pandas', 'zero_point.zpt')
+        """
+
+        self._name = name
+        self._module = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """
+        Import the module if it is not imported yet
+
+        Returns:
+            module: Imported module
+        """
+
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    self._module = importlib.import_module(self._name)
+
+        return self._module
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._load(), attribute)
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._module is not None else "not loaded"
+        return f"<lazy module '{self._name}' ({state})>"
+
+def lazy_import(name: str) -> LazyModule:
+    """
+    Return a module imported on first use
+
+    Args:
+        name (str): Full name of the module
+
+    Returns:
+        LazyModule: Proxy of the module
+    """
+
+    return LazyModule(name)
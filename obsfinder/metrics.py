@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from .lazy import lazy_import
+from contextlib import contextmanager
+import threading
+import time
+
+json = lazy_import("json")
+
+# Name of the trace span associated to each timed phase
+SPAN_NAMES = {'download': 'fetch', 'correction': 'zero-point'}
+
+class QueryMetrics():
+    """
+    This class collects structured timings and counters for one call to a finder.
+
+    Timings (in seconds) are accumulated per phase, so a query split in two parts
+    reports the sum of both parts. Phases used by the finders are:
+    'submit', 'queue', 'execution', 'download', 'parse', 'clean', 'correction' and 'write'.
+    Counters are 'bytes_downloaded' (received, compressed or not), 'bytes_decoded', 'rows_raw',
+    'rows_clean' and 'jobs'. The compression ratio of the results is given by as_dict.
+    If a Tracer is given, every timed phase is also recorded as a span. The metrics
+    can be updated by several threads running the parts of a query concurrently.
+    """
+
+    def __init__(self, catalog: str = None, tracer = None, **attributes) -> None:
+        """
+        Initialize the class
+
+        Args:
+            catalog (str, optional):
+                Name of the queried catalog ('gaia', '2mass', 'gaia2mass', 'simbad', ...). Default to None.
+            tracer (Tracer, optional):
+                Tracer in which the phases are recorded as spans. Default to None.
+            **attributes:
+                Any additional information identifying the query (lvalue, bvalue, psize, ...)
+        """
+
+        self.catalog = catalog
+        self.tracer = tracer
+        self.attributes = attributes
+        self.timings = {}
+        self.counters = {}
+        self.job_ids = []
+        self.start = time.time()
+        self.end = None
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def timer(self, phase: str, **args):
+        """
+        Context manager adding the time spent in the block to the given phase.
+        The yielded dictionary holds the attributes of the trace span, and can
+        be updated within the block.
+
+        Args:
+            phase (str): Name of the phase
+            **args: Attributes of the trace span
+        """
+
+        t0 = time.perf_counter()
+        try:
+            yield args
+        finally:
+            t1 = time.perf_counter()
+            self.add_time(phase, t1 - t0)
+            if self.tracer is not None:
+                self.tracer.add_span(SPAN_NAMES.get(phase, phase), t0, t1, **args)
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """
+        Context manager recording the block as a trace span, without timing it in the metrics.
+
+        Args:
+            name (str): Name of the span
+            **args: Attributes of the trace span
+        """
+
+        if self.tracer is None:
+            yield args
+        else:
+            with self.tracer.span(name, **args) as span_args:
+                yield span_args
+
+    def add_time(self, phase: str, seconds: float) -> None:
+        """
+        Add a duration to a phase
+
+        Args:
+            phase (str): Name of the phase
+            seconds (float): Duration to add (in second)
+        """
+
+        with self.lock:
+            self.timings[phase] = self.timings.get(phase, 0.) + seconds
+
+    def count(self, name: str, value: int) -> None:
+        """
+        Add a value to a counter
+
+        Args:
+            name (str): Name of the counter
+            value (int): Value to add
+        """
+
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def add_job(self, jobid: str) -> None:
+        """
+        Record the id of a job submitted to an archive
+
+        Args:
+            jobid (str): Job id returned by the server
+        """
+
+        with self.lock:
+            self.job_ids.append(jobid)
+        self.count('jobs', 1)
+
+    def merge(self, other: QueryMetrics) -> None:
+        """
+        Add the timings, counters and jobs of the metrics of a sub-query (e.g. one of the catalogs of a cross-match)
+
+        Args:
+            other (QueryMetrics): Metrics of the sub-query
+        """
+
+        with self.lock, other.lock:
+            for phase, seconds in other.timings.items():
+                self.timings[phase] = self.timings.get(phase, 0.) + seconds
+            for name, value in other.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            self.job_ids += other.job_ids
+
+    def as_dict(self) -> dict:
+        """
+        Return the metrics as a JSON serialisable dictionary
+
+        Returns:
+            dict: Dictionary containing the metrics
+        """
+
+        end = self.end if self.end is not None else time.time()
+        metrics = {"catalog": self.catalog,
+                   **self.attributes,
+                   "start": self.start,
+                   "total": end - self.start,
+                   "timings": dict(self.timings),
+                   "counters": dict(self.counters),
+                   "job_ids": list(self.job_ids)}
+
+        # Size of the decoded results over the bytes received
+        if self.counters.get('bytes_downloaded', 0) > 0 and 'bytes_decoded' in self.counters:
+            metrics["compression_ratio"] = self.counters['bytes_decoded'] / self.counters['bytes_downloaded']
+
+        return metrics
+
+    def write_jsonl(self, filename: str) -> None:
+        """
+        Append the metrics as a single line to a JSON-lines file
+
+        Args:
+            filename (str): Path of the JSON-lines file
+        """
+
+        with open(filename, 'a') as f:
+            f.write(json.dumps(self.as_dict()) + "\n")
+
+    def finish(self, callback = None, filename: str = None) -> None:
+        """
+        Close the metrics, then forward them to the callback and to the metrics file if defined
+
+        Args:
+            callback (callable, optional): Function called with this object as only argument. Default to None.
+            filename (str, optional): Path of the JSON-lines file to append the metrics to. Default to None.
+        """
+
+        self.end = time.time()
+
+        if callback is not None:
+            callback(self)
+
+        if filename is not None:
+            self.write_jsonl(filename)
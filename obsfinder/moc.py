@@ -0,0 +1,703 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+hashlib = lazy_import("hashlib")
+json = lazy_import("json")
+
+# Finest order of the HEALPix cells of a MOC (IVOA MOC 2.0)
+MAX_ORDER = 29
+
+# Order of the HEALPix index held in the Gaia source_id (source_id // 2**35)
+GAIA_ORDER = 12
+
+# Rotation from ICRS to Galactic cartesian coordinates (Hipparcos, ESA 1997)
+ICRS_TO_GALACTIC = [[-0.0548755604162154, -0.8734370902348850, -0.4838350155487132],
+                    [ 0.4941094278755837, -0.4448296299600112,  0.7469822444972189],
+                    [-0.8676661490190047, -0.1980763734312015,  0.4559837761750669]]
+
+# Ring of the first pixel and longitude offset of each base cell
+JRLL = [2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4]
+JPLL = [1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7]
+
+def rotate(lon, lat, matrix) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Rotate positions on the sphere
+
+    Args:
+        lon (array-like): Longitudes (in degree)
+        lat (array-like): Latitudes (in degree)
+        matrix (array-like): Rotation matrix
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Rotated longitudes in [0, 360) and latitudes (in degree)
+    """
+
+    lon = np.radians(np.asarray(lon, dtype = np.float64))
+    lat = np.radians(np.asarray(lat, dtype = np.float64))
+    vectors = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+    x, y, z = np.tensordot(np.asarray(matrix), vectors, axes = 1)
+
+    return np.mod(np.degrees(np.arctan2(y, x)), 360), np.degrees(np.arcsin(np.clip(z, -1, 1)))
+
+def galactic_to_icrs(l, b) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Convert Galactic coordinates to ICRS
+
+    Args:
+        l (array-like): Galactic longitudes (in degree)
+        b (array-like): Galactic latitudes (in degree)
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Right ascensions and declinations (in degree)
+    """
+
+    return rotate(l, b, np.transpose(ICRS_TO_GALACTIC))
+
+def icrs_to_galactic(ra, dec) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Convert ICRS coordinates to Galactic
+
+    Args:
+        ra (array-like): Right ascensions (in degree)
+        dec (array-like): Declinations (in degree)
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Galactic longitudes and latitudes (in degree)
+    """
+
+    return rotate(ra, dec, ICRS_TO_GALACTIC)
+
+def spread_bits(values: np.ndarray) -> np.ndarray:
+    """
+    Insert a 0 bit between the bits of integers (0b111 -> 0b10101)
+    """
+
+    values = np.asarray(values, dtype = np.int64)
+    result = np.zeros_like(values)
+    for bit in range(MAX_ORDER):
+        result |= ((values >> bit) & 1) << (2 * bit)
+
+    return result
+
+def compact_bits(values: np.ndarray) -> np.ndarray:
+    """
+    Keep one bit out of two of integers, starting with the lowest (0b10101 -> 0b111)
+    """
+
+    values = np.asarray(values, dtype = np.int64)
+    result = np.zeros_like(values)
+    for bit in range(MAX_ORDER):
+        result |= ((values >> (2 * bit)) & 1) << bit
+
+    return result
+
+def ang2pix(order: int, lon, lat) -> np.ndarray:
+    """
+    HEALPix cells (nested scheme) containing some positions
+
+    Args:
+        order (int): Order of the cells (nside = 2**order)
+        lon (array-like): Longitudes (in degree)
+        lat (array-like): Latitudes (in degree)
+
+    Returns:
+        np.ndarray: Cell indices (int64)
+    """
+
+    nside = 1 << order
+    lat = np.radians(np.asarray(lat, dtype = np.float64))
+    z = np.sin(lat)
+    za = np.abs(z)
+    tt = np.mod(np.radians(np.asarray(lon, dtype = np.float64)) * 2 / np.pi, 4)
+
+    # Equatorial region
+    temp1 = nside * (0.5 + tt)
+    temp2 = nside * z * 0.75
+    jp = np.floor(temp1 - temp2).astype(np.int64)
+    jm = np.floor(temp1 + temp2).astype(np.int64)
+    ifp, ifm = jp >> order, jm >> order
+    face_eq = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix_eq = jm & (nside - 1)
+    iy_eq = nside - (jp & (nside - 1)) - 1
+
+    # Polar caps
+    ntt = np.minimum(tt.astype(np.int64), 3)
+    tp = tt - ntt
+    tmp = np.where(za < 0.99, nside * np.sqrt(3 * np.maximum(1 - za, 0)), nside * np.cos(lat) / np.sqrt((1 + za) / 3))
+    jp_pol = np.minimum(np.floor(tp * tmp).astype(np.int64), nside - 1)
+    jm_pol = np.minimum(np.floor((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = z >= 0
+    face_pol = np.where(north, ntt, ntt + 8)
+    ix_pol = np.where(north, nside - jm_pol - 1, jp_pol)
+    iy_pol = np.where(north, nside - jp_pol - 1, jm_pol)
+
+    equatorial = za <= 2 / 3
+    face = np.where(equatorial, face_eq, face_pol)
+    ix = np.where(equatorial, ix_eq, ix_pol)
+    iy = np.where(equatorial, iy_eq, iy_pol)
+
+    return (face.astype(np.int64) << (2 * order)) + spread_bits(ix) + (spread_bits(iy) << 1)
+
+def cell_points(order: int, cells, step: int = 1) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Points of the boundary of HEALPix cells (nested scheme), and their center
+
+    Args:
+        order (int): Order of the cells
+        cells (array-like): Cell indices
+        step (int, optional): Number of points on each edge. Default to 1 (vertices only).
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Longitudes and latitudes (in degree), of shape (n, 4 * step + 1), the center being the last point
+    """
+
+    nside = 1 << order
+    cells = np.asarray(cells, dtype = np.int64)
+    face = cells >> (2 * order)
+    ix = compact_bits(cells & ((1 << (2 * order)) - 1))
+    iy = compact_bits((cells & ((1 << (2 * order)) - 1)) >> 1)
+
+    # Face coordinates of the points, going around the cell as in healpix boundaries()
+    t = np.arange(step) / step
+    dx = np.concatenate([1 - t, np.zeros(step), t, np.ones(step), [0.5]])
+    dy = np.concatenate([np.ones(step), 1 - t, np.zeros(step), t, [0.5]])
+    x = (ix[:, None] + dx[None, :]) / nside
+    y = (iy[:, None] + dy[None, :]) / nside
+    face = np.broadcast_to(face[:, None], x.shape)
+
+    jr = np.asarray(JRLL)[face] - x - y
+    nr = np.where(jr < 1, jr, np.where(jr > 3, 4 - jr, 1.))
+    z = np.where(jr < 1, 1 - nr**2 / 3, np.where(jr > 3, nr**2 / 3 - 1, (2 - jr) * 2 / 3))
+    tmp = np.mod(np.asarray(JPLL)[face] * nr + x - y, 8)
+    with np.errstate(divide = 'ignore', invalid = 'ignore'):
+        phi = np.where(nr < 1e-15, 0., 0.25 * np.pi * tmp / nr)
+
+    return np.degrees(phi), np.degrees(np.arcsin(np.clip(z, -1, 1)))
+
+def merge_ranges(ranges) -> np.ndarray:
+    """
+    Sort and merge overlapping or adjacent ranges
+
+    Args:
+        ranges (array-like): Ranges, as [start, end)
+
+    Returns:
+        np.ndarray: Disjoint ranges, of shape (n, 2)
+    """
+
+    ranges = np.asarray(ranges, dtype = np.int64).reshape(-1, 2)
+    ranges = ranges[ranges[:, 1] > ranges[:, 0]]
+    if len(ranges) == 0:
+        return ranges
+
+    ranges = ranges[np.argsort(ranges[:, 0], kind = "stable")]
+    ends = np.maximum.accumulate(ranges[:, 1])
+    starts = np.ones(len(ranges), dtype = bool)
+    starts[1:] = ranges[1:, 0] > ends[:-1]
+    first = np.flatnonzero(starts)
+    last = np.append(first[1:], len(ranges)) - 1
+
+    return np.column_stack([ranges[first, 0], ends[last]])
+
+class MOC():
+    """
+    This class holds a Multi-Order Coverage map (IVOA MOC 2.0): a set of HEALPix cells (nested scheme,
+    ICRS) of any order, stored as disjoint ranges of cells of order 29. It can be read from or written
+    to a FITS (NUNIQ or RANGE) or JSON file, built from boxes and cones of Galactic coordinates, and
+    combined with the |, & and - operators.
+    """
+
+    def __init__(self, ranges = None, max_order: int = None) -> None:
+        """
+        Initialize the class
+
+        Args:
+            ranges (array-like, optional): Ranges of cells of order 29, as [start, end). Default to None (empty coverage).
+            max_order (int, optional): Finest order of the cells of the coverage. Default to None (found from the ranges).
+        """
+
+        self.ranges = merge_ranges(ranges if ranges is not None else [])
+        if max_order == None:
+            # Coarsest order at which all the range bounds are cell bounds
+            bounds = self.ranges.ravel()
+            max_order = 0
+            while max_order < MAX_ORDER and np.any(bounds & ((1 << (2 * (MAX_ORDER - max_order))) - 1)):
+                max_order += 1
+        self.max_order = max_order
+
+    def __or__(self, other: MOC) -> MOC:
+        return MOC(np.concatenate([self.ranges, other.ranges]), max(self.max_order, other.max_order))
+
+    def __and__(self, other: MOC) -> MOC:
+        return self - (self - other)
+
+    def __sub__(self, other: MOC) -> MOC:
+        # Bounds of both coverages, and number of coverages (+1 for self, -2 for other) in each interval
+        bounds = np.concatenate([self.ranges.ravel(), other.ranges.ravel()])
+        weights = np.concatenate([np.tile([1, -1], len(self.ranges)), np.tile([-2, 2], len(other.ranges))])
+        order = np.argsort(bounds, kind = "stable")
+        bounds, levels = bounds[order], np.cumsum(weights[order])
+        keep = levels[:-1] == 1
+
+        return MOC(np.column_stack([bounds[:-1][keep], bounds[1:][keep]]), self.max_order)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MOC) and np.array_equal(self.ranges, other.ranges)
+
+    def __len__(self) -> int:
+        return len(self.ranges)
+
+    def is_empty(self) -> bool:
+        return len(self.ranges) == 0
+
+    def area(self) -> float:
+        """
+        Area of the coverage (in square degree)
+        """
+
+        cells = int(np.sum(self.ranges[:, 1] - self.ranges[:, 0]))
+        return cells * 4 * np.pi / (12 * 4**MAX_ORDER) * (180 / np.pi)**2
+
+    def degrade(self, order: int) -> np.ndarray:
+        """
+        Ranges of the cells of an order covering the coverage (the coverage is enlarged if it has finer cells)
+
+        Args:
+            order (int): Order of the cells
+
+        Returns:
+            np.ndarray: Ranges of cells of the order, as [start, end)
+        """
+
+        shift = 2 * (MAX_ORDER - order)
+        starts = self.ranges[:, 0] >> shift
+        ends = (self.ranges[:, 1] + (1 << shift) - 1) >> shift
+
+        return merge_ranges(np.column_stack([starts, ends]))
+
+    def count(self, order: int) -> int:
+        """
+        Number of cells of an order covering the coverage
+
+        Args:
+            order (int): Order of the cells
+
+        Returns:
+            int: Number of cells
+        """
+
+        ranges = self.degrade(order)
+        return int(np.sum(ranges[:, 1] - ranges[:, 0]))
+
+    def cells(self, order: int) -> np.ndarray:
+        """
+        Cells of an order covering the coverage
+
+        Args:
+            order (int): Order of the cells
+
+        Returns:
+            np.ndarray: Cell indices
+        """
+
+        ranges = self.degrade(order)
+        if len(ranges) == 0:
+            return np.zeros(0, dtype = np.int64)
+
+        return np.concatenate([np.arange(start, end, dtype = np.int64) for start, end in ranges])
+
+    def uniq(self) -> np.ndarray:
+        """
+        Cells of the coverage, each at the coarsest possible order, in the NUNIQ encoding (4 * 4**order + index)
+
+        Returns:
+            np.ndarray: Sorted NUNIQ indices
+        """
+
+        uniq = []
+        for start, end in self.ranges.tolist():
+            while start < end:
+                # Coarsest cell starting at start and ending before end
+                order = MAX_ORDER
+                while order > 0:
+                    size = 1 << (2 * (MAX_ORDER - order + 1))
+                    if start % size != 0 or start + size > end:
+                        break
+                    order -= 1
+                size = 1 << (2 * (MAX_ORDER - order))
+                uniq.append(4 * 4**order + start // size)
+                start += size
+
+        return np.sort(np.asarray(uniq, dtype = np.int64))
+
+    def digest(self) -> str:
+        """
+        Short identifier of the coverage, used in file names
+        """
+
+        return hashlib.sha1(self.ranges.astype('<i8').tobytes()).hexdigest()[:12]
+
+    def contains(self, lon, lat, frame: str = "icrs") -> np.ndarray:
+        """
+        Whether some positions are in the coverage
+
+        Args:
+            lon (array-like): Longitudes (in degree)
+            lat (array-like): Latitudes (in degree)
+            frame (str, optional): Frame of the positions, 'icrs' or 'galactic'. Default to 'icrs'.
+
+        Returns:
+            np.ndarray: Boolean mask
+        """
+
+        if frame == "galactic":
+            lon, lat = galactic_to_icrs(lon, lat)
+
+        order = self.max_order
+        cells = ang2pix(order, lon, lat) << (2 * (MAX_ORDER - order))
+        index = np.searchsorted(self.ranges[:, 0], cells, side = 'right') - 1
+        inside = index >= 0
+        inside[inside] = cells[inside] < self.ranges[index[inside], 1]
+
+        return inside
+
+    @classmethod
+    def from_cells(cls, order: int, cells) -> MOC:
+        """
+        Coverage of a list of cells of the same order
+
+        Args:
+            order (int): Order of the cells
+            cells (array-like): Cell indices
+
+        Returns:
+            MOC: Coverage
+        """
+
+        shift = 2 * (MAX_ORDER - order)
+        cells = np.asarray(cells, dtype = np.int64)
+
+        return cls(np.column_stack([cells << shift, (cells + 1) << shift]), order)
+
+    @classmethod
+    def from_uniq(cls, uniq) -> MOC:
+        """
+        Coverage of a list of cells in the NUNIQ encoding
+
+        Args:
+            uniq (array-like): NUNIQ indices (4 * 4**order + index)
+
+        Returns:
+            MOC: Coverage
+        """
+
+        uniq = np.asarray(uniq, dtype = np.int64)
+        orders = np.zeros(len(uniq), dtype = np.int64)
+        for order in range(1, MAX_ORDER + 1):
+            orders[uniq >= 4 * 4**order] = order
+        cells = uniq - 4 * 4**orders
+        shift = 2 * (MAX_ORDER - orders)
+
+        return cls(np.column_stack([cells << shift, (cells + 1) << shift]), int(orders.max()) if len(orders) > 0 else 0)
+
+    @classmethod
+    def from_json(cls, data) -> MOC:
+        """
+        Coverage of a JSON MOC, e.g. {"3": [12, 13], "4": [56]}
+
+        Args:
+            data (dict or str): JSON MOC, as a dictionary or a string
+
+        Returns:
+            MOC: Coverage
+        """
+
+        data = json.loads(data) if isinstance(data, str) else data
+        mocs = [cls.from_cells(int(order), cells) for order, cells in data.items()]
+
+        result = cls(max_order = max([int(order) for order in data] + [0]))
+        for moc in mocs:
+            result = result | moc
+
+        return result
+
+    @classmethod
+    def from_fits(cls, data: bytes) -> MOC:
+        """
+        Coverage of a FITS MOC (binary table of NUNIQ indices, or MOC 2.0 ranges of order 29)
+
+        Args:
+            data (bytes): Content of the FITS file
+
+        Returns:
+            MOC: Coverage
+        """
+
+        position, headers = 0, []
+        while position < len(data) and len(headers) < 2:
+            header = {}
+            while True:
+                block = data[position:position + 2880].decode('ascii')
+                position += 2880
+                for start in range(0, 2880, 80):
+                    card = block[start:start + 80]
+                    if card[:8].strip() == "END":
+                        break
+                    if card[8:10] == "= ":
+                        header[card[:8].strip()] = card[10:].split("/")[0].strip().strip("'").strip()
+                else:
+                    continue
+                break
+            headers.append(header)
+            if len(headers) == 1:
+                # Skip the data of the primary header (usually empty)
+                size = abs(int(header.get("BITPIX", 8))) // 8 * int(np.prod([int(header[f"NAXIS{axis}"]) for axis in range(1, int(header.get("NAXIS", 0)) + 1)]))
+                position += (size + 2879) // 2880 * 2880 if int(header.get("NAXIS", 0)) > 0 else 0
+
+        table = headers[-1]
+        dtype = {"J": ">i4", "K": ">i8"}[table["TFORM1"].strip()[-1]]
+        values = np.frombuffer(data[position:position + int(table["NAXIS1"]) * int(table["NAXIS2"])], dtype = dtype).astype(np.int64)
+
+        if table.get("ORDERING", "NUNIQ").upper() == "RANGE":
+            order = int(table.get("MOCORD_S", table.get("MOCORDER", MAX_ORDER)))
+            return cls(values.reshape(-1, 2), order)
+
+        return cls.from_uniq(values)
+
+    @classmethod
+    def read(cls, filename: str) -> MOC:
+        """
+        Read a MOC file, in the FITS or JSON format
+
+        Args:
+            filename (str): Path of the MOC file
+
+        Returns:
+            MOC: Coverage
+        """
+
+        with open(filename, 'rb') as f:
+            data = f.read()
+
+        if data[:6] == b"SIMPLE":
+            return cls.from_fits(data)
+
+        return cls.from_json(data.decode('utf-8'))
+
+    def to_json(self) -> dict:
+        """
+        Cells of the coverage as a JSON MOC
+
+        Returns:
+            dict: Cells of each order, as {"order": [cells]}
+        """
+
+        uniq, cells = self.uniq(), {}
+        for order in range(MAX_ORDER + 1):
+            selected = uniq[(uniq >= 4 * 4**order) & (uniq < 16 * 4**order)]
+            if len(selected) > 0:
+                cells[str(order)] = (selected - 4 * 4**order).tolist()
+
+        return cells
+
+    def write(self, filename: str) -> None:
+        """
+        Write the coverage as a FITS MOC (NUNIQ binary table) if the file name ends with .fits, as a JSON MOC otherwise
+
+        Args:
+            filename (str): Path of the MOC file
+        """
+
+        if not filename.lower().endswith((".fits", ".fit", ".fits.gz")):
+            with open(filename, 'w') as f:
+                json.dump(self.to_json(), f)
+            return
+
+        def header(cards):
+            # Strings start right after the '= ', other values end at the 30th column
+            text = "".join(key.ljust(80) if key == "END" else
+                           (f"{key:<8}= '{value:<8}'" if isinstance(value, str) else
+                            f"{key:<8}= {('T' if value else 'F') if isinstance(value, bool) else value:>20}").ljust(80)
+                           for key, value in cards)
+            return text.ljust((len(text) + 2879) // 2880 * 2880).encode('ascii')
+
+        uniq = self.uniq()
+        primary = header([("SIMPLE", True), ("BITPIX", 8), ("NAXIS", 0), ("EXTEND", True), ("END", None)])
+        table = header([("XTENSION", "BINTABLE"), ("BITPIX", 8), ("NAXIS", 2), ("NAXIS1", 8), ("NAXIS2", len(uniq)),
+                        ("PCOUNT", 0), ("GCOUNT", 1), ("TFIELDS", 1), ("TTYPE1", "UNIQ"), ("TFORM1", "1K"),
+                        ("PIXTYPE", "HEALPIX"), ("ORDERING", "NUNIQ"), ("COORDSYS", "C"), ("MOCVERS", "2.0"),
+                        ("MOCDIM", "SPACE"), ("MOCORDER", self.max_order), ("MOCTOOL", "obsfinder"), ("END", None)])
+        body = uniq.astype(">i8").tobytes()
+        body += b"\0" * ((len(body) + 2879) // 2880 * 2880 - len(body))
+
+        with open(filename, 'wb') as f:
+            f.write(primary + table + body)
+
+    @classmethod
+    def from_region(cls, inside, boundary: tuple, order: int) -> MOC:
+        """
+        Coverage of a region of Galactic coordinates. Cells whose vertices, edge midpoints and center are all
+        in the region are kept whole, cells partly in the region (or containing a point of its boundary) are
+        split, down to the order, at which they are kept.
+
+        Args:
+            inside (callable): Function of (l, b) (in degree) returning the boolean mask of the points in the region
+            boundary (tuple): Longitudes and latitudes of points along the boundary of the region (in degree)
+            order (int): Finest order of the cells
+
+        Returns:
+            MOC: Coverage of the region
+        """
+
+        boundary_ra, boundary_dec = galactic_to_icrs(*boundary)
+        cells, kept = np.arange(12, dtype = np.int64), []
+
+        for level in range(order + 1):
+            lon, lat = cell_points(level, cells, step = 2)
+            l, b = icrs_to_galactic(lon, lat)
+            points = inside(l, b)
+            crossed = np.isin(cells, ang2pix(level, boundary_ra, boundary_dec))
+
+            full = points.all(axis = 1) & ~crossed
+            partial = ~full & (points.any(axis = 1) | crossed)
+            kept.append(MOC.from_cells(level, cells[full]))
+
+            if level == order:
+                kept.append(MOC.from_cells(level, cells[partial]))
+            else:
+                cells = (cells[partial][:, None] * 4 + np.arange(4)).ravel()
+
+        result = cls(max_order = order)
+        for moc in kept:
+            result = result | moc
+        result.max_order = order
+
+        return result
+
+    @classmethod
+    def from_box(cls, lmin: float, lmax: float, bmin: float, bmax: float, order: int = 10) -> MOC:
+        """
+        Coverage of a box of Galactic coordinates
+
+        Args:
+            lmin (float): Lowest longitude (in degree). If lmin > lmax, the box contains l = 0.
+            lmax (float): Highest longitude (in degree)
+            bmin (float): Lowest latitude (in degree)
+            bmax (float): Highest latitude (in degree)
+            order (int, optional): Finest order of the cells (10: 3.4 arcmin). Default to 10.
+
+        Returns:
+            MOC: Coverage of the box
+        """
+
+        lmin, lmax = np.mod(lmin, 360), np.mod(lmax, 360)
+        width = np.mod(lmax - lmin, 360) if lmax != lmin else 360
+
+        def inside(l, b):
+            return (np.mod(l - lmin, 360) <= width) & (b >= bmin) & (b <= bmax)
+
+        # Points along the edges, closer than the cells of the order
+        count = int(max(width, bmax - bmin) / (58.6 / 2**order) * 4) + 2
+        t = np.linspace(0, 1, count)
+        l = np.concatenate([lmin + t * width, lmin + t * width, np.full(count, lmin), np.full(count, lmin + width)])
+        b = np.concatenate([np.full(count, bmin), np.full(count, bmax), bmin + t * (bmax - bmin), bmin + t * (bmax - bmin)])
+
+        return cls.from_region(inside, (l, b), order)
+
+    @classmethod
+    def from_cone(cls, lvalue: float, bvalue: float, radius: float, order: int = 10) -> MOC:
+        """
+        Coverage of a cone of Galactic coordinates
+
+        Args:
+            lvalue (float): Galactic longitude of the center (in degree)
+            bvalue (float): Galactic latitude of the center (in degree)
+            radius (float): Radius of the cone (in arcmin)
+            order (int, optional): Finest order of the cells (10: 3.4 arcmin). Default to 10.
+
+        Returns:
+            MOC: Coverage of the cone
+        """
+
+        l0, b0, radius = np.radians(lvalue), np.radians(bvalue), np.radians(radius / 60)
+
+        def inside(l, b):
+            l, b = np.radians(l), np.radians(b)
+            return np.sin(b) * np.sin(b0) + np.cos(b) * np.cos(b0) * np.cos(l - l0) >= np.cos(radius)
+
+        # Points along the circle, closer than the cells of the order
+        count = int(2 * np.pi * np.degrees(radius) / (58.6 / 2**order) * 4) + 8
+        angle = np.linspace(0, 2 * np.pi, count, endpoint = False)
+        b = np.arcsin(np.sin(b0) * np.cos(radius) + np.cos(b0) * np.sin(radius) * np.cos(angle))
+        l = l0 + np.arctan2(np.sin(angle) * np.sin(radius) * np.cos(b0), np.cos(radius) - np.sin(b0) * np.sin(b))
+        boundary = (np.degrees(np.concatenate([l, [l0]])), np.degrees(np.concatenate([b, [b0]])))
+
+        return cls.from_region(inside, boundary, order)
+
+def source_id_conditions(moc: MOC, column: str = "source_id", max_ranges: int = 500) -> list:
+    """
+    ADQL conditions selecting the Gaia sources of a coverage by their source_id, which holds the index of
+    their HEALPix cell of order 12 (source_id // 2**35). The coverage is enlarged to cells of order 12, so
+    that the sources have to be filtered with MOC.contains if the coverage has finer cells.
+
+    Args:
+        moc (MOC): Coverage
+        column (str, optional): Name of the source_id column in the query. Default to 'source_id'.
+        max_ranges (int, optional): Maximum number of ranges in a single condition. Default to 500.
+
+    Returns:
+        list: Conditions, to be used in separate queries
+    """
+
+    ranges = moc.degrade(GAIA_ORDER) << 35
+    terms = [f"{column} BETWEEN {start} AND {end - 1}" for start, end in ranges.tolist()]
+
+    return ["(" + " OR ".join(terms[start:start + max_ranges]) + ")" for start in range(0, len(terms), max_ranges)]
+
+def box_conditions(moc: MOC, ra: str = "ra", dec: str = "dec", max_boxes: int = 64) -> list:
+    """
+    ADQL condition selecting the sources of a coverage by their equatorial coordinates, for the tables
+    without HEALPix index: a union of boxes of right ascension and declination, enclosing the cells of the
+    coverage at the finest order with at most max_boxes cells. The sources have then to be filtered with
+    MOC.contains.
+
+    Args:
+        moc (MOC): Coverage
+        ra (str, optional): Name of the right ascension column. Default to 'ra'.
+        dec (str, optional): Name of the declination column. Default to 'dec'.
+        max_boxes (int, optional): Maximum number of boxes. Default to 64.
+
+    Returns:
+        list: Conditions, to be used in separate queries (a single one)
+    """
+
+    order = moc.max_order
+    while order > 0 and moc.count(order) > max_boxes:
+        order -= 1
+
+    lon, lat = cell_points(order, moc.cells(order), step = 8)
+    size = 58.6 / 2**order
+    margin = size / 100 + 1 / 3600
+    boxes = []
+    for cell_lon, cell_lat in zip(lon, lat):
+        low, high = cell_lat.min() - margin, cell_lat.max() + margin
+        # Cells close to a pole cover all the right ascensions
+        if high >= 90 - size or low <= -90 + size:
+            boxes.append(f"{dec} BETWEEN {max(low, -90)} AND {min(high, 90)}")
+            continue
+        # Right ascensions around the center of the cell, to find the cells crossing ra = 0
+        center = cell_lon[-1]
+        offsets = np.mod(cell_lon - center + 180, 360) - 180
+        ra_margin = margin / np.cos(np.radians(max(abs(low), abs(high))))
+        start, end = center + offsets.min() - ra_margin, center + offsets.max() + ra_margin
+        if start < 0 or end > 360:
+            start, end = np.mod(start, 360), np.mod(end, 360)
+            boxes.append(f"(({ra} >= {start} OR {ra} <= {end}) AND {dec} BETWEEN {low} AND {high})")
+        else:
+            boxes.append(f"({ra} BETWEEN {start} AND {end} AND {dec} BETWEEN {low} AND {high})")
+
+    return ["(" + " OR ".join(boxes) + ")"] if len(boxes) > 0 else []
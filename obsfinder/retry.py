@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+
+from .errors import TransientNetworkError
+from .lazy import lazy_import
+import time
+
+random = lazy_import("random")
+
+class RetryPolicy():
+    """
+    This class defines how transient errors are retried: exponential backoff with full jitter,
+    i.e. the n-th retry waits a random time between 0 and min(max_delay, base_delay * 2**n).
+    """
+
+    def __init__(self, max_attempts: int = 5, base_delay: float = 1., max_delay: float = 60.,
+                 retry_on: tuple = (TransientNetworkError,), verbose: int = 0) -> None:
+        """
+        Initialize the class
+
+        Args:
+            max_attempts (int, optional):
+                Maximum number of attempts, including the first one. Default to 5.
+            base_delay (float, optional):
+                Delay before the first retry, before jitter (in second). Default to 1.
+            max_delay (float, optional):
+                Maximum delay between two attempts (in second). Default to 60.
+            retry_on (tuple, optional):
+                Exceptions that are retried. Default to (TransientNetworkError,).
+            verbose (int, optional):
+                Toggle verbose (1 or 0). Default to 0.
+        """
+
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_on = retry_on
+        self.verbose = verbose
+
+    def delay(self, attempt: int) -> float:
+        """
+        Time to wait before the given retry
+
+        Args:
+            attempt (int): Number of the failed attempt (starting at 0)
+
+        Returns:
+            float: Delay (in second)
+        """
+
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+
+    def call(self, function, *args, metrics = None, **kwargs):
+        """
+        Call a function, retrying it while it raises one of the retried exceptions
+
+        Args:
+            function (callable): Function to call
+            *args: Arguments of the function
+            metrics (QueryMetrics, optional): Metrics in which the number of retries is counted. Default to None.
+            **kwargs: Keyword arguments of the function
+
+        Returns:
+            Value returned by the function
+        """
+
+        for attempt in range(self.max_attempts):
+            try:
+                return function(*args, **kwargs)
+            except self.retry_on as error:
+                if attempt == self.max_attempts - 1:
+                    raise
+
+                delay = self.delay(attempt)
+                if self.verbose:
+                    print(f"{error}, retrying in {delay:.1f} s ({attempt + 1}/{self.max_attempts - 1})")
+                if metrics is not None:
+                    metrics.count('retries', 1)
+
+                time.sleep(delay)
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from .lazy import lazy_import
+from contextlib import contextmanager
+import threading
+import time
+import os
+
+json = lazy_import("json")
+uuid = lazy_import("uuid")
+
+try:
+    import fcntl
+except ImportError:
+    # No file locks (Windows): the limits are only shared by the threads of a process
+    fcntl = None
+
+# Priority classes, first served first
+PRIORITIES = ["interactive", "bulk"]
+
+class HostLimits():
+    """
+    This class holds the limits of the requests sent to one host: number of jobs running at the same time,
+    and rate of the requests (token bucket: rate tokens per second, at most burst tokens kept).
+    """
+
+    def __init__(self, max_jobs: int = 4, rate: float = 5., burst: int = 10, reserved: int = 1) -> None:
+        """
+        Initialize the class
+
+        Args:
+            max_jobs (int, optional):
+                Maximum number of jobs running at the same time on the host. Default to 4.
+            rate (float, optional):
+                Maximum number of requests (submits, polls, downloads) per second, on average. Default to 5.
+            burst (int, optional):
+                Maximum number of requests sent at once after an idle period. Default to 10.
+            reserved (int, optional):
+                Number of job slots that only interactive queries can use, so that they never wait for a bulk batch.
+                At least one slot is left to bulk queries. Default to 1.
+        """
+
+        self.max_jobs = max_jobs
+        self.rate = rate
+        self.burst = burst
+        self.reserved = reserved
+
+    def capacity(self, priority: str) -> int:
+        """
+        Number of job slots a priority class can use
+
+        Args:
+            priority (str): 'interactive' or 'bulk'
+
+        Returns:
+            int: Number of slots
+        """
+
+        if priority == "interactive":
+            return self.max_jobs
+        return max(1, self.max_jobs - self.reserved)
+
+# Limits of the archives queried by the finders, and of the other hosts
+DEFAULT_LIMITS = {"gea.esac.esa.int": HostLimits(max_jobs = 4, rate = 5., burst = 10),
+                  "irsa.ipac.caltech.edu": HostLimits(max_jobs = 4, rate = 5., burst = 10),
+                  "simbad.u-strasbg.fr": HostLimits(max_jobs = 4, rate = 5., burst = 10)}
+DEFAULT_HOST_LIMITS = HostLimits(max_jobs = 8, rate = 10., burst = 20)
+
+# Name of the node, recorded with the jobs and waits so that only the processes of this node are checked
+HOSTNAME = os.uname().nodename if hasattr(os, "uname") else os.environ.get("COMPUTERNAME", "")
+
+def default_directory() -> str:
+    """
+    Default directory of the state of the scheduler, local to the node (the home directory may be shared by the nodes
+    of a cluster, where the processes of the other nodes cannot be seen)
+
+    Returns:
+        str: $XDG_RUNTIME_DIR/obsfinder/scheduler, or /tmp/obsfinder-<uid>/scheduler if XDG_RUNTIME_DIR is not set
+            ($TMPDIR instead of /tmp if it is set)
+    """
+
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], "obsfinder", "scheduler")
+
+    user = os.getuid() if hasattr(os, "getuid") else os.environ.get("USERNAME", "user")
+    return os.path.join(os.environ.get("TMPDIR", "/tmp"), f"obsfinder-{user}", "scheduler")
+
+def read_limits(filename: str) -> dict:
+    """
+    Read the limits of some hosts from a json file {host: {"max_jobs": ..., "rate": ..., "burst": ..., "reserved": ...}}
+
+    Args:
+        filename (str): Path of the json file
+
+    Returns:
+        dict: Limits of each host, as {host: HostLimits}
+    """
+
+    with open(filename) as f:
+        return {host: HostLimits(**options) for host, options in json.load(f).items()}
+
+def new_state() -> dict:
+    """
+    State of a host that has no job running and no query waiting
+
+    Returns:
+        dict: State (tokens, time of the last refill, jobs, waiting)
+    """
+
+    return {"tokens": None, "time": 0., "jobs": {}, "waiting": {}}
+
+def read_state(filename: str) -> dict:
+    """
+    Read the state of a host
+
+    Args:
+        filename (str): Path of the json file of the host
+
+    Returns:
+        dict: State of the host, a new state if the file does not exist or cannot be read
+    """
+
+    try:
+        with open(filename) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return new_state()
+
+    if not isinstance(state, dict) or not all(isinstance(state.get(key), dict) for key in ("jobs", "waiting")):
+        return new_state()
+
+    return {**new_state(), **state}
+
+def process_alive(pid: int, node: str = None) -> bool:
+    """
+    Whether a process is still running
+
+    Args:
+        pid (int): Process id
+        node (str, optional): Name of the node running the process. The processes of other nodes cannot be checked,
+            and are taken as running. Default to None (this node).
+
+    Returns:
+        bool: False if the process does not exist anymore
+    """
+
+    if node is not None and node != HOSTNAME:
+        return True
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+
+    return True
+
+class Scheduler():
+    """
+    This class schedules the requests sent to the TAP services: it caps the number of jobs running at the same time
+    on each host (slot), and limits the rate of the requests with a token bucket (throttle). Waiting queries are
+    served by priority class ('interactive' before 'bulk'), then in their order of arrival, so that a large batch
+    does not starve the small lookups of another catalog or user.
+
+    The state of each host (jobs running, tokens, queries waiting) is kept in a json file locked while it is updated,
+    so that the limits are shared by the threads and processes of the node (asyncio tasks run the finders in threads).
+    Jobs and waits of processes of this node that died are forgotten.
+    """
+
+    def __init__(self, limits: dict = None, directory: str = None, shared: bool = True, poll_interval: float = 0.05, verbose: int = 0) -> None:
+        """
+        Initialize the class
+
+        Args:
+            limits (dict, optional):
+                Limits of some hosts, as {host: HostLimits}, added to DEFAULT_LIMITS. The json file given by the
+                OBSFINDER_LIMITS environment variable (see read_limits) is also read if set. Default to None.
+            directory (str, optional):
+                Directory of the state files of the hosts. Default to default_directory().
+            shared (bool, optional):
+                Share the limits with the other processes of the node. If False, or if the directory cannot be written,
+                they are only shared by the threads of the process. Default to True.
+            poll_interval (float, optional):
+                Time between two checks of a query waiting for a slot or a token (in second). Default to 0.05.
+            verbose (int, optional):
+                Toggle verbose (1 or 0). Default to 0.
+        """
+
+        self.limits = dict(DEFAULT_LIMITS)
+        if os.environ.get("OBSFINDER_LIMITS"):
+            self.limits.update(read_limits(os.environ["OBSFINDER_LIMITS"]))
+        self.limits.update(limits or {})
+        self.directory = directory if directory is not None else default_directory()
+        self.shared = shared and fcntl is not None
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.states = {}
+
+    def configure(self, host: str, **options) -> None:
+        """
+        Set the limits of a host
+
+        Args:
+            host (str): Host of the TAP service
+            **options: Arguments of HostLimits (max_jobs, rate, burst, reserved)
+        """
+
+        with self.lock:
+            self.limits[host] = HostLimits(**options)
+
+    def limits_of(self, host: str) -> HostLimits:
+        """
+        Limits of a host
+
+        Args:
+            host (str): Host of the TAP service
+
+        Returns:
+            HostLimits: Limits of the host, DEFAULT_HOST_LIMITS if it has none
+        """
+
+        return self.limits.get(host, DEFAULT_HOST_LIMITS)
+
+    @contextmanager
+    def state(self, host: str):
+        """
+        Context manager giving the state of a host, locked for the threads and processes of the node until the block ends
+
+        Args:
+            host (str): Host of the TAP service
+        """
+
+        with self.lock:
+            if self.shared:
+                try:
+                    os.makedirs(self.directory, exist_ok = True)
+                    filename = os.path.join(self.directory, f"{host.replace(os.sep, '_')}.json")
+                    lock = open(filename + ".lock", "a")
+                except OSError as error:
+                    if self.verbose:
+                        print(f"Could not share the limits of the requests in {self.directory}: {error}")
+                    self.shared = False
+
+            if not self.shared:
+                yield self.states.setdefault(host, new_state())
+                return
+
+            # The state file is replaced at each update, the lock is taken on a separate file
+            with lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                state = read_state(filename)
+
+                # Forget the jobs and waits of the processes that died
+                for entries in (state["jobs"], state["waiting"]):
+                    for ident in [ident for ident, entry in entries.items() if not process_alive(entry["pid"], entry.get("node"))]:
+                        del entries[ident]
+
+                yield state
+
+                # Written to a temporary file then renamed, so that a process killed while writing never leaves a partial state
+                temporary = f"{filename}.{os.getpid()}.tmp"
+                with open(temporary, "w") as f:
+                    json.dump(state, f)
+                os.replace(temporary, filename)
+
+    def acquire(self, host: str, priority: str, resource: str) -> tuple[str, float]:
+        """
+        Wait for a job slot or a token of a host, serving the waiting queries by priority class then by order of arrival
+
+        Args:
+            host (str): Host of the TAP service
+            priority (str): 'interactive' or 'bulk'
+            resource (str): 'slot' or 'token'
+
+        Returns:
+            tuple[str, float]: Identifier of the slot (or token), and time waited (in second)
+        """
+
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority: {priority}, must be one of {', '.join(PRIORITIES)}")
+
+        limits = self.limits_of(host)
+        ident = f"{os.getpid()}-{threading.get_ident()}-{uuid.uuid4().hex[:8]}"
+        entry = {"pid": os.getpid(), "node": HOSTNAME, "priority": priority, "resource": resource, "time": time.time()}
+        start = time.time()
+
+        try:
+            while True:
+                with self.state(host) as state:
+                    state["waiting"].setdefault(ident, entry)
+                    if self.grant(state, limits, ident, entry):
+                        del state["waiting"][ident]
+                        return ident, time.time() - start
+
+                time.sleep(self.poll_interval)
+        except BaseException:
+            with self.state(host) as state:
+                state["waiting"].pop(ident, None)
+            raise
+
+    def grant(self, state: dict, limits: HostLimits, ident: str, entry: dict) -> bool:
+        """
+        Give a slot or a token to a waiting query, if it is available and no query before it waits for the same resource
+
+        Args:
+            state (dict): State of the host, updated if the resource is given
+            limits (HostLimits): Limits of the host
+            ident (str): Identifier of the query
+            entry (dict): Priority, resource and time of arrival of the query
+
+        Returns:
+            bool: True if the resource is given
+        """
+
+        rank = lambda item: (PRIORITIES.index(item[1]["priority"]), item[1]["time"], item[0])
+        waiting = sorted((item for item in state["waiting"].items() if item[1]["resource"] == entry["resource"]), key = rank)
+        if len(waiting) > 0 and waiting[0][0] != ident:
+            return False
+
+        if entry["resource"] == "slot":
+            if len(state["jobs"]) >= limits.capacity(entry["priority"]):
+                return False
+            state["jobs"][ident] = {"pid": entry["pid"], "node": entry["node"], "priority": entry["priority"], "time": time.time()}
+            return True
+
+        # Token bucket, refilled at the rate of the host
+        now = time.time()
+        tokens = limits.burst if state["tokens"] is None else min(limits.burst, state["tokens"] + (now - state["time"]) * limits.rate)
+        state["tokens"], state["time"] = tokens, now
+        if tokens < 1:
+            return False
+        state["tokens"] = tokens - 1
+        return True
+
+    @contextmanager
+    def slot(self, host: str, priority: str = "bulk"):
+        """
+        Context manager holding one of the job slots of a host while the block runs (from the submission of a job to the
+        download of its results)
+
+        Args:
+            host (str): Host of the TAP service
+            priority (str, optional): 'interactive' or 'bulk'. Default to 'bulk'.
+
+        Returns:
+            float: Time waited for the slot (in second)
+        """
+
+        ident, waited = self.acquire(host, priority, "slot")
+        try:
+            yield waited
+        finally:
+            with self.state(host) as state:
+                state["jobs"].pop(ident, None)
+
+    def throttle(self, host: str, priority: str = "bulk") -> float:
+        """
+        Wait until a request can be sent to a host without exceeding its rate
+
+        Args:
+            host (str): Host of the TAP service
+            priority (str, optional): 'interactive' or 'bulk'. Default to 'bulk'.
+
+        Returns:
+            float: Time waited (in second)
+        """
+
+        return self.acquire(host, priority, "token")[1]
+
+    def status(self, host: str) -> dict:
+        """
+        State of a host
+
+        Args:
+            host (str): Host of the TAP service
+
+        Returns:
+            dict: Number of jobs running and of queries waiting for each priority class, and tokens left
+        """
+
+        with self.state(host) as state:
+            return {"jobs": {priority: sum(job["priority"] == priority for job in state["jobs"].values()) for priority in PRIORITIES},
+                    "waiting": {priority: sum(entry["priority"] == priority for entry in state["waiting"].values()) for priority in PRIORITIES},
+                    "tokens": state["tokens"]}
+
+# Scheduler shared by all the TAP services of the process
+SCHEDULER = Scheduler()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from .lazy import lazy_import
+import threading
+import time
+import re
+import os
+
+minidom = lazy_import("xml.dom.minidom")
+json = lazy_import("json")
+
+# Kind of the values of each TAP datatype (VOTable or ADQL names): 'int', 'float', or 'str'
+KINDS = {"short": "int", "int": "int", "long": "int", "unsignedbyte": "int", "smallint": "int", "integer": "int", "bigint": "int",
+         "float": "float", "double": "float", "real": "float", "double precision": "float"}
+
+# Words that can follow a table name in a FROM clause, and are not an alias
+KEYWORDS = {"left", "right", "inner", "outer", "full", "cross", "natural", "join", "on", "where", "group", "order", "using"}
+
+def default_filename() -> str:
+    """
+    Default path of the local copy of the TAP metadata
+
+    Returns:
+        str: $XDG_CACHE_HOME/obsfinder/tap_tables.json (~/.cache if XDG_CACHE_HOME is not set)
+    """
+
+    cache = os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache, "obsfinder", "tap_tables.json")
+
+def parse_tables(data: bytes) -> dict:
+    """
+    Read the columns of the tables described by a VOSI tables document (/tables endpoint of a TAP service)
+
+    Args:
+        data (bytes): VOSI tables document
+
+    Returns:
+        dict: Kind of each column of each table, as {table: {column: kind}}, names in lower case
+    """
+
+    tables = {}
+    for table in minidom.parseString(data).getElementsByTagNameNS("*", "table"):
+        names = [node for node in table.childNodes if node.nodeType == node.ELEMENT_NODE and node.localName == "name"]
+        if len(names) == 0:
+            continue
+
+        columns = {}
+        for column in table.getElementsByTagNameNS("*", "column"):
+            name = [node for node in column.childNodes if node.nodeType == node.ELEMENT_NODE and node.localName == "name"]
+            datatype = column.getElementsByTagNameNS("*", "dataType")
+            if len(name) == 0 or len(datatype) == 0:
+                continue
+            kind = datatype[0].firstChild.data.strip().lower().split(":")[-1] if datatype[0].firstChild else ""
+            columns[name[0].firstChild.data.strip().strip('"').lower()] = KINDS.get(kind, "str")
+
+        tables[names[0].firstChild.data.strip().strip('"').lower()] = columns
+
+    return tables
+
+def select_columns(query: str) -> tuple[list, dict]:
+    """
+    Find the columns selected by an ADQL query, and the tables they come from
+
+    Args:
+        query (str): ADQL query
+
+    Returns:
+        tuple[list, dict]: Selected columns, as (output name, table or alias, column) (table is None if the column is
+            not qualified, and the item is skipped if it is not a column), and the table of each alias or table name
+    """
+
+    match = re.search(r"\bSELECT\s+(?:DISTINCT\s+)?(?:TOP\s+\d+\s+)?(.*?)(\bFROM\b.*)", query, re.IGNORECASE | re.DOTALL)
+    if match is None:
+        return [], {}
+
+    items, depth, start = [], 0, 0
+    select = match.group(1)
+    for position, character in enumerate(select):
+        depth += (character == "(") - (character == ")")
+        if character == "," and depth == 0:
+            items.append(select[start:position])
+            start = position + 1
+    items.append(select[start:])
+
+    columns = []
+    for item in items:
+        column = re.fullmatch(r'\s*(?:([\w.]+)\.)?(\w+)(?:\s+AS\s+"?([^"]+?)"?)?\s*', item, re.IGNORECASE)
+        if column is not None:
+            table, name, alias = column.groups()
+            columns.append(((alias or name).lower(), table.lower() if table else None, name.lower()))
+
+    tables = {}
+    for table, alias in re.findall(r"\b(?:FROM|JOIN)\s+([\w.]+)(?:\s+(?:AS\s+)?(\w+))?", match.group(2), re.IGNORECASE):
+        table = table.lower()
+        tables[table] = table
+        tables[table.split(".")[-1]] = table
+        if alias and alias.lower() not in KEYWORDS:
+            tables[alias.lower()] = table
+
+    return columns, tables
+
+class TableSchema():
+    """
+    This class keeps the metadata of the tables of the TAP services (the type of their columns), so
+    that the results of the queries are parsed straight into the right types. The metadata of a
+    table is fetched once from the /tables endpoint of its service, and kept in a local JSON file
+    until it expires. It can be shared by several threads.
+    """
+
+    def __init__(self, filename: str = None, ttl: float = 30 * 86400, verbose: int = 0) -> None:
+        """
+        Initialize the class. The local copy of the metadata is loaded on first use.
+
+        Args:
+            filename (str, optional): Path of the local copy of the metadata. Default to default_filename().
+            ttl (float, optional): Time after which the metadata of a table is fetched again (in second). Default to 30 days.
+            verbose (int, optional): Toggle verbose (1 or 0). Default to 0.
+        """
+
+        self.filename = filename if filename != None else default_filename()
+        self.ttl = ttl
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.services = None
+        self.failed = set()
+
+    def load(self) -> None:
+        """
+        Load the local copy of the metadata, if it exists
+        """
+
+        self.services = {}
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename) as f:
+                    self.services = json.load(f)
+            except (OSError, ValueError):
+                self.services = {}
+
+    def save(self) -> None:
+        """
+        Write the local copy of the metadata
+        """
+
+        try:
+            os.makedirs(os.path.dirname(self.filename) or ".", exist_ok = True)
+            with open(self.filename + ".tmp", 'w') as f:
+                json.dump(self.services, f)
+            os.replace(self.filename + ".tmp", self.filename)
+        except OSError as error:
+            if self.verbose:
+                print(f"Could not write the TAP metadata to {self.filename}: {error}")
+
+    def tables(self, tap, names: list) -> dict:
+        """
+        Get the columns of some tables of a TAP service, fetching the ones missing (or expired) from the service
+
+        Args:
+            tap (TapService): Service of the tables
+            names (list): Names of the tables, in lower case
+
+        Returns:
+            dict: Kind of each column of each table found, as {table: {column: kind}}
+        """
+
+        base = tap.pathinfo.rsplit("/async", 1)[0]
+        service = f"{tap.host}{base}"
+
+        with self.lock:
+            if self.services is None:
+                self.load()
+            known = self.services.setdefault(service, {})
+            missing = [name for name in names if not name.startswith("tap_upload.") and (service, name) not in self.failed
+                       and (name not in known or known[name]["time"] < time.time() - self.ttl)]
+
+            if len(missing) > 0:
+                try:
+                    response, data = tap.request("GET", f"{base}/tables?tables={','.join(missing)}")
+                    fetched = parse_tables(data) if response.status == 200 else {}
+                except Exception as error:
+                    fetched = {}
+                    if self.verbose:
+                        print(f"Could not get the metadata of {', '.join(missing)} from {service}: {error}")
+
+                now = time.time()
+                for name, columns in fetched.items():
+                    known[name] = {"time": now, "columns": columns}
+                    if "." in name:
+                        known[name.split(".")[-1]] = known[name]
+                self.failed.update((service, name) for name in missing if name not in known)
+                if len(fetched) > 0:
+                    self.save()
+
+            return {name: known[name]["columns"] for name in names if name in known}
+
+    def kinds(self, tap, query: str) -> dict:
+        """
+        Kind of the columns returned by a query
+
+        Args:
+            tap (TapService): Service running the query
+            query (str): ADQL query
+
+        Returns:
+            dict: Kind ('int', 'float' or 'str') of each output column whose table is known, as {column: kind}, names in lower case
+        """
+
+        columns, aliases = select_columns(query)
+        tables = self.tables(tap, sorted(set(aliases.values())))
+
+        kinds = {}
+        for output, table, name in columns:
+            candidates = [aliases.get(table)] if table is not None else list(dict.fromkeys(aliases.values()))
+            for candidate in candidates:
+                if name in tables.get(candidate, {}):
+                    kinds[output] = tables[candidate][name]
+                    break
+
+        return kinds
+
+# Metadata shared by all the TAP services of the process
+SCHEMA = TableSchema()
@@ -0,0 +1,918 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+from .metrics import QueryMetrics
+from .journal import JobJournal
+from .errors import QueryError, JobFailed, TransientNetworkError
+from .retry import RetryPolicy
+from .schema import TableSchema, SCHEMA
+from .scheduler import Scheduler, SCHEDULER
+from .lazy import lazy_import
+from contextlib import nullcontext
+import threading
+import io
+import time
+import zlib
+import csv
+
+httplib = lazy_import("http.client")
+minidom = lazy_import("xml.dom.minidom")
+pd = lazy_import("pandas")
+np = lazy_import("numpy")
+urllib = lazy_import("urllib.parse")
+uuid = lazy_import("uuid")
+
+# Size of the compressed chunks decoded at once, and of the buffer of the decoded result
+CHUNK_SIZE = 1 << 16
+
+class DecodedStream(io.RawIOBase):
+    """
+    This class reads a result sent with a gzip or deflate Content-Encoding from the open response, decompressing it
+    chunk by chunk as it is received, so that neither the compressed nor the decoded result is held in memory at once.
+    The connection is given back (release) once the response is read to its end, and closed if the stream is closed before.
+    """
+
+    def __init__(self, source, encoding: str, metrics: QueryMetrics = None, release = None) -> None:
+        """
+        Initialize the class
+
+        Args:
+            source (httplib.HTTPResponse): Response whose content is not read yet
+            encoding (str): Content-Encoding of the response ('gzip', 'x-gzip' or 'deflate')
+            metrics (QueryMetrics, optional): Metrics in which the sizes of the received and decoded content are counted
+                once it is read. Default to None.
+            release (callable, optional): Function called with True once the response is read to its end (the connection
+                can be reused), or with False if the stream is closed before. Default to None.
+        """
+
+        self.source = source
+        self.encoding = encoding
+        self.metrics = metrics
+        self.release = release
+        self.received = 0
+        self.pending = b""
+        self.decoded = 0
+        self.done = False
+        self.raw = False
+        # Deflate is sent with a zlib header by most servers, and as raw deflate by a few (see decode)
+        self.decoder = zlib.decompressobj(zlib.MAX_WBITS | 16 if "gzip" in encoding else zlib.MAX_WBITS)
+
+    def readable(self) -> bool:
+        return True
+
+    def decode(self, chunk: bytes) -> bytes:
+        """
+        Decompress a chunk of the response
+
+        Args:
+            chunk (bytes): Chunk received, empty at the end of the response
+
+        Returns:
+            bytes: Decoded content
+        """
+
+        try:
+            return self.decoder.decompress(chunk) if len(chunk) > 0 else self.decoder.flush()
+        except zlib.error as error:
+            if self.encoding != "deflate" or self.received > 0 or self.raw:
+                self.close()
+                raise QueryError(f"Could not decode the {self.encoding} result: {error}") from error
+            self.decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            self.raw = True
+            return self.decode(chunk)
+
+    def finish(self) -> None:
+        """
+        Read the end of the response, give the connection back and count the sizes of the result
+        """
+
+        self.done = True
+        try:
+            # Anything left after the compressed data (end of a chunked body), so that the connection can be reused
+            self.source.read()
+            complete = True
+        except (OSError, httplib.HTTPException):
+            complete = False
+
+        if self.release is not None:
+            self.release(complete)
+            self.release = None
+
+        if self.metrics is not None:
+            self.metrics.count('bytes_downloaded', self.received)
+            self.metrics.count('bytes_decoded', self.decoded + len(self.pending))
+
+    def readinto(self, buffer) -> int:
+        while len(self.pending) == 0 and not self.done:
+            try:
+                chunk = self.source.read(CHUNK_SIZE)
+            except (OSError, httplib.HTTPException) as error:
+                self.close()
+                raise TransientNetworkError(f"Download of the result interrupted: {error!r}") from error
+            if len(chunk) == 0 and not self.decoder.eof:
+                # The response ended before the end of the compressed data
+                self.close()
+                raise TransientNetworkError(f"Download of the result interrupted after {self.received} bytes")
+            self.pending = self.decode(chunk)
+            self.received += len(chunk)
+            if len(chunk) == 0 or self.decoder.eof:
+                self.pending += self.decoder.flush()
+                self.finish()
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        self.decoded += size
+
+        return size
+
+    def close(self) -> None:
+        # Closed before the end of the response: the connection cannot be reused
+        if self.release is not None:
+            self.release(False)
+            self.release = None
+        super().close()
+
+def parse_csv(data, kinds: dict = None) -> pd.DataFrame:
+    """
+    Convert the csv result of a TAP job into a DataFrame. Empty values are replaced by nan.
+
+    Args:
+        data (str or io.BufferedReader): Content of the csv result, or stream of the decoded result (see DecodedStream)
+        kinds (dict, optional): Kind ('int', 'float' or 'str') of the columns, as {column: kind} with names in lower case
+            (see TableSchema.kinds). Integer columns with missing values are read as float. The type of the other columns
+            is guessed by the csv parser. Default to None.
+
+    Returns:
+        pd.DataFrame: Dataframe containing the data
+    """
+
+    if isinstance(data, str):
+        start, source = data, io.StringIO(data)
+    else:
+        # Only the first decoded bytes of a stream are looked at before parsing it
+        start, source = data.peek(CHUNK_SIZE).decode('iso-8859-1'), io.TextIOWrapper(data, encoding = 'iso-8859-1')
+
+    if start.strip() == "":
+        return pd.DataFrame()
+
+    kinds = kinds if kinds is not None else {}
+    header = next(csv.reader(io.StringIO(start[:start.find("\n")] if "\n" in start else start)))
+    dtypes = {column: {"int": "Int64", "float": "float64", "str": object}[kinds[column.lower()]]
+              for column in header if column.lower() in kinds}
+
+    # Quoted values containing commas or spaces (identifiers) are kept as they are
+    data = pd.read_csv(source, dtype = dtypes, keep_default_na = False, na_values = [""], skip_blank_lines = True)
+
+    for column in data.columns:
+        if isinstance(data[column].dtype, pd.Int64Dtype):
+            data[column] = data[column].astype(np.int64 if data[column].notna().all() else np.float64)
+        elif pd.api.types.is_object_dtype(data[column].dtype) or pd.api.types.is_string_dtype(data[column].dtype):
+            data[column] = data[column].replace(r'^\s*$', np.nan, regex=True)
+
+    return data
+
+def encode_multipart(params: dict, uploads: dict) -> tuple[bytes, str]:
+    """
+    Encode the parameters of a query and the tables uploaded with it as multipart/form-data
+
+    Args:
+        params (dict): Parameters of the query
+        uploads (dict): Tables to upload, as {name: VOTable content}
+
+    Returns:
+        tuple[bytes, str]: Body of the request and its content type
+    """
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in params.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode('utf-8'))
+    for name, table in uploads.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{name}.xml"\r\n'
+                     f'Content-Type: application/x-votable+xml\r\n\r\n'.encode('utf-8') + table + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode('utf-8'))
+
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+class ConnectionPool():
+    """
+    This class keeps the idle connections to the TAP services open, so that successive requests
+    to the same service reuse their TCP and TLS sessions instead of opening new ones. A connection
+    is used by one request at a time, and the pool can be shared by several threads.
+    """
+
+    def __init__(self, max_idle: int = 8) -> None:
+        """
+        Initialize the class
+
+        Args:
+            max_idle (int, optional):
+                Maximum number of idle connections kept per service. Default to 8.
+        """
+
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def get(self, key: tuple):
+        """
+        Take an idle connection out of the pool
+
+        Args:
+            key (tuple): Service of the connection (host, port, proxy)
+
+        Returns:
+            httplib.HTTPSConnection: Idle connection, None if there is none
+        """
+
+        with self.lock:
+            connections = self.idle.get(key)
+            return connections.pop() if connections else None
+
+    def put(self, key: tuple, connection) -> None:
+        """
+        Give back a connection whose response has been fully read
+
+        Args:
+            key (tuple): Service of the connection (host, port, proxy)
+            connection (httplib.HTTPSConnection): Connection to keep open
+        """
+
+        with self.lock:
+            connections = self.idle.setdefault(key, [])
+            if len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+
+        connection.close()
+
+    def clear(self) -> None:
+        """
+        Close all the idle connections
+        """
+
+        with self.lock:
+            connections = [connection for idle in self.idle.values() for connection in idle]
+            self.idle = {}
+
+        for connection in connections:
+            connection.close()
+
+# Pool shared by all the TAP services of the process
+POOL = ConnectionPool()
+
+class TapService():
+    """
+    This class contains tools to run asynchronous queries on a TAP service (submit, wait for completion, get results).
+    """
+
+    def __init__(self, host: str, port: int, pathinfo: str, proxy: tuple[str, int] = None, verbose: int = 0,
+                params: dict = None, headers: dict = None, phase_tag: str = "uws:phase", poll_interval: float = 0.2,
+                submit_suffix: str = "", journal: JobJournal = None, keep_results: bool = False,
+                retry: RetryPolicy = None, pool: ConnectionPool = None, schema: TableSchema = SCHEMA, compression: bool = True,
+                scheduler: Scheduler = SCHEDULER, priority: str = "bulk") -> None:
+        """
+        Initialize the class
+
+        Args:
+            host (str):
+                Host of the TAP service
+            port (int):
+                Port of the TAP service
+            pathinfo (str):
+                Path of the asynchronous endpoint of the TAP service
+            proxy (tuple[str, int], optional):
+                Proxy to use, if needed. Tuple containing the adresse of the proxy and the port to use. Default to None.
+            verbose (int, optional):
+                Toggle verbose (1 or 0). Default to 0.
+            params (dict, optional):
+                Parameters sent with the query, in addition to the query itself. Default to {"FORMAT": "csv", "PHASE": "RUN"}.
+            headers (dict, optional):
+                Headers sent with the query. Default to None (no header).
+            phase_tag (str, optional):
+                Name of the xml tag containing the phase of the job. Default to 'uws:phase'.
+            poll_interval (float, optional):
+                Time to wait between two checks of the job status (in second). Default to 0.2.
+            submit_suffix (str, optional):
+                Suffix added to pathinfo when submitting the query. Default to "".
+            journal (JobJournal, optional):
+                Journal of the submitted jobs, used to reuse the jobs of a previous run. Default to None.
+            keep_results (bool, optional):
+                Keep the jobs on the server once their results are downloaded. Default to False, jobs are deleted.
+            retry (RetryPolicy, optional):
+                Policy used to retry the requests failing with a transient error. Default to RetryPolicy().
+            pool (ConnectionPool, optional):
+                Pool of the connections kept open between requests. Default to the pool shared by the process.
+            schema (TableSchema, optional):
+                Metadata of the tables, used to parse the results into the type of their columns. If None, the types are
+                guessed from the values. Default to the metadata shared by the process.
+            compression (bool, optional):
+                Ask for the results compressed with gzip or deflate (Accept-Encoding), and decompress them while they are
+                parsed. Default to True.
+            scheduler (Scheduler, optional):
+                Scheduler capping the number of jobs running at the same time on the host and the rate of the requests.
+                If None, the requests are not limited. Default to the scheduler shared by the process.
+            priority (str, optional):
+                Priority class of the queries in the scheduler: 'interactive' (small lookups, served first) or 'bulk'.
+                Default to 'bulk'.
+        """
+
+        self.host = host
+        self.port = port
+        self.pathinfo = pathinfo
+        self.proxy = proxy
+        self.verbose = verbose
+        self.params = params if params is not None else {"FORMAT": "csv", "PHASE": "RUN"}
+        self.headers = headers
+        self.phase_tag = phase_tag
+        self.poll_interval = poll_interval
+        self.submit_suffix = submit_suffix
+        self.journal = journal
+        self.keep_results = keep_results
+        self.retry = retry if retry is not None else RetryPolicy(verbose = verbose)
+        self.pool = pool if pool is not None else POOL
+        self.schema = schema
+        self.compression = compression
+        self.scheduler = scheduler
+        self.priority = priority
+
+    def connect(self) -> httplib.HTTPSConnection:
+        """
+        Open a connection to the TAP service, through the proxy if needed
+
+        Returns:
+            httplib.HTTPSConnection: Connection to the service
+        """
+
+        # Use proxy if needed
+        if self.proxy != None:
+            connection=httplib.HTTPSConnection(self.proxy[0], self.proxy[1])
+            connection.set_tunnel(self.host, self.port)
+        else:
+            connection=httplib.HTTPSConnection(self.host, self.port)
+
+        return connection
+
+    def _open(self, method: str, path: str, body: str = None, headers: dict = None) -> tuple[httplib.HTTPResponse, httplib.HTTPSConnection]:
+        """
+        Send a single request to the TAP service, without reading the content of the response
+
+        Args:
+            method (str): HTTP method
+            path (str): Path of the request
+            body (str, optional): Body of the request. Default to None.
+            headers (dict, optional): Headers of the request. Default to None.
+
+        Returns:
+            tuple[httplib.HTTPResponse, httplib.HTTPSConnection]: Response, whose content is not read yet, and its connection,
+                to give back with release once the content is read
+        """
+
+        key = (self.host, self.port, self.proxy)
+        connection = self.pool.get(key)
+        reused = connection is not None
+        if not reused:
+            connection = self.connect()
+            try:
+                connection.connect()
+            except (OSError, httplib.HTTPException) as error:
+                # Nothing was sent to the server
+                connection.close()
+                raise TransientNetworkError(f"{method} {self.host}{path} failed: {error!r}", sent = False) from error
+
+        try:
+            connection.request(method, path, body, headers if headers is not None else {})
+            response = connection.getresponse()
+        except (OSError, httplib.HTTPException) as error:
+            connection.close()
+            if reused and method == "GET":
+                # The server may have closed the idle connection, try again on another one
+                return self._open(method, path, body, headers)
+            raise TransientNetworkError(f"{method} {self.host}{path} failed: {error!r}") from error
+
+        return response, connection
+
+    def release(self, connection: httplib.HTTPSConnection, response: httplib.HTTPResponse, complete: bool = True) -> None:
+        """
+        Give a connection back to the pool once its response has been read
+
+        Args:
+            connection (httplib.HTTPSConnection): Connection of the response
+            response (httplib.HTTPResponse): Response
+            complete (bool, optional): Whether the response was read to its end. If not, the connection is closed. Default to True.
+        """
+
+        if not complete or response.will_close:
+            connection.close()
+        else:
+            self.pool.put((self.host, self.port, self.proxy), connection)
+
+    def _read(self, method: str, path: str, response: httplib.HTTPResponse, connection: httplib.HTTPSConnection) -> bytes:
+        """
+        Read the content of a response and give its connection back
+
+        Args:
+            method (str): HTTP method of the request
+            path (str): Path of the request
+            response (httplib.HTTPResponse): Response
+            connection (httplib.HTTPSConnection): Connection of the response
+
+        Returns:
+            bytes: Content of the response
+        """
+
+        try:
+            data = response.read()
+        except (OSError, httplib.HTTPException) as error:
+            connection.close()
+            raise TransientNetworkError(f"{method} {self.host}{path} failed: {error!r}") from error
+
+        self.release(connection, response)
+
+        if response.status >= 500:
+            raise TransientNetworkError(f"{method} {self.host}{path} failed: status {response.status} {response.reason}")
+
+        return data
+
+    def _request(self, method: str, path: str, body: str = None, headers: dict = None) -> tuple[httplib.HTTPResponse, bytes]:
+        """
+        Send a single request to the TAP service
+
+        Args:
+            method (str): HTTP method
+            path (str): Path of the request
+            body (str, optional): Body of the request. Default to None.
+            headers (dict, optional): Headers of the request. Default to None.
+
+        Returns:
+            tuple[httplib.HTTPResponse, bytes]: Response (already read) and its content
+        """
+
+        response, connection = self._open(method, path, body, headers)
+        data = self._read(method, path, response, connection)
+
+        return response, data
+
+    def request(self, method: str, path: str, body: str = None, headers: dict = None, metrics: QueryMetrics = None) -> tuple[httplib.HTTPResponse, bytes]:
+        """
+        Send a request to the TAP service, retrying it on transient errors according to the retry policy
+
+        Args:
+            method (str): HTTP method
+            path (str): Path of the request
+            body (str, optional): Body of the request. Default to None.
+            headers (dict, optional): Headers of the request. Default to None.
+            metrics (QueryMetrics, optional): Metrics in which the retries, and the time waited for the rate of the host, are counted. Default to None.
+
+        Returns:
+            tuple[httplib.HTTPResponse, bytes]: Response (already read) and its content
+        """
+
+        self.throttle(metrics)
+
+        return self.retry.call(self._request, method, path, body, headers, metrics = metrics)
+
+    def throttle(self, metrics: QueryMetrics = None) -> None:
+        """
+        Wait until a request can be sent without exceeding the rate of the host (see Scheduler.throttle)
+
+        Args:
+            metrics (QueryMetrics, optional): Metrics in which the time waited is counted as 'throttle'. Default to None.
+        """
+
+        if self.scheduler is None:
+            return
+
+        waited = self.scheduler.throttle(self.host, self.priority)
+        if metrics is not None and waited > 0:
+            metrics.add_time('throttle', waited)
+
+    def _submit(self, params: str, headers: dict = None) -> tuple[str, str]:
+        """
+        Send the query once and read the job location
+
+        Args:
+            params (str): Encoded parameters of the query
+            headers (dict, optional): Headers of the request. Default to self.headers.
+
+        Returns:
+            tuple[str, str]: Job id and job location
+        """
+
+        # Send the query
+        response, data = self._request("POST", self.pathinfo + self.submit_suffix, params, headers if headers is not None else self.headers)
+
+        #Status
+        if self.verbose:
+            print ("Status: " +str(response.status), "Reason: " + str(response.reason))
+
+        if response.status >= 400:
+            raise QueryError(f"Query rejected by {self.host} (status {response.status} {response.reason}): {data.decode('utf-8', 'replace')}")
+
+        #Server job location (URL)
+        location = response.getheader("location")
+        if location is None:
+            raise TransientNetworkError(f"No job location returned by {self.host} (status {response.status} {response.reason})")
+        if self.verbose:
+            print ("Location: " + location)
+
+        #Jobid
+        jobid = location[location.rfind('/')+1:]
+        if self.verbose:
+            print ("Job id: " + jobid)
+
+        return jobid, location
+
+    def find_job(self, runid: str) -> tuple[str, str]:
+        """
+        Look for a job in the job list of the TAP service (UWS), from the RUNID given when it was submitted
+
+        Args:
+            runid (str): RUNID of the job
+
+        Returns:
+            tuple[str, str]: Job id and job location, None if the job is not listed (or the list is not available)
+        """
+
+        response, data = self._request("GET", self.pathinfo)
+        if response.status >= 400:
+            return None
+
+        try:
+            dom = minidom.parseString(data)
+        except Exception as error:
+            raise TransientNetworkError(f"Unreadable job list of {self.host}: {error!r}") from error
+
+        for job in dom.getElementsByTagNameNS("*", "jobref"):
+            runids = job.getElementsByTagNameNS("*", "runId")
+            if len(runids) > 0 and runids[0].firstChild is not None and runids[0].firstChild.nodeValue.strip() == runid:
+                jobid = job.getAttribute("id")
+                location = job.getAttribute("xlink:href") or f"https://{self.host}{self.pathinfo}/{jobid}"
+                return jobid, location
+
+        return None
+
+    def submit(self, query: str, metrics: QueryMetrics = None, uploads: dict = None) -> str:
+        """
+        Submit a query to the TAP service. The query is only sent again if the previous attempt could not reach the
+        server, or if its job is not in the job list of the service (see find_job): a job created by an attempt whose
+        answer was lost is used instead of submitting a second one.
+
+        Args:
+            query (str): ADQL query
+            metrics (QueryMetrics, optional): Metrics to update. Default to None.
+            uploads (dict, optional): Tables uploaded with the query, as {name: VOTable content}. They are
+                available in the query as TAP_UPLOAD.name. Default to None.
+
+        Returns:
+            str: Job id
+        """
+
+        if metrics is None:
+            metrics = QueryMetrics()
+
+        # Encode the query, with the uploaded tables if any. The RUNID identifies the job in the job list of the service.
+        runid = f"obsfinder-{uuid.uuid4().hex}"
+        if uploads:
+            params = {**self.params, "QUERY": f"{query}", "RUNID": runid, "UPLOAD": ";".join(f"{name},param:{name}" for name in uploads)}
+            params, content_type = encode_multipart(params, uploads)
+            headers = {**(self.headers or {}), "Content-type": content_type}
+        else:
+            params = urllib.urlencode({**self.params, "QUERY": f"{query}", "RUNID": runid})
+            headers = None
+
+        sent = False
+        def attempt():
+            nonlocal sent
+            if sent:
+                # A previous attempt may have created the job, look for it before sending the query again
+                found = self.find_job(runid)
+                if found is not None:
+                    return found
+            try:
+                return self._submit(params, headers)
+            except TransientNetworkError as error:
+                sent = sent or error.sent
+                raise
+
+        self.throttle(metrics)
+        with metrics.timer('submit', host = self.host) as span:
+            jobid, location = self.retry.call(attempt, metrics = metrics)
+            span['job_id'] = jobid
+
+        metrics.add_job(jobid)
+
+        if self.journal is not None:
+            self.journal.record(self.journal.key(self.host, self.pathinfo, query, uploads), 'SUBMITTED',
+                                host = self.host, port = self.port, pathinfo = self.pathinfo, jobid = jobid, location = location)
+
+        return jobid
+
+    def phase(self, jobid: str) -> tuple[str, bytes]:
+        """
+        Get the phase of a job (single attempt, see RetryPolicy.call to retry it)
+
+        Args:
+            jobid (str): Job id
+
+        Returns:
+            tuple[str, bytes]: Phase of the job and the raw job description. The phase is None if the job does not exist anymore.
+        """
+
+        response, data = self._request("GET", self.pathinfo + "/" + jobid)
+
+        if response.status >= 400:
+            return None, data
+
+        try:
+            dom = minidom.parseString(data)
+            phaseElement = dom.getElementsByTagName(self.phase_tag)[0]
+            phaseValueElement = phaseElement.firstChild
+            phase = phaseValueElement.toxml()
+        except Exception as error:
+            # Truncated or unexpected answer, most likely a proxy or server hiccup
+            raise TransientNetworkError(f"Unreadable status of job {jobid}: {error!r}") from error
+
+        return phase, data
+
+    def error_message(self, data: bytes) -> str:
+        """
+        Extract the error message from a job description
+
+        Args:
+            data (bytes): Raw job description
+
+        Returns:
+            str: Error message, empty if not found
+        """
+
+        try:
+            dom = minidom.parseString(data)
+            for tag in ['uws:message', 'message']:
+                elements = dom.getElementsByTagName(tag)
+                if len(elements) > 0 and elements[0].firstChild is not None:
+                    return elements[0].firstChild.nodeValue.strip()
+        except Exception:
+            pass
+
+        return ""
+
+    def resume(self, key: str, metrics: QueryMetrics = None) -> str:
+        """
+        Look for a job already submitted for the same query in the journal, and check that it
+        can still be used (it is pending, queued, executing or completed on the server).
+
+        Args:
+            key (str): Key of the query in the journal
+            metrics (QueryMetrics, optional): Metrics to update. Default to None.
+
+        Returns:
+            str: Job id of the reusable job, None if the query has to be submitted
+        """
+
+        entry = self.journal.get(key)
+        if entry is None or entry["state"] in ['ABORTED', 'DELETED']:
+            return None
+
+        self.throttle(metrics)
+        phase, _ = self.retry.call(self.phase, entry["jobid"], metrics = metrics)
+        if phase not in ['PENDING', 'QUEUED', 'EXECUTING', 'COMPLETED']:
+            if self.verbose:
+                print(f"Job {entry['jobid']} from the journal cannot be reused (phase: {phase})")
+            return None
+
+        if self.verbose:
+            print(f"Reusing job {entry['jobid']} from the journal (phase: {phase})")
+
+        if metrics is not None:
+            metrics.count('jobs_resumed', 1)
+            metrics.job_ids.append(entry["jobid"])
+
+        return entry["jobid"]
+
+    def wait(self, jobid: str, metrics: QueryMetrics = None, key: str = None) -> None:
+        """
+        Check the job status until it is finished. Time spent while the job is
+        pending or queued is counted as 'queue', time spent while it is executing
+        is counted as 'execution'.
+
+        Args:
+            jobid (str): Job id
+            metrics (QueryMetrics, optional): Metrics to update. Default to None.
+            key (str, optional): Key of the query in the journal, if any. Default to None.
+        """
+
+        if metrics is None:
+            metrics = QueryMetrics()
+
+        t_last = time.perf_counter()
+        last_phase = None
+
+        with metrics.span('poll', job_id = jobid, polls = 0) as span:
+            # Check job status, wait until finished
+            while True:
+                self.throttle(metrics)
+                phase, data = self.retry.call(self.phase, jobid, metrics = metrics)
+                span['polls'] += 1
+                if self.verbose:
+                    print ("Status: " + str(phase))
+
+                t_now = time.perf_counter()
+                metrics.add_time('execution' if last_phase == 'EXECUTING' else 'queue', t_now - t_last)
+                t_last = t_now
+                last_phase = phase
+
+                #Check finished
+                if phase == 'COMPLETED':
+                    if key is not None:
+                        self.journal.record(key, 'COMPLETED')
+                    break
+
+                if phase in ['ERROR', 'ABORTED']:
+                    raise JobFailed(jobid, phase, self.error_message(data))
+
+                if phase is None:
+                    raise JobFailed(jobid, phase, "the job does not exist on the server")
+
+                #wait and repeat
+                time.sleep(self.poll_interval)
+
+    def fetch(self, jobid: str, metrics: QueryMetrics = None):
+        """
+        Download the result of a completed job (single attempt, see read_result to retry it). With compression,
+        the result is asked compressed, and is read from the open response and decompressed while it is parsed.
+        The bytes received are counted in 'bytes_downloaded', and the bytes of the decoded result in 'bytes_decoded'.
+
+        Args:
+            jobid (str): Job id
+            metrics (QueryMetrics, optional): Metrics to update. Default to None.
+
+        Returns:
+            str or io.BufferedReader: Content of the result, or stream of the decoded result if it is sent compressed
+                (to close once read, its connection being given back to the pool at the end of the response)
+        """
+
+        # Get results
+        if self.verbose:
+            print("Retrieving data...")
+
+        if metrics is None:
+            metrics = QueryMetrics()
+
+        self.throttle(metrics)
+        with metrics.timer('download', job_id = jobid) as span:
+            headers = {"Accept-Encoding": "gzip, deflate"} if self.compression else None
+            path = self.pathinfo + "/" + jobid + "/results/result"
+            response, connection = self._open("GET", path, headers = headers)
+            encoding = (response.getheader("Content-Encoding") or "identity").strip().lower()
+            span['encoding'] = encoding
+
+            if response.status < 400 and encoding in ("gzip", "x-gzip", "deflate"):
+                release = lambda complete: self.release(connection, response, complete)
+                return io.BufferedReader(DecodedStream(response, encoding, metrics, release), buffer_size = CHUNK_SIZE)
+
+            raw = self._read("GET", path, response, connection)
+            if response.status >= 400:
+                raise JobFailed(jobid, 'COMPLETED', f"results not available (status {response.status} {response.reason})")
+            span['bytes'] = len(raw)
+
+        metrics.count('bytes_downloaded', len(raw))
+        metrics.count('bytes_decoded', len(raw))
+
+        return raw.decode('iso-8859-1')
+
+    def read_result(self, jobid: str, metrics: QueryMetrics = None, key: str = None, kinds: dict = None) -> pd.DataFrame:
+        """
+        Download and parse the result of a completed job, retrying it on transient errors (including a connection
+        lost while the result is streamed) according to the retry policy
+
+        Args:
+            jobid (str): Job id
+            metrics (QueryMetrics, optional): Metrics to update. Default to None.
+            key (str, optional): Key of the query in the journal, if any. Default to None.
+            kinds (dict, optional): Kind of the columns (see parse_csv). Default to None.
+
+        Returns:
+            pd.DataFrame: Dataframe containing the data
+        """
+
+        if metrics is None:
+            metrics = QueryMetrics()
+
+        def attempt():
+            data = self.fetch(jobid, metrics)
+            try:
+                with metrics.timer('parse', job_id = jobid) as span:
+                    data = parse_csv(data, kinds)
+                    span['rows'] = len(data)
+            finally:
+                if isinstance(data, io.BufferedReader):
+                    data.close()
+            return data
+
+        data = self.retry.call(attempt, metrics = metrics)
+
+        if key is not None:
+            self.journal.record(key, 'FETCHED')
+
+        return data
+
+    def delete(self, jobid: str, key: str = None) -> int:
+        """
+        Delete a job and its results from the server, to free the quota of the user
+
+        Args:
+            jobid (str): Job id
+            key (str, optional): Key of the query in the journal, if any. Default to None.
+
+        Returns:
+            int: HTTP status of the response
+        """
+
+        response, _ = self.request("POST", self.pathinfo + "/" + jobid, urllib.urlencode({"ACTION": "DELETE"}),
+                                   {"Content-type": "application/x-www-form-urlencoded"})
+
+        if self.verbose:
+            print(f"Job {jobid} deleted (status: {response.status})")
+
+        if key is not None:
+            self.journal.record(key, 'DELETED')
+
+        return response.status
+
+    def abort(self, jobid: str, key: str = None) -> None:
+        """
+        Abort a job that is still running on the server. The job is also deleted, unless keep_results is set.
+        Errors are ignored, as this is called while another error is being handled.
+
+        Args:
+            jobid (str): Job id
+            key (str, optional): Key of the query in the journal, if any. Default to None.
+        """
+
+        try:
+            response, _ = self._request("POST", self.pathinfo + "/" + jobid + "/phase", urllib.urlencode({"PHASE": "ABORT"}),
+                                        {"Content-type": "application/x-www-form-urlencoded"})
+
+            if self.verbose:
+                print(f"Job {jobid} aborted (status: {response.status})")
+
+            if key is not None:
+                self.journal.record(key, 'ABORTED')
+
+            if not self.keep_results:
+                self.delete(jobid, key)
+        except Exception as error:
+            if self.verbose:
+                print(f"Could not abort job {jobid}: {error}")
+
+    def run(self, query: str, metrics: QueryMetrics = None, uploads: dict = None) -> pd.DataFrame:
+        """
+        Run a query: submit it, wait until the job is finished and get the results
+
+        Args:
+            query (str): ADQL query
+            metrics (QueryMetrics, optional): Metrics to update. Default to None.
+            uploads (dict, optional): Tables uploaded with the query, as {name: VOTable content}. Default to None.
+
+        Returns:
+            pd.DataFrame: Dataframe containing the data
+        """
+
+        if metrics is None:
+            metrics = QueryMetrics()
+
+        kinds = self.schema.kinds(self, query) if self.schema is not None else None
+
+        # Job slot of the host, held until the results are downloaded (see Scheduler.slot)
+        with self.scheduler.slot(self.host, self.priority) if self.scheduler is not None else nullcontext(0.) as waited:
+            metrics.add_time('schedule', waited)
+            key = None
+            jobid = None
+            if self.journal is not None:
+                key = self.journal.key(self.host, self.pathinfo, query, uploads)
+                jobid = self.resume(key, metrics)
+
+            if jobid is None:
+                jobid = self.submit(query, metrics, uploads)
+
+            # Abort the job if anything goes wrong (including KeyboardInterrupt), so that it does not keep running on the server
+            try:
+                self.wait(jobid, metrics, key)
+                # The result is parsed while it is downloaded, before the job is deleted
+                data = self.read_result(jobid, metrics, key, kinds)
+            except BaseException:
+                self.abort(jobid, key)
+                raise
+
+        if not self.keep_results:
+            try:
+                self.delete(jobid, key)
+            except Exception as error:
+                if self.verbose:
+                    print(f"Could not delete job {jobid}: {error}")
+
+        metrics.count('rows_raw', len(data))
+
+        return data
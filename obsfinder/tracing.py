@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+
+from .lazy import lazy_import
+from contextlib import contextmanager
+import threading
+import time
+import os
+
+json = lazy_import("json")
+
+class Tracer():
+    """
+    This class collects nested spans (pixel, submit, poll, fetch, parse, clean, zero-point, write)
+    and writes them in the Chrome trace-event JSON format, which can be loaded in Perfetto
+    (https://ui.perfetto.dev) or chrome://tracing. Spans from several threads are kept on
+    separate tracks, so that overlaps and idle gaps between concurrent jobs are visible.
+    """
+
+    def __init__(self, filename: str = None) -> None:
+        """
+        Initialize the class
+
+        Args:
+            filename (str, optional):
+                Default file in which the trace is written by write(). Default to None.
+        """
+
+        self.filename = filename
+        self.events = []
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+        self.pid = os.getpid()
+        self.threads = set()
+
+    def add_span(self, name: str, start: float, end: float, **args) -> None:
+        """
+        Add a complete span
+
+        Args:
+            name (str): Name of the span
+            start (float): Start of the span, as given by time.perf_counter()
+            end (float): End of the span, as given by time.perf_counter()
+            **args: Attributes of the span (job id, number of rows, ...)
+        """
+
+        thread = threading.current_thread()
+        event = {"name": name, "ph": "X", "pid": self.pid, "tid": thread.ident,
+                 "ts": (start - self.origin) * 1e6, "dur": (end - start) * 1e6,
+                 "args": {key: value for key, value in args.items() if value is not None}}
+
+        with self.lock:
+            self.events.append(event)
+            if thread.ident not in self.threads:
+                self.threads.add(thread.ident)
+                self.events.append({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": thread.ident,
+                                    "args": {"name": thread.name}})
+
+    @contextmanager
+    def span(self, name: str, **args):
+        """
+        Context manager recording the block as a span. The yielded dictionary can be
+        updated within the block to add attributes known only at the end (job id, rows, ...).
+
+        Args:
+            name (str): Name of the span
+            **args: Attributes of the span
+        """
+
+        t0 = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.add_span(name, t0, time.perf_counter(), **args)
+
+    def write(self, filename: str = None) -> None:
+        """
+        Write the trace in the Chrome trace-event JSON format
+
+        Args:
+            filename (str, optional): Output file. Uses self.filename if not provided.
+        """
+
+        if filename is None:
+            filename = self.filename
+
+        with self.lock:
+            trace = {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+        with open(filename, 'w') as f:
+            json.dump(trace, f)
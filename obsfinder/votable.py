@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+
+def escape(text: str) -> str:
+    """
+    Escape the characters of a text that are special in XML (xml.sax.saxutils imports urllib.request, too slow for the start-up)
+
+    Args:
+        text (str): Text of an element or of an attribute
+
+    Returns:
+        str: Escaped text
+    """
+
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+def write_votable(name: str, columns: dict) -> bytes:
+    """
+    Write a table as a VOTable, to be uploaded to a TAP service (TAP_UPLOAD)
+
+    Args:
+        name (str): Name of the table
+        columns (dict): Columns of the table, as {name: (datatype, values)}. The datatype is a VOTable
+            datatype ('long', 'double', 'char', ...). All the columns must have the same number of values.
+
+    Returns:
+        bytes: VOTable (TABLEDATA serialization), encoded in utf-8
+    """
+
+    fields = []
+    for column, (datatype, _) in columns.items():
+        arraysize = ' arraysize="*"' if datatype == 'char' else ''
+        fields.append(f'<FIELD name="{escape(column)}" datatype="{datatype}"{arraysize}/>')
+
+    values = [values for _, values in columns.values()]
+    rows = "".join("<TR>" + "".join(f"<TD>{escape(str(value))}</TD>" for value in row) + "</TR>\n" for row in zip(*values))
+
+    return (f'<?xml version="1.0" encoding="UTF-8"?>\n'
+            f'<VOTABLE version="1.4" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">\n'
+            f'<RESOURCE type="results">\n<TABLE name="{escape(name)}">\n'
+            + "\n".join(fields) +
+            f'\n<DATA><TABLEDATA>\n{rows}</TABLEDATA></DATA>\n</TABLE>\n</RESOURCE>\n</VOTABLE>\n').encode('utf-8')
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+from __future__ import annotations
+
+from .lazy import lazy_import
+
+np = lazy_import("numpy")
+spatial = lazy_import("scipy.spatial")
+
+def unit_vectors(lon, lat) -> np.ndarray:
+    """
+    Cartesian unit vectors of positions on the sphere
+
+    Args:
+        lon (array-like): Longitudes (in degree)
+        lat (array-like): Latitudes (in degree)
+
+    Returns:
+        np.ndarray: Unit vectors, of shape (n, 3)
+    """
+
+    lon = np.radians(np.asarray(lon, dtype = np.float64))
+    lat = np.radians(np.asarray(lat, dtype = np.float64))
+
+    return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+def cross_match(lon1, lat1, lon2, lat2, radius: float = 1., best_neighbour: str = "first") -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Match the sources of a first catalog to their nearest neighbour in a second catalog, within a radius.
+    The second catalog is indexed with a KD-tree built on the unit vectors of its sources, so that both
+    catalogs must use the same frame (e.g. galactic l, b).
+
+    Args:
+        lon1 (array-like): Longitudes of the sources of the first catalog (in degree)
+        lat1 (array-like): Latitudes of the sources of the first catalog (in degree)
+        lon2 (array-like): Longitudes of the sources of the second catalog (in degree)
+        lat2 (array-like): Latitudes of the sources of the second catalog (in degree)
+        radius (float, optional): Maximum separation of two matched sources (in arcsecond). Default to 1.
+        best_neighbour (str, optional): 'first' to keep the nearest neighbour of each source of the first catalog, a source of
+            the second catalog possibly being the neighbour of several ones (as the best neighbour tables of the Gaia archive),
+            or 'mutual' to only keep the pairs in which each source is the nearest neighbour of the other. Default to 'first'.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: Indices of the matched sources in the first and in the second catalog, and their separation (in arcsecond)
+    """
+
+    if best_neighbour not in ("first", "mutual"):
+        raise ValueError(f"Unknown best neighbour selection '{best_neighbour}', use 'first' or 'mutual'")
+
+    vectors1 = unit_vectors(lon1, lat1)
+    vectors2 = unit_vectors(lon2, lat2)
+    if len(vectors1) == 0 or len(vectors2) == 0:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64), np.zeros(0)
+
+    # Distance between the unit vectors of two sources separated by the radius
+    chord = 2 * np.sin(np.radians(radius / 3600) / 2)
+    distance, index2 = spatial.cKDTree(vectors2).query(vectors1, k = 1, distance_upper_bound = chord)
+    index1 = np.flatnonzero(np.isfinite(distance))
+    index2 = index2[index1]
+    distance = distance[index1]
+
+    if best_neighbour == "mutual" and len(index1) > 0:
+        # Keep the pairs in which the source of the first catalog is also the nearest neighbour of the source of the
+        # second one, among all the sources of the first catalog
+        _, nearest1 = spatial.cKDTree(vectors1).query(vectors2[index2], k = 1)
+        keep = nearest1 == index1
+        index1, index2, distance = index1[keep], index2[keep], distance[keep]
+
+    separation = np.degrees(2 * np.arcsin(distance / 2)) * 3600
+
+    return index1, index2, separation
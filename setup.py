@@ -18,7 +18,9 @@ setuptools.setup(
             'pyfind2mass = obsfinder.find2mass:main',
             'pyfindgaia2mass = obsfinder.findgaia2mass:main',
             'pyfinder = obsfinder.finder:main',
-            'pyfindsimbad = obsfinder.findsimbad:main'
+            'pyfindsimbad = obsfinder.findsimbad:main',
+            'pyfindcleanup = obsfinder.cleanup:main',
+            'pyfinderd = obsfinder.daemon:main'
         ],
     },
     packages=['obsfinder'],
@@ -28,6 +30,7 @@ setuptools.setup(
         "pandas>=1.5.3",
         "pathlib>=1.0.1",
         "h5py>=3.8.0",
+        "scipy>=1.6.0",
         "tables>=3.8.0",
         "gaiadr3-zeropoint>=0.0.5"
     ],